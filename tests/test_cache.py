@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Test the persistent array cache.
+"""
+__author__ = "Alex Drlica-Wagner"
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from ugali.utils.cache import DiskCache, MemoryCache, hash_args, freeze
+from ugali.analysis.model import Parameter
+
+def test_hash_args():
+    x = np.arange(10,dtype='f8')
+    np.testing.assert_equal(hash_args(x,1.0),hash_args(x.copy(),1.0))
+    assert hash_args(x,1.0) != hash_args(x,2.0)
+    assert hash_args(x) != hash_args(x.astype('f4'))
+
+    d = dict(age=Parameter(12.0),isochrones=[dict(z=Parameter(1e-4))])
+    np.testing.assert_equal(freeze(d),(('age',12.0),('isochrones',((('z',1e-4),),))))
+
+def test_memory_cache():
+    cache = MemoryCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.put('a',1)
+    cache.put('b',2)
+    # Touch 'a' so that 'b' is the least recently used
+    assert cache.get('a') == 1
+    cache.put('c',3)
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
+
+def test_disk_cache():
+    dirname = tempfile.mkdtemp()
+    try:
+        nbytes = 100*4 + 128 # float32 payload plus npy header
+        cache = DiskCache(dirname,max_bytes=2*nbytes+10)
+        x = np.linspace(0,1,100)
+
+        assert cache.get('a',['x']) is None
+        cache.put('a',x=x)
+        out, = cache.get('a',['x'])
+        assert isinstance(out,np.memmap)
+        np.testing.assert_equal(out.dtype,np.float32)
+        np.testing.assert_allclose(out,x,rtol=1e-7)
+
+        # Touch 'a' so that 'b' is the least recently used
+        cache.put('b',x=x)
+        os.utime(cache.path('b'),(0,0))
+        cache.get('a',['x'])
+        cache.put('c',x=x)
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+        assert cache.nbytes() <= cache.max_bytes
+    finally:
+        shutil.rmtree(dirname)
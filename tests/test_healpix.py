@@ -4,6 +4,8 @@ Testing healpix module
 """
 __author__ = "Alex Drlica-Wagner"
 
+import os
+import tempfile
 import unittest
 
 import numpy as np
@@ -38,6 +40,18 @@ DU_GRADE_PIX_RING = np.array([[104582830, 104566446, 104566445, 104550062],
 
 
 
+def superpixel_ang(subpix, nside_subpix, nside_superpix):
+    """ Reference superpixel through the pixel centers. """
+    theta, phi =  hp.pix2ang(nside_subpix, subpix)
+    return hp.ang2pix(nside_superpix, theta, phi)
+
+def subpixel_disc(superpix, nside_superpix, nside_subpix):
+    """ Reference subpixel through a disc query. """
+    vec = hp.pix2vec(nside_superpix, superpix)
+    radius = 2. * hp.max_pixrad(nside_superpix)
+    subpix = hp.query_disc(nside_subpix, vec, radius, inclusive=True)
+    return subpix[superpixel_ang(subpix,nside_subpix,nside_superpix) == superpix]
+
 class TestHealpix(unittest.TestCase):
     """Test healpix module"""
 
@@ -81,3 +95,148 @@ class TestHealpix(unittest.TestCase):
 
 
 
+
+    def test_lookup_partial_map(self):
+        pix = np.array([PIX[1],PIX[0],PIX[2]])
+        value = np.array([1.,2.,3.])
+        pixels = np.array([PIX[0],PIX[0]+1,PIX[2]])
+
+        np.testing.assert_equal(healpix.lookup_partial_map(pix,value,pixels),
+                                [2.,hp.UNSEEN,3.])
+        np.testing.assert_equal(healpix.lookup_partial_map(pix[:0],value[:0],pixels),
+                                [hp.UNSEEN]*3)
+
+        # Integer values are filled with -1
+        np.testing.assert_equal(healpix.lookup_partial_map(np.array([1,5]),np.array([3,4]),
+                                                           np.array([5,6])),[4,-1])
+        np.testing.assert_equal(healpix.lookup_partial_map(np.array([1,5]),np.array([3,4]),
+                                                           np.array([5,6]),fill_value=0),[4,0])
+
+    def test_read_partial_map_pixels(self):
+        nside = 64
+        pix = np.array([100,5,4000,7,2500])
+        data = dict(PIXEL=pix,VALUE=pix.astype(float))
+        filename = os.path.join(tempfile.mkdtemp(),'partial.fits')
+        healpix.write_partial_map(filename,data,nside)
+
+        # Rows are sorted by pixel and indexed
+        np.testing.assert_equal(fitsio.read(filename)['PIXEL'],np.sort(pix))
+        index = fitsio.read(filename,ext='PIX_INDEX')
+        np.testing.assert_equal(index['PIXMIN'][0],5)
+
+        pixels = np.array([7,8,2500])
+        _,_,value = healpix.read_partial_map(filename,'VALUE',pixels=pixels)
+        np.testing.assert_equal(value,[7.,hp.UNSEEN,2500.])
+        os.remove(filename)
+
+    def test_superpixel_subpixel(self):
+        np.random.seed(0)
+        subpix = np.random.randint(0,hp.nside2npix(NSIDE),10000)
+        for nside in [1,32,256,NSIDE]:
+            np.testing.assert_equal(healpix.superpixel(subpix,NSIDE,nside),
+                                    superpixel_ang(subpix,NSIDE,nside))
+
+        for superpix in [0,PIX[0]//64,hp.nside2npix(NSIDE//8)-1]:
+            np.testing.assert_equal(healpix.subpixel(superpix,NSIDE//8,NSIDE),
+                                    subpixel_disc(superpix,NSIDE//8,NSIDE))
+
+        # Batch form
+        superpix = healpix.superpixel(subpix[:10],NSIDE,NSIDE//4)
+        subpixels = healpix.subpixel(superpix,NSIDE//4,NSIDE)
+        np.testing.assert_equal(subpixels.shape,(10,16))
+        np.testing.assert_equal((subpixels == subpix[:10,np.newaxis]).sum(axis=1),1)
+
+        with self.assertRaises(ValueError):
+            healpix.superpixel(subpix,NSIDE,3)
+
+    def test_sparse_healpix_map(self):
+        nside = 64
+        pix = np.array([100,5,4000,7,2500])
+        values = dict(A=pix.astype(float),B=np.vstack([pix,2*pix]).T)
+        m = healpix.SparseHealpixMap(nside,pix,values)
+        np.testing.assert_equal(m.pixels,np.sort(pix))
+        np.testing.assert_equal(m.names,['A','B'])
+
+        # Lookup
+        pixels = np.array([7,8,2500,hp.nside2npix(nside)-1])
+        np.testing.assert_equal(m.lookup(pixels,'A'),[7.,hp.UNSEEN,2500.,hp.UNSEEN])
+        np.testing.assert_equal(m.lookup(pixels,'B')[2],[2500,5000])
+        np.testing.assert_equal(m.lookup(pixels,'B')[1],[-1,-1])
+        np.testing.assert_equal(m.fullsky('B')[8],[-1,-1])
+        np.testing.assert_equal(m.contains(pixels),[True,False,True,False])
+        np.testing.assert_equal(m.fullsky('A')[pix],pix)
+
+        with self.assertRaises(ValueError):
+            healpix.SparseHealpixMap(nside,[1,1],[1.,2.])
+
+        # Degrade and upgrade
+        sub = healpix.subpixel(10,nside,nside*4)
+        m = healpix.SparseHealpixMap(nside*4,sub[:6],np.arange(6.))
+        mean = m.ud_grade(nside)
+        np.testing.assert_equal(mean.pixels,[10])
+        np.testing.assert_equal(mean['VALUE'],[2.5])
+        np.testing.assert_equal(m.ud_grade(nside,how='max')['VALUE'],[5.])
+        up = mean.ud_grade(nside*4,how='sum')
+        np.testing.assert_equal(up.pixels,sub)
+        np.testing.assert_equal(up['VALUE'],np.ones(16)*2.5/16)
+
+        # Set operations
+        m1 = healpix.SparseHealpixMap(nside,[1,2,3],[1.,2.,3.])
+        m2 = healpix.SparseHealpixMap(nside,[3,4],[30.,40.])
+        np.testing.assert_equal(m1.union(m2)['VALUE'],[1.,2.,3.,40.])
+        np.testing.assert_equal(m1.intersection(m2).pixels,[3])
+        np.testing.assert_equal(m2.intersection(m1)['VALUE'],[30.])
+
+        # FITS round trip (reading a subset of pixels)
+        filename = os.path.join(tempfile.mkdtemp(),'sparse.fits')
+        m1.write(filename)
+        m = healpix.SparseHealpixMap.read(filename)
+        np.testing.assert_equal(m.pixels,m1.pixels)
+        np.testing.assert_equal(m['VALUE'],m1['VALUE'])
+        m = healpix.SparseHealpixMap.read(filename,'VALUE',pixels=[2,5])
+        np.testing.assert_equal(m.pixels,[2])
+        os.remove(filename)
+
+    def test_merge_partial_maps(self):
+        nside = 64
+        distance = np.array([16.,17.,18.],dtype='f4')
+        dirname = tempfile.mkdtemp()
+        filenames = []
+        for i,pix in enumerate([np.array([100,5,4000]),np.array([7,2500])]):
+            filename = os.path.join(dirname,'merge_%i.fits'%i)
+            value = np.outer(pix,np.arange(len(distance))).astype('f4')
+            healpix.write_partial_map(filename,dict(PIXEL=pix,VALUE=value),nside)
+            fitsio.write(filename,{'DISTANCE_MODULUS':distance},
+                         extname='DISTANCE_MODULUS')
+            filenames.append(filename)
+
+        outfile = os.path.join(dirname,'merged.fits')
+        healpix.stream_partial_maps(filenames,outfile,chunksize=2,threads=2)
+        _nside,data,dist = healpix.merge_partial_maps(filenames,None)
+        merged = fitsio.read(outfile,ext='PIX_DATA')
+        np.testing.assert_equal(merged['PIXEL'],[5,7,100,2500,4000])
+        np.testing.assert_equal(merged['VALUE'][:,1],merged['PIXEL'])
+        np.testing.assert_equal(np.sort(data['PIXEL']),merged['PIXEL'])
+        np.testing.assert_equal(fitsio.read(outfile,ext='DISTANCE_MODULUS')['DISTANCE_MODULUS'],dist)
+
+        # Duplicate pixels are not allowed
+        with self.assertRaises(Exception):
+            healpix.stream_partial_maps(filenames+filenames[:1],outfile)
+
+def benchmark(n=1000000, nsub=100):
+    """ Compare the integer hierarchy operations to the angular ones. """
+    import timeit
+    np.random.seed(0)
+    subpix = np.random.randint(0,hp.nside2npix(NSIDE),n)
+    superpix = np.unique(healpix.superpixel(subpix[:nsub],NSIDE,NSIDE//16))
+
+    for name,func in [('superpixel',healpix.superpixel),('superpixel_ang',superpixel_ang)]:
+        t = timeit.timeit(lambda: func(subpix,NSIDE,32),number=3)/3.
+        print("%-16s %i pixels: %.4f s"%(name,n,t))
+
+    for name,func in [('subpixel',healpix.subpixel),('subpixel_disc',subpixel_disc)]:
+        t = timeit.timeit(lambda: [func(p,NSIDE//16,NSIDE) for p in superpix],number=3)/3.
+        print("%-16s %i pixels: %.4f s"%(name,len(superpix),t))
+
+if __name__ == "__main__":
+    benchmark()
@@ -115,6 +115,116 @@ def test_pdf():
                              0.02930542, 0.03083482], dtype=np.float32)
     np.testing.assert_array_almost_equal(u_color[9490:9500],test_results)
 
+    # The chunked pdf should not depend on the memory budget
+    u_chunk = iso.pdf(mag_1, mag_2, mag_err_1, mag_err_2, max_bytes=1e5)
+    np.testing.assert_allclose(u_chunk,u_color,rtol=1e-5,atol=1e-9)
+
+    # ...and should agree with the dense calculation
+    sel = slice(9400,9600)
+    u_dense = iso.pdf_dense(mag_1[sel], mag_2[sel], mag_err_1[sel], mag_err_2[sel])
+    np.testing.assert_allclose(u_color[sel],u_dense,rtol=1e-5,atol=1e-9)
+
+    # The separable calculation should give the same answer
+    u_sep = iso.pdf(mag_1, mag_2, mag_err_1, mag_err_2, mode='separable')
+    np.testing.assert_allclose(u_sep,u_color,rtol=1e-5,atol=1e-9)
+
+    # Several distance moduli at once (in absolute magnitude, so the
+    # bin edges differ from the float32 apparent edges at ~1e-6 mag)
+    moduli = [17.5, 18.0, 18.5]
+    u_mod = iso.pdf(mag_1, mag_2, mag_err_1, mag_err_2, distance_modulus=moduli)
+    np.testing.assert_equal(u_mod.shape,(len(moduli),len(mag_1)))
+    for u,mod in zip(u_mod,moduli):
+        np.testing.assert_allclose(u,iso.pdf(mag_1, mag_2, mag_err_1, mag_err_2, mod),
+                                   rtol=1e-4,atol=1e-9)
+
+def test_memo():
+    """ Test memoization of isochrone samples and histograms. """
+    iso = isochrone.Bressan2012(**default_kwargs)
+    sample = iso.sample(mass_steps=1000)
+    np.testing.assert_equal(sample,iso._sample(mass_steps=1000))
+
+    # Modifying the returned sample should not modify the cache
+    sample[1] *= 2
+    np.testing.assert_equal(iso.sample(mass_steps=1000),iso._sample(mass_steps=1000))
+
+    # Histograms only shift with distance modulus
+    pdf_18,bins_1_18,bins_2_18 = iso.histogram2d(18,0.01,1000)
+    pdf_20,bins_1_20,bins_2_20 = iso.histogram2d(20,0.01,1000)
+    np.testing.assert_equal(pdf_18,pdf_20)
+    np.testing.assert_allclose(bins_1_20-bins_1_18,2.0,atol=1e-5)
+    np.testing.assert_allclose(bins_2_20-bins_2_18,2.0,atol=1e-5)
+
+    # Changing the age should invalidate the cache
+    iso.age = alt_kwargs['age']
+    np.testing.assert_equal(iso.sample(mass_steps=1000),iso._sample(mass_steps=1000))
+    np.testing.assert_equal(iso.stellar_mass(),iso._stellar_mass())
+
+def test_archive():
+    """ Test loading isochrones from a binary archive. """
+    import shutil, tempfile
+    from ugali.isochrone.archive import create_archive, IsochroneArchive
+
+    iso = isochrone.Bressan2012(**default_kwargs)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(iso.filename,tmpdir)
+        outfile = create_archive(iso,filenames=[iso.filename],
+                                 outfile=os.path.join(tmpdir,'archive.npy'))
+        archive = IsochroneArchive.open(outfile)
+        assert os.path.basename(iso.filename) in archive
+
+        new = isochrone.Bressan2012(dirname=tmpdir,**default_kwargs)
+        assert isinstance(new.data,np.memmap)
+        np.testing.assert_equal(new.data,iso.data)
+        np.testing.assert_equal(new.sample(),iso.sample())
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_archive_object_columns():
+    """ Test that object columns round-trip through the archive. """
+    import shutil, tempfile
+    from ugali.isochrone.archive import create_archive, IsochroneArchive
+
+    # Padova-like file with a (partially empty) stage column
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir,'iso_a12.0_z0.00010.dat')
+    with open(filename,'w') as f:
+        f.write('0.1\t\n0.5\tBHeb\n0.8\t\n0.9\tLTP\n')
+    kwargs = dict(delimiter='\t',dtype=[('mass_init',float),('stage',object)])
+
+    class Iso(object):
+        _prefix = 'iso'
+        def get_dirname(self): return tmpdir
+        def _parse(self, filename): self.data = self._genfromtxt(filename,**kwargs)
+
+    try:
+        outfile = create_archive(Iso())
+        data = IsochroneArchive.open(outfile).get(os.path.basename(filename),kwargs)
+        expected = np.genfromtxt(filename,**kwargs)
+        np.testing.assert_equal(data['mass_init'],expected['mass_init'])
+        assert data.dtype['stage'].kind == 'S'
+        assert data['stage'].tolist() == expected['stage'].tolist()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_interpolate():
+    """ Test interpolation between isochrone grid points. """
+    iso = isochrone.Bressan2012(**default_kwargs)
+    interp = isochrone.Bressan2012(interpolate=True,**default_kwargs)
+
+    # Grid points are reproduced exactly
+    for name in ['mass_init','mass_act','mag_1','mag_2']:
+        np.testing.assert_allclose(getattr(interp,name),getattr(iso,name))
+
+    # Between grid points the isochrone lies between the nodes
+    ages = np.unique(iso.agrid)
+    if len(ages) < 2: return
+    iso.age = ages[0]; mag_lo = iso.mag_1.min()
+    iso.age = ages[1]; mag_hi = iso.mag_1.min()
+    interp.age = 0.5*(ages[0]+ages[1])
+    assert min(mag_lo,mag_hi) <= interp.mag_1.min() <= max(mag_lo,mag_hi)
+    assert np.all(np.diff(interp.mass_init) >= 0)
+
 def test_simulate():
     """Test isochrone simulation."""    
     
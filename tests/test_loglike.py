@@ -3,6 +3,9 @@
 Generic python script.
 """
 __author__ = "Alex Drlica-Wagner"
+import os
+import shutil
+import tempfile
 import unittest
 # Execute tests in order: https://stackoverflow.com/a/22317851/4075339
 unittest.TestLoader.sortTestMethodsUsing = None
@@ -25,7 +28,11 @@ class TestLoglike(unittest.TestCase):
     def setUp(self):
         self.loglike = ugali.analysis.loglike.createLoglike(CONFIG,lon=LON,lat=LAT)
         self.source = self.loglike.source
-        self.filename = 'test-membership.fits'
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir,'test-membership.fits')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
 
     def test_initial_config(self):
         # Likelihood configuration.
@@ -52,14 +59,49 @@ class TestLoglike(unittest.TestCase):
         np.testing.assert_allclose(self.loglike.nobs,85.9556015)
 
     def test_fit_richness(self):
-        # Fit the richness
-        interval = self.loglike.richness_interval()
-        np.testing.assert_allclose(interval,(31596.21551, 32918.707276))
-                                             
+        # Fit the richness (Halley steps on the analytic derivatives)
         lnl,rich,para = self.loglike.fit_richness()
+        np.testing.assert_allclose(self.loglike.source.richness,rich)
+
+        # Reference from the same solver run to the precision of the sums
+        lnl_ref,rich_ref,para_ref = self.loglike.fit_richness(atol=1e-6)
+        np.testing.assert_allclose(lnl,lnl_ref,rtol=1e-10)
+        np.testing.assert_allclose(rich,rich_ref,rtol=1e-7)
+
+        # ...which is the maximum found by a bounded scalar minimization
+        # (limited by the flatness of the loglike at the maximum)
+        from scipy.optimize import minimize_scalar
+        x = self.loglike.u/self.loglike.b
+        fn = lambda r: -(np.log1p(r*x).sum() - self.loglike.f*r)
+        res = minimize_scalar(fn,bounds=(0.5*rich_ref,2*rich_ref),method='bounded',
+                              options=dict(xatol=1e-6,maxiter=500))
+        np.testing.assert_allclose(rich_ref,res.x,rtol=1e-6)
+        np.testing.assert_allclose(lnl_ref,-res.fun,rtol=1e-10)
+
+        # At least as good as the iterative parabola fit
+        assert lnl_ref >= 8449.77225 - 1e-5
+
+        lo,hi = self.loglike.richness_interval()
+        assert lo < rich_ref < hi
+
+    def test_fit_richness_parabola(self):
+        # Iterative parabola fit (the original algorithm)
+        lnl,rich,para = self.loglike.fit_richness_parabola()
         np.testing.assert_allclose(lnl,8449.77225)
         np.testing.assert_allclose(rich,32252.807226)
-        np.testing.assert_allclose(self.loglike.source.richness,rich)
+
+        # Fall back to the parabola fit if the Halley fit does not converge
+        from unittest import mock
+        def fit_richness_batch(u, b, f, atol, maxiter):
+            return np.zeros(1), np.zeros(1), np.array([maxiter]), np.zeros(1,dtype=bool)
+        with mock.patch('ugali.analysis.loglike.fit_richness_batch',fit_richness_batch):
+            lnl,rich,para = self.loglike.fit_richness()
+            np.testing.assert_allclose(lnl,8449.77225)
+            np.testing.assert_allclose(rich,32252.807226)
+            assert self.loglike.richness_niter > 50
+
+            interval = self.loglike.richness_interval()
+            np.testing.assert_allclose(interval,(31596.21551, 32918.707276))
 
     def test_write_membership(self):
         # Write membership
@@ -83,5 +125,91 @@ class TestLoglike(unittest.TestCase):
         np.testing.assert_allclose(self.source.lon,hdr['LON'])
         np.testing.assert_allclose(self.source.lat,hdr['LAT'])
 
+    def test_surface_template(self):
+        # Accuracy of the surface intensity template
+        max_diff,sum_diff = self.loglike.check_surface_template()
+        self.assertLess(max_diff,0.02)
+        self.assertLess(abs(sum_diff),0.005)
+
+    def test_color_grid(self):
+        # Isochrone terms for several distance moduli at once
+        loglike,mask = self.loglike,self.loglike.mask
+        moduli = np.array([17.0,17.5,18.0])
+        frac = loglike.isochrone.observableFraction(mask,moduli)
+        np.testing.assert_equal(frac.shape,(len(moduli),len(mask.frac_interior_sparse)))
+        for f,mod in zip(frac,moduli):
+            np.testing.assert_allclose(f,loglike.isochrone.observableFraction(mask,mod))
+
+        # Values read from the grid by `sync_params` should match the
+        # per-modulus calculation (in absolute vs apparent magnitude bins)
+        loglike.color_cache = None
+        loglike.set_color_grid(moduli)
+        loglike.set_params(distance_modulus=moduli[1])
+        assert loglike.read_color_grid() is not None
+        loglike.sync_params()
+        u_color = loglike.u_color.copy()
+        obsfrac = loglike.observable_fraction.copy()
+        loglike._color_grid = None
+        loglike.set_params(distance_modulus=moduli[0])
+        loglike.sync_params()
+        loglike.set_params(distance_modulus=moduli[1])
+        loglike.sync_params()
+        np.testing.assert_allclose(u_color,loglike.u_color,rtol=1e-4,atol=1e-9)
+        np.testing.assert_allclose(obsfrac,loglike.observable_fraction)
+
+    def test_observable_fraction_table(self):
+        # Lookup table of the observable fraction (exact at grid nodes)
+        loglike,mask = self.loglike,self.loglike.mask
+        table = loglike.get_observable_fraction_table()
+        for mod in table.distance_moduli[[0,-1]]:
+            np.testing.assert_allclose(table(mask,mod),
+                                       loglike.isochrone.observableFraction(mask,mod),
+                                       atol=1e-6)
+
+def test_fit_richness_batch():
+    # Batched richness fit with the closed-form gradient
+    from scipy.optimize import minimize_scalar
+    np.random.seed(0)
+    b = np.random.uniform(100,1000,size=500)
+    u = np.random.exponential(1.0,size=(4,500))
+    u[1] *= 1e-3 # Negligible signal (mle at zero)
+    u[2] = 0     # No signal
+    f = np.array([0.1,0.1,0.1,0.2])
+    lnl,rich,niter,conv = ugali.analysis.loglike.fit_richness_batch(u,b,f,atol=1e-8)
+    assert conv.all()
+    assert (niter[[0,3]] < 10).all()
+
+    for i in [0,3]:
+        fn = lambda r: -(np.log1p(r*u[i]/b).sum() - f[i]*r)
+        res = minimize_scalar(fn,bounds=(0,1e7),method='bounded',
+                              options=dict(xatol=1e-6))
+        np.testing.assert_allclose(rich[i],res.x,rtol=1e-5)
+        np.testing.assert_allclose(lnl[i],-res.fun,rtol=1e-8)
+    np.testing.assert_equal(rich[1:3],0)
+    np.testing.assert_equal(lnl[1:3],0)
+
+def test_spatial_cache():
+    # Sparse spatial cache with LRU eviction
+    cache = ugali.analysis.loglike.SpatialCache(max_bytes=4*84)
+    u = np.zeros(100); u[[3,50]] = [0.1,0.2]
+    si = np.zeros(20); si[:5] = 1.0
+    nbytes = 2*(4+8) + 5*(4+8)
+
+    cache.put('a',u,si)
+    np.testing.assert_equal(cache.nbytes,nbytes)
+    u_out,si_out = cache.get('a')
+    np.testing.assert_array_equal(u_out,u)
+    np.testing.assert_array_equal(si_out,si)
+    np.testing.assert_equal(cache.get('b'),None)
+
+    # Fill the cache; 'a' was used most recently so 'b' is evicted
+    for key in ['b','c','d']:
+        cache.put(key,u,si)
+    cache.get('a')
+    cache.put('e',u,si)
+    assert 'a' in cache and 'b' not in cache
+    np.testing.assert_equal(len(cache),4)
+    np.testing.assert_equal(cache.nbytes,4*nbytes)
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,6 +3,7 @@
 Generic python script.
 """
 __author__ = "Alex Drlica-Wagner"
+import os
 import numpy as np
 from ugali.utils.logger import logger
 logger.setLevel(logger.WARN)
@@ -60,8 +61,24 @@ def test_catalog():
     np.testing.assert_equal(catalog,catalog2)
     np.testing.assert_equal(len(catalog),35600)
 
+    # Only the configured and selection columns are read
+    names = catalog.data.dtype.names
+    np.testing.assert_equal('WAVG_SPREAD_MODEL_I' in names, True)
+    np.testing.assert_equal(len(names) <= 7, True)
+    sel = ugali.observation.catalog.Selection(config['catalog']['selection'])
+    np.testing.assert_equal(sel.columns,['WAVG_SPREAD_MODEL_I'])
+    np.testing.assert_equal(sel(catalog.data).all(), True)
+
     cat = catalog.applyCut(IDX)
     np.testing.assert_equal(len(cat),3)
+
+    # Selections are views that share derived quantities
+    np.testing.assert_equal(cat.is_view,True)
+    catalog.spatialBin(roi)
+    cat.spatialBin(roi)
+    np.testing.assert_equal(cat.pixel,catalog.pixel[IDX])
+    np.testing.assert_equal(cat.lon,catalog.lon[IDX])
+    np.testing.assert_equal(cat.data,catalog.data[IDX])
     cat2 = cat + cat
     np.testing.assert_equal(len(cat2),6)
     cat.write('tmp.fits')
@@ -77,6 +94,31 @@ def test_catalog():
     np.testing.assert_allclose(cat.lon,cat.ra)
     np.testing.assert_allclose(cat.lat,cat.dec)
 
+def test_column_store():
+    """ Test the memory-mapped columnar catalog store """
+    import tempfile
+    import fitsio
+    import ugali.observation.catalog
+    import ugali.utils.config
+    from ugali.utils import fileio
+
+    config = ugali.utils.config.Config(CONFIG)
+    filename = config.filenames['catalog'].compressed()[0]
+    data = fitsio.read(filename)
+
+    dirname = fileio.column_store_path(os.path.join(tempfile.mkdtemp(),'catalog.fits'))
+    fileio.write_column_store(dirname,data)
+    np.testing.assert_equal(fileio.column_store_names(dirname),list(data.dtype.names))
+
+    columns = ['COADD_OBJECT_ID','RA','DEC','WAVG_SPREAD_MODEL_I']
+    selection = ugali.observation.catalog.Selection(config['catalog']['selection'])
+    store = fileio.load_column_stores([dirname,dirname],columns,selection)
+    expected = data[columns][selection(data)]
+    np.testing.assert_equal(len(store),2*len(expected))
+    for c in columns:
+        np.testing.assert_equal(store[c][:len(expected)],expected[c])
+        np.testing.assert_equal(store[c].dtype.isnative,True)
+
 def test_mask():
     """ Test ugali.observation.mask """
     import ugali.observation.roi
@@ -91,6 +133,16 @@ def test_mask():
     np.testing.assert_allclose(mask.mask_roi_unique,[[0,0],[24,23.98]])
     np.testing.assert_equal(np.unique(mask.mask_roi_digi),[0,1])
 
+    # The decomposition is cached until the mask arrays are replaced
+    dec = mask.decomposition
+    np.testing.assert_equal(mask.decomposition is dec, True)
+    np.testing.assert_equal(dec.maglim[dec.digi],
+                            np.vstack([mask.mask_1.mask_roi_sparse,
+                                       mask.mask_2.mask_roi_sparse]).T)
+    np.testing.assert_equal(dec.tuples[dec.index_interior,2],mask.frac_interior_sparse)
+    mask.mask_1.mask_roi_sparse = mask.mask_1.mask_roi_sparse.copy()
+    np.testing.assert_equal(mask.decomposition is dec, False)
+
     # Test the solid angle
     np.testing.assert_allclose(np.unique(mask.solid_angle_cmd),
                                [0., 0.15429397])
@@ -114,6 +166,36 @@ def test_mask():
     np.testing.assert_allclose(mask.photo_err_2(np.array([0,1,3])),
                                [0.09270298, 0.03845626, 0.006904741])
 
+def test_catalog_spatial_index():
+    """ Test the catalog spatial index and sparse kernel evaluation """
+    import ugali.observation.catalog
+    import ugali.analysis.kernel
+    from ugali.utils.projector import angsep
+
+    np.random.seed(1)
+    n = 5000
+    dtype = [('COADD_OBJECT_ID','>i8'),('RA','>f8'),('DEC','>f8')]
+    data = np.zeros(n,dtype=dtype)
+    data['COADD_OBJECT_ID'] = np.arange(n)
+    data['RA'] = LON + np.random.uniform(-1.5,1.5,n)
+    data['DEC'] = LAT + np.random.uniform(-1,1,n)
+    catalog = ugali.observation.catalog.Catalog(CONFIG,data=data)
+
+    idx = catalog.query_disc(LON,LAT,0.5)
+    sep = angsep(LON,LAT,catalog.lon,catalog.lat)
+    np.testing.assert_equal(idx,np.where(sep <= 0.5)[0])
+
+    kernels = [dict(name='RadialPlummer',truncate=0.5),
+               dict(name='EllipticalExponential',ellipticity=0.3,position_angle=30),
+               dict(name='RadialDisk')]
+    for kwargs in kernels:
+        kernel = ugali.analysis.kernel.factory(lon=LON,lat=LAT,extension=0.05,**kwargs)
+        idx,pdf = kernel.pdf_sparse(catalog)
+        dense = np.zeros(n)
+        dense[idx] = pdf
+        assert len(idx) < n
+        np.testing.assert_array_equal(dense,kernel.pdf(catalog.lon,catalog.lat))
+
 if __name__ == "__main__":
     import argparse
     description = __doc__
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Test the likelihood grid search.
+"""
+import numpy as np
+
+import ugali.analysis.scan
+from ugali.utils.logger import logger
+logger.setLevel(logger.WARN)
+
+CONFIG='tests/config.yaml'
+LON = RA = 53.92
+LAT = DEC = -54.05
+
+def test_search_parallel():
+    """ Test that the worker pool reproduces the serial search """
+    grid = ugali.analysis.scan.createGridSearch(CONFIG,LON,LAT)
+    # Small target region (256 pixels) at a single distance modulus
+    assert len(grid.roi.pixels_target) <= 256
+    assert len(grid.distance_modulus_array) == 1
+
+    grid.ncores = 1
+    grid.search()
+    serial = [arr.copy() for arr in grid._result_arrays]
+
+    grid.ncores = 2
+    grid.search()
+    assert not grid._workers
+    for arr,expected in zip(grid._result_arrays,serial):
+        np.testing.assert_array_equal(arr,expected)
+    assert (serial[0] > 0).any()
+
+class _Source(object):
+    def reset_sync(self, name): pass
+
+class _Loglike(object):
+    """ Minimal likelihood for exercising the worker pool """
+    source = _Source()
+    def set_params(self, **kwargs): pass
+    def sync_params(self):
+        self.observable_fraction = np.ones(4)
+        self.u_color = np.ones(8)
+
+def _fake_grid(npixels):
+    grid = ugali.analysis.scan.GridSearch.__new__(ugali.analysis.scan.GridSearch)
+    grid.loglike = _Loglike()
+    grid.source = grid.loglike.source
+    grid.distance_modulus_array = np.array([17.,18.])
+    grid.batch_fit = False
+    grid.ncores = 2
+    grid._workers = []
+    for name in ['loglike','richness','stellar_mass','fraction_observable','extension_fit']:
+        setattr(grid,name+'_array',np.zeros([2,npixels],dtype='f4'))
+    grid.niter_array = np.zeros([2,npixels],dtype='i2')
+
+    def search_pixels(ii, pixels, extension_idx=None):
+        if grid.fail in pixels: raise ValueError("pixel %i"%grid.fail)
+        grid.loglike_array[ii][pixels] = pixels + ii
+        grid.niter_array[ii][pixels] = 1
+    grid._search_pixels = search_pixels
+    grid.fail = None
+    return grid
+
+def test_search_parallel_workers():
+    """ Test result assembly and shutdown of the worker pool """
+    pixels = np.arange(10)
+    grid = _fake_grid(len(pixels))
+    for ii in range(2):
+        grid._search_parallel(ii, pixels)
+    procs = [p for p,c,s in grid._workers]
+    np.testing.assert_array_equal(grid.loglike_array,[pixels,pixels+1])
+    np.testing.assert_array_equal(grid.niter_array,1)
+    grid._stop_workers()
+    assert not grid._workers
+    assert not any(p.is_alive() for p in procs)
+
+    # A failing worker shuts down the whole pool
+    grid = _fake_grid(len(pixels))
+    grid.fail = 3
+    grid._start_workers(pixels)
+    procs = [p for p,c,s in grid._workers]
+    try:
+        grid._search_parallel(0, pixels)
+    except Exception as e:
+        assert 'pixel 3' in str(e)
+    else:
+        raise AssertionError("Worker failure not raised")
+    assert not grid._workers
+    assert not any(p.is_alive() for p in procs)
+
+    # ...and the next search starts a fresh pool
+    grid.fail = None
+    grid._search_parallel(1, pixels)
+    np.testing.assert_array_equal(grid.loglike_array[1],pixels+1)
+    grid._stop_workers()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Test candidate search.
+"""
+import numpy as np
+import healpy as hp
+
+from ugali.analysis.search import CandidateSearch
+from ugali.utils.logger import logger
+logger.setLevel(logger.WARN)
+
+NSIDE = 64
+PIX = 20000
+FAR = PIX + 10*4*NSIDE
+
+def test_label_healpix():
+    """ Test labeling on the healpix neighbor graph """
+    # A pixel two steps away from PIX (not a neighbor)
+    neighbors = hp.get_all_neighbours(NSIDE,PIX)
+    ring2 = np.setdiff1d(hp.get_all_neighbours(NSIDE,neighbors).ravel(),
+                         np.append(neighbors,PIX))
+    gap = ring2[0]
+
+    pixels = np.unique(np.hstack([PIX,neighbors,ring2,FAR]))
+    values = np.zeros(len(pixels))
+    values[np.in1d(pixels,[PIX,gap,FAR])] = 10
+
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5,dilate=0)
+    np.testing.assert_equal(nlabels,3)
+    np.testing.assert_equal(labels[values < 5],0)
+    np.testing.assert_equal(np.sort(labels[values > 5]),[1,2,3])
+
+    # Gaps of one pixel are bridged by dilation
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5,dilate=1)
+    np.testing.assert_equal(nlabels,2)
+    np.testing.assert_equal(labels[pixels==PIX],labels[pixels==gap])
+
+    # Adjacent distance slices are linked
+    values = np.zeros((len(pixels),3))
+    values[pixels == PIX,0] = 10
+    values[pixels == neighbors[0],1] = 10
+    values[pixels == FAR,2] = 10
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5,dilate=0)
+    np.testing.assert_equal(labels.shape,values.shape)
+    np.testing.assert_equal(nlabels,2)
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5,
+                                                  dilate=0,link=False)
+    np.testing.assert_equal(nlabels,3)
+
+def test_find_objects():
+    """ Test the grouped characterization of labelled objects """
+    from ugali.utils.healpix import pix2ang
+    from ugali.utils.projector import angsep
+
+    neighbors = hp.get_all_neighbours(NSIDE,PIX)
+    pixels = np.hstack([neighbors,PIX,FAR])
+    zvalues = np.array([16.,17.,18.])
+    values = np.zeros((len(pixels),len(zvalues)))
+    values[:-1,1] = 10
+    values[pixels == PIX,1] = 20
+    values[pixels == FAR,2] = 30
+
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5)
+    objs = CandidateSearch.findObjects(pixels,values,NSIDE,zvalues,labels)
+    np.testing.assert_equal(len(objs),nlabels)
+    objs = objs[np.argsort(objs['VAL_MAX'])]
+    np.testing.assert_equal(objs['NPIX'],[9,1])
+    np.testing.assert_equal(objs['PIX_MAX'],[PIX,FAR])
+    np.testing.assert_equal(objs['Z_MAX'],[17.,18.])
+    np.testing.assert_equal(objs['Z_BARY'],[17.,18.])
+
+    # Centroid of the symmetric island is close to the central pixel
+    lon,lat = pix2ang(NSIDE,PIX)
+    sep = angsep(lon,lat,objs['X_CENT'][0],objs['Y_CENT'][0])
+    assert sep < 0.25*hp.nside2resol(NSIDE,arcmin=True)/60.
+    np.testing.assert_allclose([objs['X_MAX'][0],objs['Y_MAX'][0]],[lon,lat],rtol=1e-5)
+
+    # Spatial labels apply to all distances
+    labels2d = labels.max(axis=1)
+    objs2d = CandidateSearch.findObjects(pixels,values,NSIDE,zvalues,labels2d)
+    np.testing.assert_equal(np.sort(objs2d['NPIX']),[3,27])
+    np.testing.assert_equal(np.sort(objs2d['VAL_MAX']),[20,30])
+
+def test_labels_roundtrip():
+    """ Labels are aligned with unsorted likelihood pixels on load """
+    import os, tempfile
+
+    search = CandidateSearch.__new__(CandidateSearch)
+    search.nside = NSIDE
+    search.pixels = np.array([FAR,PIX,5,PIX+1])
+    search.distances = np.array([17.,18.])
+    search.labels = np.array([[1,1],[2,0],[0,0],[2,2]])
+    search.labelfile = os.path.join(tempfile.mkdtemp(),'labels.fits')
+    labels = search.labels.copy()
+
+    search.writeLabels()
+    search.labels = None
+    search.loadLabels()
+    np.testing.assert_equal(search.labels,labels)
+    np.testing.assert_equal(search.nlabels,2)
+    os.remove(search.labelfile)
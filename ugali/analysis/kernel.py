@@ -33,6 +33,8 @@ class Kernel(Model):
     ])
     _mapping = odict([])
     _proj = 'ait'
+    # Maximum edge (deg) for sparse evaluation
+    _max_sparse_edge = 30.
     
     def __init__(self, proj='ait', **kwargs):
         # This __init__ is probably not necessary...
@@ -68,6 +70,29 @@ class Kernel(Model):
         """Normalized, truncated pdf"""
         pass
 
+    def pdf_sparse(self, catalog):
+        """
+        Evaluate the pdf only for catalog objects within the kernel
+        edge using the catalog spatial index. Kernels without a
+        finite edge are evaluated for all objects.
+
+        Parameters
+        ----------
+        catalog : Catalog object
+
+        Returns
+        -------
+        idx, pdf : indices of the selected objects and their pdf values
+        """
+        edge = getattr(self,'edge',None)
+        if edge is None or not (edge < self._max_sparse_edge):
+            return np.arange(len(catalog)), self.pdf(catalog.lon,catalog.lat)
+
+        # The projected radius is slightly smaller than the angular
+        # separation (<2% within 30 deg), so pad the search radius.
+        idx = catalog.query_disc(self.lon,self.lat,1.05*edge)
+        return idx, self.pdf(catalog.lon[idx],catalog.lat[idx])
+
     @property
     def norm(self):
         """Normalization from the integated pdf"""
@@ -186,6 +211,10 @@ class EllipticalKernel(Kernel):
         
     def radius(self,lon,lat):
         x,y = self.projector.sphereToImage(lon,lat)
+        return self.radius_image(x,y)
+
+    def radius_image(self,x,y):
+        """Elliptical radius from projected image coordinates (deg)."""
         costh = np.cos(np.radians(self.theta))
         sinth = np.sin(np.radians(self.theta))
         return np.sqrt(((x*costh-y*sinth)/(1-self.e))**2 + (x*sinth+y*costh)**2)
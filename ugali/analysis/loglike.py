@@ -9,6 +9,7 @@ import time
 import numpy
 import numpy as np
 from scipy.stats import norm
+import scipy.ndimage as ndimage
 
 import healpy as hp
 import fitsio
@@ -19,6 +20,7 @@ import ugali.utils.parabola
 from ugali.utils.projector import angsep, gal2cel
 from ugali.utils.healpix import ang2pix,pix2ang,ang2disc
 from ugali.utils.logger import logger
+from ugali.utils.cache import DiskCache, hash_args, freeze
 
 from ugali.utils.config import Config
 from ugali.analysis.source import Source
@@ -33,6 +35,220 @@ class Observation(object):
     def __init__(self,**kwargs):
         self.__dict__.update(**kwargs)
 
+class SpatialCache(object):
+    """
+    Memory-bounded cache of the spatial signal terms (`u_spatial` and
+    `surface_intensity_sparse`) keyed by the kernel parameters. The
+    kernel terms do not depend on the isochrone, so a scan can reuse
+    them for every distance modulus. Each entry is stored as a
+    compact sparse row (indices, values) over the catalog objects and
+    interior pixels. The least recently used entries are evicted when
+    the total size exceeds `max_bytes`.
+
+    Note that a cyclic scan over more entries than fit in the cache
+    evicts every entry before it is reused, so the budget should be
+    sized to hold all (target pixel, extension) pairs.
+    """
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = odict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    @staticmethod
+    def sparsify(array):
+        """ Compress a dense array into (size, indices, values). """
+        idx = np.flatnonzero(array).astype(np.int32)
+        return (len(array), idx, array[idx])
+
+    @staticmethod
+    def densify(row):
+        """ Expand a sparse (size, indices, values) row. """
+        size, idx, values = row
+        array = np.zeros(size,dtype=values.dtype)
+        array[idx] = values
+        return array
+
+    def get(self, key):
+        """
+        Get the cached spatial terms.
+
+        Parameters:
+        -----------
+        key : hashable kernel key
+
+        Returns:
+        --------
+        u_spatial, surface_intensity : dense arrays (or None if not cached)
+        """
+        try:
+            rows = self._cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Move to the most recently used position
+        self._cache[key] = rows
+        self.hits += 1
+        return tuple(self.densify(r) for r in rows)
+
+    def put(self, key, u_spatial, surface_intensity):
+        """
+        Add the spatial terms to the cache evicting old entries if
+        necessary.
+
+        Parameters:
+        -----------
+        key               : hashable kernel key
+        u_spatial         : spatial signal probability for each object
+        surface_intensity : surface intensity for each interior pixel
+
+        Returns:
+        --------
+        None
+        """
+        if key in self._cache: return
+        rows = (self.sparsify(u_spatial), self.sparsify(surface_intensity))
+        nbytes = sum(r[1].nbytes + r[2].nbytes for r in rows)
+        if nbytes > self.max_bytes: return
+
+        while self._cache and (self.nbytes + nbytes > self.max_bytes):
+            old = self._cache.popitem(last=False)[1]
+            self.nbytes -= sum(r[1].nbytes + r[2].nbytes for r in old)
+            logger.debug("Evicting spatial cache entry")
+
+        self._cache[key] = rows
+        self.nbytes += nbytes
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+class SurfaceTemplate(object):
+    """
+    Translation-invariant template of the pixel-integrated kernel
+    surface intensity. The kernel is defined in the tangent plane of a
+    projection centered on the kernel, so its shape does not depend on
+    the kernel location. The kernel is sampled on a tangent-plane grid
+    at the resolution of the finest subsampling level in
+    `LogLikelihood.calc_surface_intensity` and averaged over a
+    (diamond-shaped) pixel footprint. The template is then mapped onto
+    the ROI pixels by linear interpolation of their projected offsets.
+    """
+    def __init__(self, kernel, nside, factor=10, nsub=16):
+        self.nside = nside
+        pixsize = np.sqrt(hp.nside2pixarea(nside,degrees=True))
+
+        # Subsampled region (matches the first subsampling level)
+        self.radius = factor*np.degrees(hp.max_pixrad(2*nside)) \
+                      + np.degrees(hp.max_pixrad(nside))
+
+        # Symmetric grid including the origin
+        self.delta = pixsize/nsub
+        nhalf = int(np.ceil((self.radius + pixsize)/self.delta))
+        self.origin = -nhalf*self.delta
+        grid = self.origin + np.arange(2*nhalf+1)*self.delta
+        xx,yy = np.meshgrid(grid,grid,indexing='ij')
+        pdf = kernel.norm*kernel._pdf(kernel.radius_image(xx,yy))
+
+        # HEALPix pixels are approximately squares rotated by 45 deg
+        nfoot = int(np.ceil(pixsize/np.sqrt(2)/self.delta))
+        fx,fy = np.meshgrid(*2*[np.arange(-nfoot,nfoot+1)*self.delta],indexing='ij')
+        footprint = (np.abs(fx)+np.abs(fy) <= pixsize/np.sqrt(2)).astype(float)
+        footprint /= footprint.sum()
+        self.template = ndimage.convolve(pdf,footprint,mode='constant')
+
+    def __call__(self, kernel, lon, lat):
+        """
+        Evaluate the surface intensity at a set of pixel centers.
+
+        Parameters:
+        -----------
+        kernel : kernel (sets the location of the template)
+        lon    : longitude of the pixel centers (deg)
+        lat    : latitude of the pixel centers (deg)
+
+        Returns:
+        --------
+        surface_intensity : the surface intensity at each pixel
+        """
+        x,y = kernel.projector.sphereToImage(lon,lat)
+        surface_intensity = kernel.norm*kernel._pdf(kernel.radius_image(x,y))
+
+        sel = (x**2 + y**2) <= self.radius**2
+        coords = [(x[sel]-self.origin)/self.delta,(y[sel]-self.origin)/self.delta]
+        surface_intensity[sel] = ndimage.map_coordinates(self.template,coords,order=1)
+        return surface_intensity
+
+class ObservableFractionTable(object):
+    """
+    Lookup table of the observable fraction as a function of the
+    limiting magnitudes in the two bands and the distance modulus for
+    a fixed isochrone (see `IsochroneModel.observableFractionTable`).
+    The observable fraction of all interior pixels is evaluated with a
+    single (trilinear) interpolation.
+    """
+    def __init__(self, table, maglim_1, maglim_2, distance_moduli):
+        self.table = np.asarray(table)
+        self.maglim_1 = np.asarray(maglim_1,dtype=float)
+        self.maglim_2 = np.asarray(maglim_2,dtype=float)
+        self.distance_moduli = np.asarray(distance_moduli,dtype=float)
+
+    @classmethod
+    def create(cls, isochrone, mask, distance_moduli, delta_mag=0.01):
+        """
+        Tabulate the observable fraction for an isochrone.
+
+        Parameters:
+        -----------
+        isochrone       : the isochrone model
+        mask            : the mask
+        distance_moduli : distance modulus grid
+        delta_mag       : spacing of the limiting magnitude grid
+
+        Returns:
+        --------
+        table : ObservableFractionTable
+        """
+        table,maglim_1,maglim_2 = isochrone.observableFractionTable(
+            mask,distance_moduli,delta_mag)
+        return cls(table,maglim_1,maglim_2,distance_moduli)
+
+    def contains(self, distance_modulus):
+        mods = self.distance_moduli
+        return mods.min() <= distance_modulus <= mods.max()
+
+    def __call__(self, mask, distance_modulus):
+        """
+        Evaluate the observable fraction in the interior pixels.
+
+        Parameters:
+        -----------
+        mask             : the mask
+        distance_modulus : distance modulus
+
+        Returns:
+        --------
+        observable_fraction : observable fraction in each interior pixel
+        """
+        decomposition = mask.decomposition
+        mag_1,mag_2 = decomposition.maglim.T
+
+        # Fractional grid coordinates of each unique magnitude pair
+        coords = [np.interp(distance_modulus,self.distance_moduli,
+                            np.arange(len(self.distance_moduli)))*np.ones(len(mag_1)),
+                  np.interp(mag_1,self.maglim_1,np.arange(len(self.maglim_1))),
+                  np.interp(mag_2,self.maglim_2,np.arange(len(self.maglim_2)))]
+        observable_fraction = ndimage.map_coordinates(self.table,coords,order=1,
+                                                      mode='nearest')
+        return decomposition.interior(observable_fraction)
+
 class LogLikelihood(object):
     """
     Class for calculating the log-likelihood from a set of models.
@@ -66,6 +282,30 @@ class LogLikelihood(object):
         elif self.color_only:
             logger.warning("Likelihood calculated from color information only!!!")
 
+        # Translation-invariant surface intensity templates
+        self.surface_template = self.config['likelihood'].get('surface_template',False)
+        self._surface_templates = odict()
+
+        # Lookup tables of the observable fraction
+        self.observable_fraction_table = self.config['likelihood'].get('observable_fraction_table',False)
+        self._observable_fraction_tables = odict()
+
+        # Isochrone terms for an array of distance moduli (see `set_color_grid`)
+        self._color_grid = None
+
+        # Number of iterations in the last richness fit
+        self.richness_niter = 0
+
+        # Optional cache of spatial terms (see `SpatialCache`)
+        self.spatial_cache = None
+
+        # Optional persistent cache of isochrone terms
+        self.color_cache = None
+        if self.config['likelihood'].get('color_cache'):
+            size = self.config['likelihood'].get('color_cache_size',10240)
+            self.color_cache = DiskCache(self.config['likelihood']['color_cache'],
+                                         max_bytes=int(size*1024**2))
+
         self.calc_background()
 
     def __call__(self):
@@ -151,8 +391,14 @@ class LogLikelihood(object):
             # No sync necessary for richness
             pass
         if self.source.get_sync('isochrone'):
-            self.observable_fraction = self.calc_observable_fraction(self.source.distance_modulus)
-            self.u_color = self.calc_signal_color(self.source.distance_modulus)
+            cached = self.read_color_grid()
+            if cached is None: cached = self.read_color_cache()
+            if cached is not None:
+                self.observable_fraction, self.u_color = cached
+            else:
+                self.observable_fraction = self.calc_observable_fraction(self.source.distance_modulus)
+                self.u_color = self.calc_signal_color(self.source.distance_modulus)
+                self.write_color_cache()
         if self.source.get_sync('kernel'):
             self.u_spatial = self.calc_signal_spatial()
 
@@ -199,8 +445,8 @@ class LogLikelihood(object):
 
         # All objects interior to the background annulus
         logger.debug("Creating interior catalog...")
-        cut_interior = np.in1d(ang2pix(self.config['coords']['nside_pixel'], self.catalog_roi.lon, self.catalog_roi.lat), 
-                                  self.roi.pixels_interior)
+        # (reuse the pixels from binning the roi catalog)
+        cut_interior = np.in1d(self.catalog_roi.pixel, self.roi.pixels_interior)
         #cut_interior = self.roi.inInterior(self.catalog_roi.lon,self.catalog_roi.lat)
         self.catalog_interior = self.catalog_roi.applyCut(cut_interior)
         self.catalog_interior.project(self.roi.projector)
@@ -268,21 +514,172 @@ class LogLikelihood(object):
         """
         # This is the observable fraction after magnitude cuts in each 
         # pixel of the ROI.
-        observable_fraction = self.isochrone.observableFraction(self.mask,distance_modulus)
-        if not observable_fraction.sum() > 0:
+        table = None
+        if self.observable_fraction_table:
+            table = self.get_observable_fraction_table()
+        if table is not None and np.all([table.contains(m) for m in np.atleast_1d(distance_modulus)]):
+            if np.ndim(distance_modulus) == 0:
+                observable_fraction = table(self.mask,distance_modulus)
+            else:
+                observable_fraction = np.array([table(self.mask,m) for m in distance_modulus])
+        else:
+            observable_fraction = self.isochrone.observableFraction(self.mask,distance_modulus)
+        if not np.all(observable_fraction.sum(axis=-1) > 0):
             msg = "No observable fraction"
             msg += ("\n"+str(self.source.params))
             logger.error(msg)
             raise ValueError(msg)
         return observable_fraction
 
+    def get_observable_fraction_table(self, maxsize=4):
+        """
+        Get (or create) the observable fraction lookup table for the
+        current isochrone. Tables are kept in memory and, if
+        'color_cache' is set, on disk.
+
+        The grid is set by 'observable_fraction_delta' in the
+        likelihood configuration (limiting magnitude and distance
+        modulus spacing). The distance modulus grid spans the scan
+        'distance_modulus_array' (or the distance modulus bounds).
+
+        Parameters:
+        -----------
+        maxsize : maximum number of tables to keep in memory
+
+        Returns:
+        --------
+        table : ObservableFractionTable
+        """
+        delta_mag,delta_mod = self.config['likelihood'].get('observable_fraction_delta',[0.01,0.1])
+        mods = self.config['scan'].get('distance_modulus_array')
+        if mods is None:
+            mods = self.source.isochrone.params['distance_modulus'].bounds
+        mod_min = np.floor(np.min(mods)/delta_mod)*delta_mod
+        mod_max = np.ceil(np.max(mods)/delta_mod)*delta_mod
+        distance_moduli = np.arange(mod_min,mod_max+0.5*delta_mod,delta_mod)
+
+        iso = self.isochrone.todict()
+        iso.pop('distance_modulus',None)
+        mask = self.mask
+        key = hash_args(mask.mask_1.mask_roi_sparse,mask.mask_2.mask_roi_sparse,
+                        mask.solid_angle_cmd,freeze(iso),delta_mag,distance_moduli)
+        if key in self._observable_fraction_tables:
+            return self._observable_fraction_tables[key]
+
+        names = ['table','maglim_1','maglim_2','distance_moduli']
+        cached = None
+        if self.color_cache is not None:
+            cached = self.color_cache.get('obsfrac_'+key,names)
+        if cached is not None:
+            table = ObservableFractionTable(*cached)
+        else:
+            logger.debug("Creating observable fraction table...")
+            table = ObservableFractionTable.create(self.isochrone,mask,distance_moduli,delta_mag)
+            if self.color_cache is not None:
+                self.color_cache.put('obsfrac_'+key,**dict((n,getattr(table,n)) for n in names))
+
+        if len(self._observable_fraction_tables) >= maxsize:
+            self._observable_fraction_tables.popitem(last=False)
+        self._observable_fraction_tables[key] = table
+        return table
+
+    def color_cache_key(self):
+        """
+        Hash of the catalog objects, mask, isochrone parameters,
+        `delta_mag` and distance modulus that determine the isochrone
+        terms of the likelihood.
+        """
+        if not hasattr(self,'_color_cache_data'):
+            # The catalog and mask are fixed after initialization
+            cat,mask = self.catalog,self.mask
+            self._color_cache_data = hash_args(
+                cat.mag_1,cat.mag_2,cat.mag_err_1,cat.mag_err_2,
+                mask.mask_1.mask_roi_sparse,mask.mask_2.mask_roi_sparse,
+                mask.frac_interior_sparse,mask.solid_angle_cmd,
+                self.roi.pixels_interior)
+
+        iso = self.isochrone.todict()
+        iso.pop('distance_modulus',None)
+        iso['weights'] = getattr(self.isochrone,'weights',None)
+        return hash_args(self._color_cache_data, freeze(iso), self.delta_mag,
+                         float(self.source.distance_modulus))
+
+    def set_color_grid(self, distance_moduli):
+        """
+        Calculate `observable_fraction` and `u_color` for an array of
+        distance moduli at once. The result is used by `sync_params`
+        for any of these moduli until the other isochrone parameters
+        change.
+
+        Parameters:
+        -----------
+        distance_moduli : array of distance moduli
+
+        Returns:
+        --------
+        None
+        """
+        distance_moduli = np.atleast_1d(distance_moduli).astype(float)
+        self._color_grid = dict(
+            key = self.color_grid_key(),
+            distance_moduli = distance_moduli,
+            observable_fraction = self.calc_observable_fraction(distance_moduli),
+            u_color = self.calc_signal_color(distance_moduli))
+
+    def color_grid_key(self):
+        """ Isochrone parameters (except distance modulus) of the color grid. """
+        iso = self.isochrone.todict()
+        iso.pop('distance_modulus',None)
+        return freeze(iso)
+
+    def read_color_grid(self):
+        """
+        Read `observable_fraction` and `u_color` at the current
+        distance modulus from the color grid (see `set_color_grid`).
+
+        Returns:
+        --------
+        observable_fraction, u_color : arrays (or None)
+        """
+        grid = self._color_grid
+        if grid is None: return None
+        idx = np.nonzero(grid['distance_moduli'] == float(self.source.distance_modulus))[0]
+        if not len(idx) or grid['key'] != self.color_grid_key(): return None
+        return grid['observable_fraction'][idx[0]], grid['u_color'][idx[0]]
+
+    def read_color_cache(self):
+        """
+        Read `observable_fraction` and `u_color` from the color cache.
+
+        Returns:
+        --------
+        observable_fraction, u_color : cached arrays (or None)
+        """
+        if self.color_cache is None: return None
+        return self.color_cache.get(self.color_cache_key(),
+                                    ['observable_fraction','u_color'])
+
+    def write_color_cache(self):
+        """
+        Write `observable_fraction` and `u_color` to the color cache.
+        """
+        if self.color_cache is None: return
+        self.color_cache.put(self.color_cache_key(),
+                             observable_fraction=self.observable_fraction,
+                             u_color=self.u_color)
+
     def calc_signal_color1(self, distance_modulus, mass_steps=10000):
         """
         Compute signal color probability (u_color) for each catalog object on the fly.
         """
         mag_1, mag_2 = self.catalog.mag_1,self.catalog.mag_2
         mag_err_1, mag_err_2 = self.catalog.mag_err_1,self.catalog.mag_err_2
-        u_density = self.isochrone.pdf(mag_1,mag_2,mag_err_1,mag_err_2,distance_modulus,self.delta_mag,mass_steps)
+        # Memory budget (MB) for the isochrone pdf calculation
+        max_bytes = self.config['likelihood'].get('pdf_max_bytes',256)*1024**2
+        mode = self.config['likelihood'].get('pdf_mode','chunked')
+        u_density = self.isochrone.pdf(mag_1,mag_2,mag_err_1,mag_err_2,distance_modulus,
+                                       self.delta_mag,mass_steps,max_bytes=max_bytes,
+                                       mode=mode)
 
         #u_color = u_density * self.delta_mag**2
         u_color = u_density
@@ -314,6 +711,30 @@ class LogLikelihood(object):
         region of the ROI. Pixels are adaptively subsampled around the
         kernel centroid out to a radius of 'factor * max_pixrad'.
 
+        If 'surface_template' is set in the likelihood configuration,
+        the subsampled surface intensity is interpolated from a
+        precomputed `SurfaceTemplate` instead.
+
+        Parameters:
+        -----------
+        factor : the radius of the oversample region in units of max_pixrad
+
+        Returns:
+        --------
+        surface_intensity : the surface intensity at each pixel
+        """
+        if self.surface_template:
+            template = self.get_surface_template(factor)
+            if template is not None:
+                pixels = self.roi.pixels_interior
+                return template(self.kernel,pixels.lon,pixels.lat)
+
+        return self.calc_surface_intensity_exact(factor)
+
+    def calc_surface_intensity_exact(self, factor=10):
+        """Calculate the surface intensity for each pixel in the interior
+        region of the ROI by adaptive HEALPix subsampling.
+
         Parameters:
         -----------
         factor : the radius of the oversample region in units of max_pixrad
@@ -347,6 +768,56 @@ class LogLikelihood(object):
 
         return surface_intensity
 
+    def get_surface_template(self, factor=10, maxsize=16):
+        """
+        Get (or create) the surface intensity template for the current
+        kernel shape. Returns None for kernels that do not support
+        templates.
+
+        Parameters:
+        -----------
+        factor  : the radius of the oversample region in units of max_pixrad
+        maxsize : maximum number of templates to keep
+
+        Returns:
+        --------
+        template : SurfaceTemplate (or None)
+        """
+        kernel = self.kernel
+        if not hasattr(kernel,'radius_image') or kernel.projector is None:
+            return None
+
+        nside = self.config['coords']['nside_pixel']
+        shape = tuple(float(v.value) for k,v in kernel.params.items()
+                      if k not in ('lon','lat'))
+        key = (kernel.name,nside,factor) + shape
+        if key not in self._surface_templates:
+            if len(self._surface_templates) >= maxsize:
+                self._surface_templates.popitem(last=False)
+            self._surface_templates[key] = SurfaceTemplate(kernel,nside,factor)
+        return self._surface_templates[key]
+
+    def check_surface_template(self, factor=10):
+        """
+        Accuracy check of the surface intensity template against the
+        exact adaptive subsampling at the current kernel location.
+
+        Parameters:
+        -----------
+        factor : the radius of the oversample region in units of max_pixrad
+
+        Returns:
+        --------
+        max_diff, sum_diff : maximum pixel difference relative to the
+            peak surface intensity and fractional difference of the sum
+        """
+        pixels = self.roi.pixels_interior
+        exact = self.calc_surface_intensity_exact(factor)
+        approx = self.get_surface_template(factor)(self.kernel,pixels.lon,pixels.lat)
+        max_diff = np.max(np.abs(approx - exact))/np.max(exact)
+        sum_diff = (approx.sum() - exact.sum())/exact.sum()
+        return max_diff, sum_diff
+
     def calc_signal_spatial(self):
         """
         Calculate the spatial signal probability for each catalog object.
@@ -359,17 +830,37 @@ class LogLikelihood(object):
         --------
         u_spatial : array of spatial probabilities per object
         """
+        if self.spatial_cache is not None:
+            key = self.spatial_key()
+            cached = self.spatial_cache.get(key)
+            if cached is not None:
+                self.surface_intensity_object,self.surface_intensity_sparse = cached
+                return self.surface_intensity_object
+
         # Calculate the surface intensity
         self.surface_intensity_sparse = self.calc_surface_intensity()
 
         # Calculate the probability per object-by-object level
-        self.surface_intensity_object = self.kernel.pdf(self.catalog.lon,
-                                                        self.catalog.lat)
+        # (only evaluated for objects within the kernel edge)
+        idx,pdf = self.kernel.pdf_sparse(self.catalog)
+        self.surface_intensity_object = np.zeros(len(self.catalog))
+        self.surface_intensity_object[idx] = pdf
         
         # Spatial component of signal probability
         u_spatial = self.surface_intensity_object
+
+        if self.spatial_cache is not None:
+            self.spatial_cache.put(key,u_spatial,self.surface_intensity_sparse)
+
         return u_spatial
 
+    def spatial_key(self):
+        """
+        Hashable key identifying the current spatial kernel.
+        """
+        values = tuple(float(p.value) for p in self.kernel.params.values())
+        return (self.kernel.name,) + values
+
     ############################################################################
     # Methods for fitting and working with the likelihood
     ############################################################################
@@ -381,6 +872,11 @@ class LogLikelihood(object):
         """
         Maximize the log-likelihood as a function of richness.
 
+        The maximum is found with Halley/Newton steps on the analytic
+        derivatives (see `fit_richness_batch`). The iterative parabola
+        fit is only used if that fails to converge. The number of
+        iterations is stored in `self.richness_niter`.
+
         ADW 2018-06-04: Does it make sense to set the richness to the mle?
 
         Parameters:
@@ -392,6 +888,8 @@ class LogLikelihood(object):
         --------
         loglike, richness, parabola : the maximum loglike, the mle, and the parabola
         """
+        self.richness_niter = 0
+
         # Check whether the signal probability for all objects are zero
         # This can occur for finite kernels on the edge of the survey footprint
         if np.isnan(self.u).any():
@@ -406,6 +904,44 @@ class LogLikelihood(object):
             logger.warning("Observable fraction is zero")
             return 0., 0., None
 
+        loglike,richness,niter,converged = fit_richness_batch(self.u,self.b,self.f,
+                                                              atol,maxiter)
+        if not converged[0]:
+            logger.warning("Richness fit did not converge; using parabola")
+            ret = self.fit_richness_parabola(atol,maxiter)
+            self.richness_niter += niter[0]
+            return ret
+        self.richness_niter = niter[0]
+
+        loglike,richness = loglike[0],richness[0]
+
+        # Parabola from the local curvature for interval estimates
+        x = self.u/self.b
+        w = x/(1. + richness*x)
+        sigma = 1./np.sqrt((w**2).sum())
+        r = richness + sigma*np.array([-1.,0.,1.])
+        if r[0] < 0: r -= r[0]
+        lnl = np.log1p(r[:,np.newaxis]*x).sum(axis=1) - self.f*r
+        parabola = ugali.utils.parabola.Parabola(r, 2.*lnl)
+
+        # Set the richness to the mle
+        self.value(richness=richness)
+        return loglike, richness, parabola
+
+    def fit_richness_parabola(self, atol=1.e-3, maxiter=50):
+        """
+        Maximize the log-likelihood as a function of richness by
+        iteratively fitting a parabola.
+
+        Parameters:
+        -----------
+        atol : absolute tolerence for conversion
+        maxiter : maximum number of iterations
+
+        Returns:
+        --------
+        loglike, richness, parabola : the maximum loglike, the mle, and the parabola
+        """
         # Richness corresponding to 0, 1, and 10 observable stars
         richness = np.array([0., 1./self.f, 10./self.f])
         loglike = np.array([self.value(richness=r) for r in richness])
@@ -426,6 +962,7 @@ class LogLikelihood(object):
             if iteration > maxiter:
                 logger.warning("Maximum number of iterations reached")
                 break
+        self.richness_niter = iteration
             
         index = np.argmax(loglike)
         return loglike[index], richness[index], parabola
@@ -509,6 +1046,93 @@ class LogLikelihood(object):
         header.append(card)
         fitsio.write(filename,data,header=header,clobber=True)
 
+def fit_richness_batch(u, b, f, atol=1.e-3, maxiter=50):
+    """
+    Maximize the log-likelihood with respect to richness for a
+    batch of signal models simultaneously. Each row of `u` is the
+    object-by-object signal probability for one model (e.g., one
+    target pixel). The log-likelihood
+
+        L(r) = -sum(log(1-p)) - f*r = sum(log(1 + r*u/b)) - f*r
+
+    is concave in richness and its derivatives are analytic sums over
+    w = u/(r*u + b). The maximum is found with Halley steps on the
+    gradient starting from r = 0 (falling back to a Newton step where
+    the Halley denominator is not positive).
+
+    Parameters:
+    -----------
+    u       : signal probability, shape (nmodels, nobjects)
+    b       : background probability, shape (nobjects,)
+    f       : observable fraction, shape (nmodels,)
+    atol    : absolute tolerance on the log-likelihood
+    maxiter : maximum number of iterations
+
+    Returns:
+    --------
+    loglike, richness, niter, converged : maximum loglike, mle,
+        number of iterations, and convergence flag for each model
+    """
+    u = np.atleast_2d(u)
+    f = np.atleast_1d(f).astype(float)
+    b = np.asarray(b)
+    nmodels = len(u)
+
+    loglike   = np.zeros(nmodels)
+    richness  = np.zeros(nmodels)
+    niter     = np.zeros(nmodels,dtype=int)
+    converged = np.ones(nmodels,dtype=bool)
+
+    # Same failure modes as `LogLikelihood.fit_richness`
+    good = ~np.isnan(u).any(axis=1) & np.any(u,axis=1) & (f != 0)
+    if (~good).any():
+        logger.debug("Skipping %i models with no valid signal"%(~good).sum())
+
+    # u/b is all that enters the likelihood
+    x = u[good]/b
+    fg = f[good]
+
+    # The maximum is at r = 0 unless the gradient at zero is positive
+    active = x.sum(axis=1) > fg
+    r = np.zeros(len(x))
+    lnl = np.zeros(len(x))
+    nit = np.zeros(len(x),dtype=int)
+    conv = np.ones(len(x),dtype=bool)
+
+    for i in range(maxiter):
+        if not active.any(): break
+        idx = np.where(active)[0]
+        xa,ra,fa = x[idx],r[idx],fg[idx]
+
+        # Derivatives of the log-likelihood
+        w = xa/(1. + ra[:,np.newaxis]*xa)
+        d1 = w.sum(axis=1) - fa
+        d2 = -(w**2).sum(axis=1)
+        d3 = 2*(w**3).sum(axis=1)
+
+        # Halley step (Newton where the denominator is not positive)
+        denom = 2*d2**2 - d1*d3
+        step = np.where(denom > 0, -2*d1*d2/np.where(denom > 0,denom,1.), -d1/d2)
+        r_new = ra + step
+        # Don't step past zero richness
+        r_new = np.where(r_new < 0, 0.5*ra, r_new)
+
+        lnl_new = np.log1p(r_new[:,np.newaxis]*xa).sum(axis=1) - fa*r_new
+        done = np.fabs(lnl_new - lnl[idx]) < atol
+        failed = ~np.isfinite(lnl_new)
+
+        r[idx],lnl[idx] = r_new,lnl_new
+        nit[idx] += 1
+        conv[idx[failed]] = False
+        active[idx[done|failed]] = False
+
+    if active.any():
+        logger.warning("Maximum number of iterations reached")
+        conv[active] = False
+
+    loglike[good],richness[good],niter[good],converged[good] = lnl,r,nit,conv
+    return loglike, richness, niter, converged
+
 def write_membership(filename,config,srcfile,section=None):
     """
     Top level interface to write the membership from a config and source model.
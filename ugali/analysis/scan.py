@@ -4,6 +4,9 @@ Create and run an individual likelihood analysis.
 """
 import os
 import sys
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 from collections import OrderedDict as odict
 
 import numpy
@@ -14,6 +17,7 @@ import fitsio
 import ugali.utils.skymap
 import ugali.analysis.loglike
 from ugali.analysis.loglike import LogLikelihood, createSource, createObservation
+from ugali.analysis.loglike import fit_richness_batch, SpatialCache
 from ugali.analysis.source import Source
 from ugali.utils.parabola import Parabola
 
@@ -99,6 +103,22 @@ class GridSearch:
         self.distance_modulus_array = np.asarray(self.config['scan']['distance_modulus_array'])
         self.extension_array = np.asarray(self.config['scan'].get('extension_array',[self.source.extension]))
 
+        # Fit the richness for blocks of target pixels simultaneously
+        self.batch_fit = self.config['scan'].get('batch_fit',False)
+        self.batch_size = self.config['scan'].get('batch_size',64)
+
+        # Calculate the isochrone terms for all distance moduli at once
+        self.batch_moduli = self.config['scan'].get('batch_moduli',False)
+
+        # Number of worker processes to partition target pixels across
+        self.ncores = self.config['scan'].get('ncores',1)
+        self._workers = []
+
+        # Reuse the spatial kernel terms across distance moduli (MB; off by default)
+        cache_size = self.config['scan'].get('spatial_cache_size',0)
+        if cache_size and len(self.distance_modulus_array) > 1:
+            self.loglike.spatial_cache = SpatialCache(int(cache_size*1024**2))
+
 
     def search(self, coords=None, distance_modulus=None, extension=None, tolerance=1.e-2):
         """
@@ -130,6 +150,7 @@ class GridSearch:
         self.stellar_mass_array         = np.zeros([nmoduli,npixels],dtype='f4')
         self.fraction_observable_array  = np.zeros([nmoduli,npixels],dtype='f4')
         self.extension_fit_array        = np.zeros([nmoduli,npixels],dtype='f4')
+        self.niter_array                = np.zeros([nmoduli,npixels],dtype='i2')
         if self.config['scan']['full_pdf']:
             # DEPRECATED: ADW 2019-04-27
             DeprecationWarning("'full_pdf' is deprecated.")
@@ -149,8 +170,18 @@ class GridSearch:
             # Match to nearest extension
             extension_idx=np.fabs(self.extension_array-extension).argmin()
 
-        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
-            
+        # Specific pixel
+        pixels = np.arange(npixels)
+        if coord_idx is not None: pixels = pixels[[coord_idx]]
+
+        self._stop_workers()
+
+        if self.batch_moduli and len(self.loglike.catalog):
+            moduli = self.distance_modulus_array
+            if distance_modulus_idx is not None: moduli = moduli[[distance_modulus_idx]]
+            logger.info('Calculating isochrone terms for %i distance moduli ...'%len(moduli))
+            self.loglike.set_color_grid(moduli)
+
         logger.info('Looping over distance moduli in grid search ...')
         for ii, distance_modulus in enumerate(self.distance_modulus_array):
             # Specific distance
@@ -166,82 +197,276 @@ class GridSearch:
 
             # Set distance_modulus once to save time
             self.loglike.set_params(distance_modulus=distance_modulus)
-            # Loop over pixels
-            for jj in range(0, npixels):
-                # Specific pixel
-                if coord_idx is not None:
-                    if jj != coord_idx: continue
-
-                # Set kernel location
-                self.loglike.set_params(lon=lon[jj],lat=lat[jj])
-
-                loglike = 0
-                # Loop over extensions
-                for kk,ext in enumerate(self.extension_array):
-                    # Specific extension
-                    if extension_idx is not None:
-                        if kk != extension_idx: continue
-
-                    # Set extension
-                    self.loglike.set_params(extension=ext)
-
-                    # Doesn't re-sync distance_modulus each time
-                    self.loglike.sync_params()
 
-                    # Maximize the likelihood with respect to richness
-                    loglike,rich,p = self.loglike.fit_richness()
-
-                    if loglike < self.loglike_array[ii][jj]:
-                        # No loglike increase, continue
-                        continue
-
-                    self.loglike_array[ii][jj],self.richness_array[ii][jj], parabola = loglike,rich,p
-                    self.stellar_mass_array[ii][jj] = self.stellar_mass_conversion*self.richness_array[ii][jj]
-                    self.fraction_observable_array[ii][jj] = self.loglike.f
-                    self.extension_fit_array[ii][jj] = self.source.extension
-
-                # ADW: Careful, we are leaving the extension at the
-                # last value in the array, not at the maximum...
-
-                # Debug output
-                args = (jj+1, npixels, lon[jj], lat[jj],
-                        2.*self.loglike_array[ii][jj], 
-                        self.stellar_mass_array[ii][jj],
-                        self.fraction_observable_array[ii][jj],
-                        self.extension_fit_array[ii][jj]
-                        )
-                msg  = '    (%-3i/%i) Candidate at (%.2f, %.2f) ... '
-                msg += 'TS=%.1f, Mstar=%.2g, ObsFrac=%.2g, Ext=%.2g'
-                logger.debug(msg%args)
-
-                """
-                # This is debugging output
-                if self.config['scan']['full_pdf']:
-                    DeprecationWarning("'full_pdf' is deprecated.")
-                    self.richness_lower_array[ii][jj], self.richness_upper_array[ii][jj] = self.loglike.richness_interval(0.6827)
-                    
-                    self.richness_ulimit_array[ii][jj] = parabola.bayesianUpperLimit(0.95)
-
-                    args = (
-                        2. * self.loglike_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_lower_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_upper_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_ulimit_array[ii][jj]
+            if self.ncores > 1:
+                self._search_parallel(ii, pixels, extension_idx)
+            elif self.batch_fit:
+                self._search_batch(ii, pixels, extension_idx)
+            else:
+                self._search_pixels(ii, pixels, extension_idx)
+
+            self._log_max(ii)
+
+        self._stop_workers()
+
+    def _search_pixels(self, ii, pixels, extension_idx=None):
+        """
+        Maximize the likelihood with respect to richness for each
+        target pixel (and extension) at a single distance modulus.
+
+        Parameters:
+        -----------
+        ii            : index of the distance modulus
+        pixels        : indices of the target pixels to search
+        extension_idx : index of a specific extension (or None)
+
+        Returns:
+        --------
+        None
+        """
+        npixels = len(self.roi.pixels_target)
+        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
+
+        # Loop over pixels
+        for jj in pixels:
+            # Set kernel location
+            self.loglike.set_params(lon=lon[jj],lat=lat[jj])
+
+            loglike = 0
+            # Loop over extensions
+            for kk,ext in enumerate(self.extension_array):
+                # Specific extension
+                if extension_idx is not None:
+                    if kk != extension_idx: continue
+
+                # Set extension
+                self.loglike.set_params(extension=ext)
+
+                # Doesn't re-sync distance_modulus each time
+                self.loglike.sync_params()
+
+                # Maximize the likelihood with respect to richness
+                loglike,rich,p = self.loglike.fit_richness()
+
+                if loglike < self.loglike_array[ii][jj]:
+                    # No loglike increase, continue
+                    continue
+
+                self.loglike_array[ii][jj],self.richness_array[ii][jj], parabola = loglike,rich,p
+                self.stellar_mass_array[ii][jj] = self.stellar_mass_conversion*self.richness_array[ii][jj]
+                self.fraction_observable_array[ii][jj] = self.loglike.f
+                self.extension_fit_array[ii][jj] = self.source.extension
+                self.niter_array[ii][jj] = self.loglike.richness_niter
+
+            # ADW: Careful, we are leaving the extension at the
+            # last value in the array, not at the maximum...
+
+            # Debug output
+            args = (jj+1, npixels, lon[jj], lat[jj],
+                    2.*self.loglike_array[ii][jj], 
+                    self.stellar_mass_array[ii][jj],
+                    self.fraction_observable_array[ii][jj],
+                    self.extension_fit_array[ii][jj]
                     )
-                    msg = 'TS=%.1f, Stellar Mass=%.1f (%.1f -- %.1f @ 0.68 CL, < %.1f @ 0.95 CL)'%(args)
-                    logger.debug(msg)
-                """
-                
-            jj_max = self.loglike_array[ii].argmax()
-            args = (
-                jj_max+1, npixels, lon[jj_max], lat[jj_max],
-                2. * self.loglike_array[ii][jj_max], 
-                self.stellar_mass_conversion * self.richness_array[ii][jj_max],
-                self.extension_fit_array[ii][jj_max]
-            )
-            msg = '  (%-3i/%i) Max at (%.2f, %.2f) : TS=%.1f, Mstar=%.2g, Ext=%.2f'%(args)
-            logger.info(msg)
+            msg  = '    (%-3i/%i) Candidate at (%.2f, %.2f) ... '
+            msg += 'TS=%.1f, Mstar=%.2g, ObsFrac=%.2g, Ext=%.2g'
+            logger.debug(msg%args)
+
+            """
+            # This is debugging output
+            if self.config['scan']['full_pdf']:
+                DeprecationWarning("'full_pdf' is deprecated.")
+                self.richness_lower_array[ii][jj], self.richness_upper_array[ii][jj] = self.loglike.richness_interval(0.6827)
+
+                self.richness_ulimit_array[ii][jj] = parabola.bayesianUpperLimit(0.95)
+
+                args = (
+                    2. * self.loglike_array[ii][jj],
+                    self.stellar_mass_conversion*self.richness_array[ii][jj],
+                    self.stellar_mass_conversion*self.richness_lower_array[ii][jj],
+                    self.stellar_mass_conversion*self.richness_upper_array[ii][jj],
+                    self.stellar_mass_conversion*self.richness_ulimit_array[ii][jj]
+                )
+                msg = 'TS=%.1f, Stellar Mass=%.1f (%.1f -- %.1f @ 0.68 CL, < %.1f @ 0.95 CL)'%(args)
+                logger.debug(msg)
+            """
+
+    def _search_batch(self, ii, pixels, extension_idx=None):
+        """
+        Maximize the likelihood with respect to richness for all
+        target pixels at a single distance modulus. The
+        object-by-pixel signal matrix is built in blocks of
+        `batch_size` pixels and the richness is solved for the entire
+        block with vectorized Newton steps.
+
+        Parameters:
+        -----------
+        ii            : index of the distance modulus
+        pixels        : indices of the target pixels to search
+        extension_idx : index of a specific extension (or None)
+
+        Returns:
+        --------
+        None
+        """
+        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
+
+        extensions = np.arange(len(self.extension_array))
+        if extension_idx is not None: extensions = extensions[[extension_idx]]
+
+        nobjects = len(self.loglike.catalog)
+        for kk in extensions:
+            ext = self.extension_array[kk]
+            self.loglike.set_params(extension=ext)
+
+            for start in range(0, len(pixels), self.batch_size):
+                block = pixels[start:start+self.batch_size]
+                u = np.zeros((len(block),nobjects))
+                f = np.zeros(len(block))
+                for i,jj in enumerate(block):
+                    self.loglike.set_params(lon=lon[jj],lat=lat[jj])
+                    self.loglike.sync_params()
+                    u[i] = self.loglike.u
+                    f[i] = self.loglike.f
+
+                loglike,rich,niter,converged = fit_richness_batch(u,self.loglike.b,f)
+                if not converged.all():
+                    logger.warning('    Richness fit did not converge for %i pixels'%(~converged).sum())
+
+                # Only keep the extension that increases the loglike
+                sel = ~(loglike < self.loglike_array[ii][block])
+                jj = block[sel]
+                self.loglike_array[ii][jj] = loglike[sel]
+                self.richness_array[ii][jj] = rich[sel]
+                self.stellar_mass_array[ii][jj] = self.stellar_mass_conversion*self.richness_array[ii][jj]
+                self.fraction_observable_array[ii][jj] = f[sel]
+                self.extension_fit_array[ii][jj] = ext
+                self.niter_array[ii][jj] = niter[sel]
+
+    @property
+    def _result_arrays(self):
+        return [self.loglike_array, self.richness_array, self.stellar_mass_array,
+                self.fraction_observable_array, self.extension_fit_array,
+                self.niter_array]
+
+    def _start_workers(self, pixels):
+        """
+        Fork a pool of worker processes that each own a fixed subset
+        of the target pixels. Workers inherit the catalog, mask, and
+        spatial cache from the parent; the isochrone terms that change
+        with distance modulus are shared through shared memory.
+
+        Parameters:
+        -----------
+        pixels : indices of the target pixels to search
+
+        Returns:
+        --------
+        None
+        """
+        ctx = multiprocessing.get_context('fork')
+        ncores = min(self.ncores, len(pixels))
+        logger.info('Starting %i worker processes ...'%ncores)
+        for i in range(ncores):
+            parent_conn, child_conn = ctx.Pipe()
+            subset = pixels[i::ncores]
+            proc = ctx.Process(target=_search_worker, args=(self,subset,child_conn))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._workers.append((proc,parent_conn,subset))
+
+    def _stop_workers(self, terminate=False):
+        """
+        Shut down the worker processes and close their connections.
+
+        Parameters:
+        -----------
+        terminate : kill the workers rather than waiting for them to
+                    finish (e.g., if they may be blocked on a result)
+
+        Returns:
+        --------
+        None
+        """
+        for proc,conn,subset in self._workers:
+            if terminate:
+                proc.terminate()
+            else:
+                try: conn.send(None)
+                except (OSError,ValueError): pass
+            conn.close()
+            proc.join()
+        self._workers = []
+
+    def _search_parallel(self, ii, pixels, extension_idx=None):
+        """
+        Search the target pixels at a single distance modulus with a
+        pool of worker processes. The results are assembled in the
+        parent and are identical to the serial search.
+
+        Parameters:
+        -----------
+        ii            : index of the distance modulus
+        pixels        : indices of the target pixels to search
+        extension_idx : index of a specific extension (or None)
+
+        Returns:
+        --------
+        None
+        """
+        # Calculate the isochrone terms once in the parent
+        self.loglike.sync_params()
+        if not self._workers: self._start_workers(pixels)
+
+        shms, specs = [], []
+        try:
+            for name in ['observable_fraction','u_color']:
+                arr = np.ascontiguousarray(getattr(self.loglike,name))
+                shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+                np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[:] = arr
+                shms.append(shm)
+                specs.append((shm.name,arr.shape,arr.dtype.str))
+
+            msg = (ii, self.distance_modulus_array[ii], extension_idx, specs)
+            try:
+                for proc,conn,subset in self._workers:
+                    conn.send(msg)
+                # Receive from every worker so no result is left in a pipe
+                results = [conn.recv() for proc,conn,subset in self._workers]
+            except BaseException:
+                self._stop_workers(terminate=True)
+                raise
+
+            errors = [r for r in results if isinstance(r,str)]
+            if errors:
+                self._stop_workers()
+                raise Exception("Worker failed:\n"+errors[0])
+
+            for (proc,conn,subset),result in zip(self._workers,results):
+                for arr,values in zip(self._result_arrays,result):
+                    arr[ii][subset] = values
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def _log_max(self, ii):
+        """ Log the maximum likelihood target pixel at a distance modulus. """
+        npixels = len(self.roi.pixels_target)
+        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
+        jj_max = self.loglike_array[ii].argmax()
+        args = (
+            jj_max+1, npixels, lon[jj_max], lat[jj_max],
+            2. * self.loglike_array[ii][jj_max], 
+            self.stellar_mass_conversion * self.richness_array[ii][jj_max],
+            self.extension_fit_array[ii][jj_max]
+        )
+        msg = '  (%-3i/%i) Max at (%.2f, %.2f) : TS=%.1f, Mstar=%.2g, Ext=%.2f'%(args)
+        logger.info(msg)
+        niter = self.niter_array[ii]
+        msg = '  Richness fit iterations: mean=%.1f, max=%i'%(niter.mean(),niter.max())
+        logger.info(msg)
 
     def mle(self):
         a = self.loglike_array
@@ -367,6 +592,61 @@ class GridSearch:
                      extname='DISTANCE_MODULUS',
                      clobber=False)
 
+def _search_worker(grid, pixels, conn):
+    """
+    Worker process for `GridSearch._search_parallel`. Receives the
+    distance modulus index and shared memory specification of the
+    isochrone terms, searches its subset of target pixels, and returns
+    the corresponding slices of the result arrays.
+
+    Parameters:
+    -----------
+    grid   : GridSearch instance (inherited through fork)
+    pixels : indices of the target pixels owned by this worker
+    conn   : connection to the parent process
+
+    Returns:
+    --------
+    None
+    """
+    loglike = grid.loglike
+    while True:
+        msg = conn.recv()
+        if msg is None: break
+        ii, distance_modulus, extension_idx, specs = msg
+        shms = []
+        try:
+            arrays = []
+            for name,shape,dtype in specs:
+                shm = shared_memory.SharedMemory(name=name)
+                # The parent owns (and unlinks) the shared memory
+                resource_tracker.unregister(shm._name,'shared_memory')
+                shms.append(shm)
+                arrays.append(np.ndarray(shape,dtype=dtype,buffer=shm.buf))
+
+            # Set the precomputed isochrone terms without re-syncing
+            loglike.set_params(distance_modulus=distance_modulus)
+            loglike.observable_fraction, loglike.u_color = arrays
+            grid.source.reset_sync('isochrone')
+            del arrays
+
+            for arr in grid._result_arrays:
+                arr[ii][pixels] = 0
+            if grid.batch_fit:
+                grid._search_batch(ii, pixels, extension_idx)
+            else:
+                grid._search_pixels(ii, pixels, extension_idx)
+
+            result = [arr[ii][pixels] for arr in grid._result_arrays]
+        except Exception:
+            result = traceback.format_exc()
+        finally:
+            # Release the views before detaching
+            loglike.observable_fraction = loglike.u_color = None
+            for shm in shms: shm.close()
+        conn.send(result)
+    conn.close()
+
 if __name__ == "__main__":
     import ugali.utils.parser
     description = "Script for executing the likelihood scan."
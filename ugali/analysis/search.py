@@ -14,18 +14,34 @@ import fitsio
 import numpy as np
 import numpy
 import numpy.lib.recfunctions as recfuncs
-import scipy.ndimage as ndimage
 
 from ugali.utils.shell import mkdir, which
 from ugali.utils.logger import logger
-from ugali.utils.binning import reverseHistogram
-from ugali.utils.projector import Projector,gal2cel,cel2gal,ang2iau,mod2dist
+from ugali.utils.projector import gal2cel,cel2gal,ang2iau,mod2dist
 from ugali.utils import healpix, mlab
 from ugali.utils.healpix import pix2ang, ang2pix
 from ugali.candidate.associate import SourceCatalog, catalogFactory
 from ugali.utils.config import Config
 from ugali.utils import fileio
 
+def _roots(parent):
+    """ Compress a union-find forest in place and return the roots. """
+    while True:
+        grand = parent[parent]
+        if np.all(grand == parent): return parent
+        parent[:] = grand
+
+def _union(parent, a, b):
+    """ Vectorized union of the sets containing nodes a and b. The
+    parent of a node is never larger than the node, so hooking the
+    larger root onto the smaller cannot create cycles. """
+    while len(a):
+        roots = _roots(parent)
+        ra,rb = roots[a],roots[b]
+        sel = (ra != rb)
+        a,b,ra,rb = a[sel],b[sel],ra[sel],rb[sel]
+        np.minimum.at(parent,np.maximum(ra,rb),np.minimum(ra,rb))
+
 class CandidateSearch(object):
     """
     Object used to search for candidate objects in TS maps.
@@ -81,7 +97,8 @@ class CandidateSearch(object):
         self.richness = data['RICHNESS']
 
         # Load distances from first file (should all be the same)
-        self.distances = fileio.load_files(filenames[0],ext=2,columns='DISTANCE_MODULUS')
+        self.distances = fileio.load_files(filenames[0],ext='DISTANCE_MODULUS',
+                                            columns='DISTANCE_MODULUS')
 
     def loadROI(self,filename=None):
         """Load the ROI parameter sparse healpix map.
@@ -116,20 +133,16 @@ class CandidateSearch(object):
         vmax = self.values[np.arange(len(self.pixels),dtype=int),zmax]
 
         kwargs=dict(pixels=self.pixels,values=vmax,nside=self.nside,
-                    threshold=self.threshold,xsize=self.xsize)
-        labels,nlabels = CandidateSearch.labelHealpix(**kwargs)
-        self.nlabels = nlabels
-
-        # This is wasteful, but returns the same shape array for 2D and 3D labels
-        self.labels = np.repeat(labels,len(self.distances)).reshape(len(labels),len(self.distances))
-        #self.labels = labels
+                    threshold=self.threshold)
+        self.labels,self.nlabels = CandidateSearch.labelHealpix(**kwargs)
 
+        # The same (spatial) labels apply to all distances
         return self.labels, self.nlabels
 
     def createLabels3D(self):
         logger.debug("  Creating 3D labels...")
         kwargs=dict(pixels=self.pixels,values=self.values,nside=self.nside,
-                    threshold=self.threshold,xsize=self.xsize)
+                    threshold=self.threshold)
         self.labels,self.nlabels = CandidateSearch.labelHealpix(**kwargs)
         return self.labels, self.nlabels
 
@@ -170,16 +183,19 @@ class CandidateSearch(object):
         f = fitsio.FITS(filename)
 
         data = f['PIX_DATA'].read()
-        if not (self.pixels == data['PIXEL']).all(): 
+        # Rows are sorted by pixel on write; align them with self.pixels
+        pixel = data['PIXEL']
+        order = np.argsort(pixel,kind='stable')
+        idx = order[healpix.index_pix_in_pixels(self.pixels,pixel[order])]
+        if len(pixel) != len(self.pixels) or not (pixel[idx] == self.pixels).all():
             raise Exception("Pixels do not match")
-        self.pixels = data['PIXEL'] # this is just to save memory
 
         distances = f['DISTANCE_MODULUS'].read(columns='DISTANCE_MODULUS')
         if not (self.distances == distances).all():
             raise Exception("Distance moduli do not match.")
         self.distances = distances
 
-        self.labels = data['LABEL']
+        self.labels = data['LABEL'][idx]
         self.nlabels = self.labels.max()
         if self.nlabels != (len(np.unique(self.labels)) - 1):
             raise Exception("Incorrect number of labels found.")
@@ -198,16 +214,11 @@ class CandidateSearch(object):
         objects : array of objects
         """
         logger.debug("  Creating objects...")
-        hist,edges,rev = reverseHistogram(self.labels,bins=np.arange(self.nlabels+2))
-        self.rev = rev
-        # Make some cut on the minimum size of a labelled object
-        good, = np.where( (hist >= self.minpix) )
-        # Get rid of zero label (below threshold)
-        self.good, = np.nonzero(good)
-
         kwargs=dict(pixels=self.pixels,values=self.values,nside=self.nside,
-                    zvalues=self.distances, rev=self.rev, good=self.good)
+                    zvalues=self.distances, labels=self.labels)
         objects = self.findObjects(**kwargs)
+        # Make some cut on the minimum size of a labelled object
+        objects = objects[objects['NPIX'] >= self.minpix]
         self.objects = self.finalizeObjects(objects)
 
         return self.objects
@@ -219,10 +230,12 @@ class CandidateSearch(object):
 
 
     @staticmethod
-    def labelHealpix(pixels, values, nside, threshold=0, xsize=1000):
+    def labelHealpix(pixels, values, nside, threshold=0, xsize=None, dilate=1, link=True):
         """
-        Label contiguous regions of a (sparse) HEALPix map. Works by mapping 
-        HEALPix array to a Mollweide projection and applying scipy.ndimage.label
+        Label contiguous regions of a (sparse) HEALPix map. Works directly
+        on the HEALPix neighbour graph (`healpy.get_all_neighbours`) with a
+        vectorized union-find over the pixels above threshold, so memory
+        scales with the number of those pixels rather than an image size.
      
         Assumes non-nested HEALPix map.
         
@@ -231,66 +244,109 @@ class CandidateSearch(object):
         values    : (Sparse) HEALPix array of data values
         nside     : HEALPix dimensionality
         threshold : Threshold value for object detection
-        xsize     : Size of Mollweide projection
+        xsize     : Unused (size of the former Mollweide projection)
+        dilate    : Join regions separated by up to `dilate` pixels/slices
+        link      : Link regions in adjacent distance slices
         
         Returns:
         labels, nlabels
         """
-        proj = healpy.projector.MollweideProj(xsize=xsize)
-        vec = healpy.pix2vec(nside,pixels)
-        xy = proj.vec2xy(vec)
-        ij = proj.xy2ij(xy)
-        xx,yy = proj.ij2xy()
-     
-        # Convert to Mollweide
-        searchims = []
-        if values.ndim < 2: iterate = [values]
-        else:               iterate = values.T
-        for i,value in enumerate(iterate):
-            logger.debug("Labeling slice %i..."%i)
-            searchim = np.zeros(xx.shape,dtype=bool)
-            select = (value > threshold)
-            yidx = ij[0][select]; xidx = ij[1][select]
-            searchim[yidx,xidx] |= True
-            searchims.append( searchim )
-        searchims = np.array(searchims)
-
-        # Full binary structure
-        s = ndimage.generate_binary_structure(searchims.ndim,searchims.ndim)
-     
-        ### # Dilate in the z-direction
-        logger.info("  Dilating image...")
-        searchims = ndimage.binary_dilation(searchims,s,1)
-        
-        # Do the labeling
-        logger.info("  Labeling image...")
-        labels,nlabels = ndimage.label(searchims,structure=s)
-
-        # Convert back to healpix
-        pix_labels = labels[:,ij[0],ij[1]].T
-        pix_labels = pix_labels.reshape(values.shape)
-        pix_labels *= (values > threshold) # re-trim
-
-        return pix_labels, nlabels
+        pixels = np.asarray(pixels)
+        values = np.asarray(values)
+        shape = values.shape
+        values = values.reshape(len(pixels),-1)
+        nz = values.shape[1]
+
+        # Nodes are the (pixel, slice) pairs above threshold; the keys
+        # are sorted since np.nonzero returns them in row-major order
+        idx,zidx = np.nonzero(values > threshold)
+        pix_labels = np.zeros(values.shape,dtype='i4')
+        if not len(idx): return pix_labels.reshape(shape), 0
+        upix,upos = np.unique(idx,return_inverse=True)
+        keys = upos*nz + zidx
+
+        # Pixels reachable in (1 + dilate) steps of each occupied pixel
+        logger.info("  Finding neighbors...")
+        pix = pixels[upix]
+        reach = pix[np.newaxis,:]
+        for i in range(1+int(dilate)):
+            nbr = healpy.get_all_neighbours(nside,reach.clip(0).ravel())
+            nbr = nbr.reshape(-1,reach.shape[-1])
+            nbr[np.tile(reach < 0,(8,1))] = -1
+            reach = np.sort(np.vstack([reach,nbr]),axis=0)
+            reach[1:][reach[1:] == reach[:-1]] = -1
+            reach = np.sort(reach,axis=0)
+            reach = reach[(reach >= 0).any(axis=1)]
+
+        # Index of the reachable pixels among the occupied pixels
+        order = np.argsort(pix)
+        neighbors = order[np.searchsorted(pix,reach,sorter=order).clip(0,len(pix)-1)]
+        neighbors[pix[neighbors] != reach] = -1
+
+        # Join the nodes with their neighbors in this and higher slices
+        logger.info("  Labeling pixels...")
+        parent = np.arange(len(keys))
+        nlink = (1 + int(dilate)) if link else 0
+        for dz in range(nlink+1):
+            z = zidx + dz
+            for nbr in neighbors:
+                j = nbr[upos]
+                sel, = np.where((j >= 0) & (z < nz))
+                key = j[sel]*nz + z[sel]
+                b = np.searchsorted(keys,key).clip(0,len(keys)-1)
+                found = (keys[b] == key)
+                _union(parent,sel[found],b[found])
+
+        roots = _roots(parent)
+        ulabels,labels = np.unique(roots,return_inverse=True)
+        pix_labels[idx,zidx] = labels + 1
+
+        return pix_labels.reshape(shape), len(ulabels)
 
     @staticmethod
-    def findObjects(pixels, values, nside, zvalues, rev, good):
+    def findObjects(pixels, values, nside, zvalues, labels, good=None):
         """
         Characterize labelled candidates in a multi-dimensional HEALPix map.
+        The labelled entries are sorted by label once and each quantity is
+        reduced per label (`np.add.reduceat`, `np.maximum.reduceat`). The
+        centroid and barycenter are the (weighted) means of the pixel unit
+        vectors.
      
         Parameters:
         pixels    : Pixel values associated to (sparse) HEALPix array
         values    : (Sparse) HEALPix array of data values
         nside     : HEALPix dimensionality
         zvalues   : Values of the z-dimension (usually distance modulus)
-        rev       : Reverse indices for pixels in each "island"
-        good      : Array containg labels for each "island"
+        labels    : Labels of each pixel (1D, for all z-values) or of each
+                    pixel and z-value (same shape as values)
+        good      : Labels to characterize (default: all non-zero labels)
      
         Returns:
         objs      : np.recarray of object characteristics
         """
-     
-        ngood = len(good)
+        values = np.asarray(values).reshape(len(pixels),-1)
+        labels = np.asarray(labels)
+        ncol = values.shape[1]
+
+        # Spatial and distance index of each labelled entry
+        if labels.ndim < 2:
+            idx, = np.nonzero(labels)
+            label = np.repeat(labels[idx],ncol)
+            idx,zidx = np.repeat(idx,ncol),np.tile(np.arange(ncol),len(idx))
+        else:
+            idx,zidx = np.nonzero(labels.reshape(len(pixels),-1))
+            label = labels.reshape(len(pixels),-1)[idx,zidx]
+        if good is not None:
+            sel = np.in1d(label,good)
+            idx,zidx,label = idx[sel],zidx[sel],label[sel]
+
+        # Group the entries by label
+        order = np.argsort(label,kind='stable')
+        idx,zidx,label = idx[order],zidx[order],label[order]
+        ulabel,start,npix = np.unique(label,return_index=True,return_counts=True)
+        group = np.repeat(np.arange(len(ulabel)),npix)
+        ngood = len(ulabel)
+
         objs = np.recarray((ngood,),
                            dtype=[('LABEL','i4'),
                                   ('NPIX','i4'),
@@ -309,55 +365,33 @@ class CandidateSearch(object):
                                   ('Z_BARY','f4'),
                                   ('CUT','i2'),])
         objs['CUT'][:] = 0
-     
-        shape = values.shape
-        ncol = shape[1]
-        for i in range(0,ngood):
-            logger.debug("i=%i",i)
-            # This code could use some cleanup...
-            indices=rev[rev[good[i]]:rev[good[i]+1]]
-            npix = len(indices)
-            idx = indices // ncol # This is the spatial index
-            zidx = indices % ncol  # This is the distance index
-     
-            pix = pixels[idx] # This is the healpix pixel
-            xval,yval = pix2ang(nside, pix)
-            zval = zvalues[zidx]
-            
-            objs[i]['LABEL'] = good[i]
-            objs[i]['NPIX'] = npix
-            logger.debug("LABEL=%i"%objs[i]['LABEL'])
-            logger.debug("NPIX=%i"%objs[i]['NPIX'])
-     
-            island = values[idx,zidx]
-            idxmax = island.argmax()
-            xval_max,yval_max,zval_max = xval[idxmax],yval[idxmax],zval[idxmax]
-     
-            objs[i]['VAL_MAX'] = island[idxmax]
-            objs[i]['IDX_MAX']  = idx[idxmax]
-            objs[i]['ZIDX_MAX']  = zidx[idxmax]
-            objs[i]['PIX_MAX']   = pix[idxmax]
-            objs[i]['X_MAX']  = xval_max
-            objs[i]['Y_MAX']  = yval_max
-            objs[i]['Z_MAX']  = zval_max
-
-            proj = Projector(xval_max,yval_max)
-            xpix,ypix = proj.sphereToImage(xval,yval)
-
-            # Projected centroid
-            x_cent,y_cent,zval_cent = np.average([xpix,ypix,zval],axis=1)
-            xval_cent, yval_cent = proj.imageToSphere(x_cent,y_cent)
-            objs[i]['X_CENT'] = xval_cent
-            objs[i]['Y_CENT'] = yval_cent
-            objs[i]['Z_CENT'] = zval_cent
-
-            # Projected barycenter
-            weights=[island,island,island]
-            x_bary,y_bary,zval_bary = np.average([xpix,ypix,zval],weights=weights,axis=1)
-            xval_bary,yval_bary = proj.imageToSphere(x_bary, y_bary)
-            objs[i]['X_BARY'] = xval_bary
-            objs[i]['Y_BARY'] = yval_bary
-            objs[i]['Z_BARY'] = zval_bary
+        if not ngood: return objs
+        objs['LABEL'] = ulabel
+        objs['NPIX'] = npix
+
+        island = values[idx,zidx]
+        zval = np.asarray(zvalues)[zidx]
+
+        # Maximum (first entry attaining the maximum of each label)
+        val_max = np.maximum.reduceat(island,start)
+        ismax, = np.nonzero(island == val_max[group])
+        imax = ismax[np.unique(group[ismax],return_index=True)[1]]
+        objs['VAL_MAX'] = val_max
+        objs['IDX_MAX'] = idx[imax]
+        objs['ZIDX_MAX'] = zidx[imax]
+        objs['PIX_MAX'] = pixels[idx[imax]]
+        objs['X_MAX'],objs['Y_MAX'] = pix2ang(nside,pixels[idx[imax]])
+        objs['Z_MAX'] = zval[imax]
+
+        # Centroid and barycenter from the sum of the unit vectors
+        vec = np.array(healpy.pix2vec(nside,pixels[idx]))
+        for key,weights in [('CENT',np.ones(len(island))),('BARY',island)]:
+            wsum = np.add.reduceat(weights,start)
+            vsum = np.add.reduceat(vec*weights,start,axis=1)
+            theta,phi = healpy.vec2ang(vsum.T)
+            objs['X_'+key] = healpix.phi2lon(phi)
+            objs['Y_'+key] = healpix.theta2lat(theta)
+            objs['Z_'+key] = np.add.reduceat(zval*weights,start)/wsum
      
         return objs
 
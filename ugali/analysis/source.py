@@ -215,8 +215,9 @@ class Source(object):
     def get_sync(self,model):
         return self._sync.get(model)
 
-    def reset_sync(self):
-        for k in self._sync.keys(): self._sync[k]=False
+    def reset_sync(self, models=None):
+        if models is None: models = list(self._sync.keys())
+        for k in np.atleast_1d(models): self._sync[k]=False
 
     def read(self,filename):
         pass
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Binary archive of a directory of isochrone files.
+
+The archive is a single file holding two '.npy' arrays back to back:
+an index table with the name and row range of each isochrone, and one
+contiguous structured array with the parsed data of all isochrones.
+The data array is memory mapped, so loading an isochrone is a slice
+rather than a call to `np.genfromtxt`.
+"""
+__author__ = "Alex Drlica-Wagner"
+
+import os
+import glob
+import tempfile
+
+import numpy as np
+
+from ugali.utils.cache import hash_args, freeze
+from ugali.utils.logger import logger
+
+# Basename of the archive in the isochrone directory
+ARCHIVE = 'archive.npy'
+
+def kwargs_key(kwargs):
+    """ Hash of the `np.genfromtxt` arguments used to parse the files.
+
+    Parameters:
+    -----------
+    kwargs : dictionary of keyword arguments
+
+    Returns:
+    --------
+    key    : hexadecimal hash string
+    """
+    return hash_args(freeze(kwargs))
+
+class IsochroneArchive(object):
+    """
+    Read-only access to an isochrone archive. Use `IsochroneArchive.open`
+    to share the (memory-mapped) archive between isochrone instances.
+    """
+    _open = dict()
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename,'rb') as f:
+            self.index = np.load(f)
+            version = np.lib.format.read_magic(f)
+            if version == (1,0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        shape,fortran_order,dtype = header
+        # Copy-on-write, so callers cannot modify the archive
+        self.data = np.memmap(filename,dtype=dtype,mode='c',offset=offset,shape=shape)
+        self._rows = dict((str(n),(str(k),int(a),int(b))) for n,k,a,b in self.index)
+
+    @classmethod
+    def open(cls, filename):
+        """ Open an archive (or return the already opened archive).
+
+        Parameters:
+        -----------
+        filename : archive filename
+
+        Returns:
+        --------
+        archive  : the archive (or None if the file does not exist)
+        """
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return None
+        opened = cls._open.get(filename)
+        if opened is None or opened[0] != mtime:
+            logger.debug("Opening isochrone archive: %s"%filename)
+            opened = (mtime,cls(filename))
+            cls._open[filename] = opened
+        return opened[1]
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, name, kwargs=None):
+        """ Get the data of an isochrone.
+
+        Parameters:
+        -----------
+        name   : basename of the isochrone file
+        kwargs : `np.genfromtxt` arguments expected by the caller
+
+        Returns:
+        --------
+        data   : structured array (or None if not archived)
+        """
+        try:
+            key,start,stop = self._rows[name]
+        except KeyError:
+            return None
+        if kwargs is not None and key != kwargs_key(kwargs):
+            logger.debug("Isochrone archive parsed with different columns")
+            return None
+        return self.data[start:stop]
+
+def create_archive(iso, outfile=None, filenames=None):
+    """
+    Parse a directory of isochrone files into a binary archive.
+
+    Parameters:
+    -----------
+    iso       : isochrone instance (sets the parsing format and survey)
+    outfile   : output archive (default: 'archive.npy' in isochrone directory)
+    filenames : isochrone files (default: all files in isochrone directory)
+
+    Returns:
+    --------
+    outfile   : archive filename
+    """
+    dirname = iso.get_dirname()
+    if outfile is None:
+        outfile = os.path.join(dirname,ARCHIVE)
+    if filenames is None:
+        filenames = sorted(glob.glob(os.path.join(dirname,'%s_*.dat'%iso._prefix)))
+    if not len(filenames):
+        msg = "No isochrone files found in: %s"%dirname
+        raise IOError(msg)
+
+    # Record the output of `np.genfromtxt` while parsing each file
+    records = []
+    def genfromtxt(filename, **kwargs):
+        data = np.genfromtxt(filename,**kwargs)
+        records.append((os.path.basename(filename),kwargs_key(kwargs),data))
+        return data
+    iso._genfromtxt = genfromtxt
+    try:
+        for filename in filenames:
+            logger.info("Parsing %s..."%filename)
+            iso._parse(filename)
+    finally:
+        del iso._genfromtxt
+
+    # Object columns (e.g., stage names) are stored as fixed-width
+    # strings of the same type that `np.genfromtxt` returned (bytes
+    # unless an encoding was given)
+    arrays = []
+    for name,key,data in records:
+        descr = []
+        for n in data.dtype.names:
+            dt = data.dtype[n]
+            if dt == object:
+                values = data[n].tolist()
+                size = max([len(v) for v in values]+[1])
+                kind = 'S' if all(isinstance(v,bytes) for v in values) else 'U'
+                dt = np.dtype('%s%i'%(kind,size))
+            descr.append((n,dt))
+        arrays.append(data.astype(descr))
+    dtype = np.result_type(*[a.dtype for a in arrays])
+    data = np.concatenate([a.astype(dtype) for a in arrays])
+
+    size = max([len(r[0]) for r in records])
+    index = np.recarray(len(records),dtype=[('name','U%i'%size),('key','U40'),
+                                            ('start','i8'),('stop','i8')])
+    index['name'] = [r[0] for r in records]
+    index['key'] = [r[1] for r in records]
+    index['stop'] = np.cumsum([len(a) for a in arrays])
+    index['start'] = index['stop'] - [len(a) for a in arrays]
+
+    # Write to a temporary file and move into place
+    fd,tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    with os.fdopen(fd,'wb') as f:
+        np.lib.format.write_array(f,np.asarray(index))
+        np.lib.format.write_array(f,data)
+    os.chmod(tmpname,0o644)
+    os.rename(tmpname,outfile)
+    logger.info("Wrote %i isochrones to %s"%(len(records),outfile))
+    return outfile
+
+if __name__ == "__main__":
+    import argparse
+    from ugali.isochrone import factory
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name',help='isochrone class name (e.g., Bressan2012)')
+    parser.add_argument('-s','--survey',default='des',help='survey filter system')
+    parser.add_argument('-o','--outfile',default=None,help='output archive')
+    args = parser.parse_args()
+
+    iso = factory(args.name,survey=args.survey)
+    create_archive(iso,outfile=args.outfile)
@@ -169,7 +169,7 @@ class Dotter2008(Isochrone):
             raise(e)
 
         kwargs = dict(comments='#',usecols=list(columns.keys()),dtype=list(columns.values()))
-        self.data = np.genfromtxt(filename,**kwargs)
+        self.data = self._genfromtxt(filename,**kwargs)
 
         # KCB: Not sure whether the mass in Dotter isochrone output
         # files is initial mass or current mass
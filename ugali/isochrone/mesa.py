@@ -138,7 +138,7 @@ class Dotter2016(Isochrone):
             raise(e)
 
         kwargs = dict(comments='#',usecols=list(columns.keys()),dtype=list(columns.values()))
-        data = np.genfromtxt(filename,**kwargs)
+        data = self._genfromtxt(filename,**kwargs)
 
         self.mass_init = data['mass_init']
         self.mass_act  = data['mass_act']
@@ -41,6 +41,7 @@ import numpy as np
 import scipy.interpolate
 import scipy.stats
 import scipy.spatial
+import scipy.sparse
 import scipy.ndimage as ndimage
 
 import ugali.analysis.imf
@@ -51,9 +52,22 @@ from ugali.utils.projector import mod2dist
 
 from ugali.utils.config import Config
 from ugali.utils.logger import logger
+from ugali.utils.cache import MemoryCache, freeze
+from ugali.isochrone.archive import IsochroneArchive, ARCHIVE
+
+# Default memory budget for the (object, bin) pairs in `pdf`
+PDF_MAX_BYTES = 256*1024**2
+# Number of memoized isochrone samples and histograms
+MEMO_SIZE = 32
 
 ############################################################
 
+def ordered_unique(values):
+    """ Unique values in order of first appearance. """
+    values = np.asarray(values)
+    idx = np.unique(values,return_index=True)[1]
+    return values[np.sort(idx)]
+
 def sum_mags(mags, weights=None):
     """
     Sum an array of magnitudes in flux space.
@@ -119,6 +133,7 @@ class IsochroneModel(Model):
         ('imf_type','Chabrier2003','Initial mass function'),
         ('hb_stage',None,'Horizontal branch stage name'),
         ('hb_spread',0.0,'Intrinisic spread added to horizontal branch'),
+        ('interpolate',False,'Interpolate between isochrone grid points'),
         )
     
     def __init__(self, **kwargs):
@@ -137,6 +152,9 @@ class IsochroneModel(Model):
         self.imf = ugali.analysis.imf.factory(defaults['imf_type'])
         self.index = None
 
+        # Memoized samples and histograms (see `_memo_key`)
+        self._memo = MemoryCache(MEMO_SIZE)
+
     def _parse(self,filename):
         msg = "Not implemented for base class"
         raise Exception(msg)
@@ -157,9 +175,31 @@ class IsochroneModel(Model):
         """ Convert to physical distance (kpc) """
         return mod2dist(self.distance_modulus)
 
+    def _memo_key(self, *args):
+        """
+        Key for memoized quantities that depend on everything except
+        the distance modulus (i.e., age, metallicity, IMF, HB spread,
+        and the isochrone file).
+
+        Parameters:
+        -----------
+        args : additional arguments of the memoized function
+
+        Returns:
+        --------
+        key  : hashable tuple
+        """
+        params = self.todict()
+        params.pop('distance_modulus',None)
+        for iso in params.get('isochrones',[]):
+            iso.pop('distance_modulus',None)
+        return (freeze(params),getattr(self,'filename',None)) + freeze(args)
+
     def sample(self, mode='data', mass_steps=1000, mass_min=0.1, full_data_range=False):
         """Sample the isochrone in steps of mass interpolating between
-        the originally defined isochrone points.
+        the originally defined isochrone points. Samples are memoized,
+        so repeated calls (e.g., when only the distance modulus
+        changes) are cheap.
 
         Parameters:
         -----------
@@ -176,6 +216,16 @@ class IsochroneModel(Model):
         mag_1 : Array of absolute magnitudes in first band (no distance modulus applied)
         mag_2 : Array of absolute magnitudes in second band (no distance modulus applied)
         """
+        key = self._memo_key('sample',mode,int(mass_steps),mass_min,full_data_range)
+        out = self._memo.get(key)
+        if out is None:
+            out = self._sample(mode,mass_steps,mass_min,full_data_range)
+            self._memo.put(key,out)
+        # Callers may modify the sample in place
+        return out.copy()
+
+    def _sample(self, mode='data', mass_steps=1000, mass_min=0.1, full_data_range=False):
+        """Sample the isochrone in steps of mass (not memoized; see `sample`)."""
 
         if full_data_range:
             # ADW: Might be depricated 02/10/2015
@@ -276,6 +326,15 @@ class IsochroneModel(Model):
         --------
         mass     : Stellar mass [Msun]
         """
+        key = self._memo_key('stellar_mass',mass_min,int(steps))
+        mass = self._memo.get(key)
+        if mass is None:
+            mass = self._stellar_mass(mass_min,steps)
+            self._memo.put(key,mass)
+        return mass
+
+    def _stellar_mass(self, mass_min=0.1, steps=10000):
+        """ Compute the stellar mass (not memoized; see `stellar_mass`). """
         mass_max = self.mass_init_upper_bound
             
         d_log_mass = (np.log10(mass_max) - np.log10(mass_min)) / float(steps)
@@ -491,7 +550,7 @@ class IsochroneModel(Model):
         observable_fraction = (mass_pdf_cut[:,np.newaxis]*mask_cut_repeat).sum(axis=0)
         return observable_fraction
 
-    def observableFractionCMD(self, mask, distance_modulus, mass_min=0.1):
+    def observableFractionCMD(self, mask, distance_modulus, mass_min=0.1, max_bytes=PDF_MAX_BYTES):
         """
         Compute observable fraction of stars with masses greater than mass_min in each 
         pixel in the interior region of the mask.
@@ -502,6 +561,17 @@ class IsochroneModel(Model):
              broadcasting here.
         ADW: Could this function be even faster / more readable?
         ADW: Should this include magnitude error leakage?
+
+        Parameters:
+        -----------
+        mask : the mask
+        distance_modulus : distance modulus (or array of moduli)
+        mass_min : minimum mass [Msun]
+        max_bytes : approximate memory budget for an array of moduli
+
+        Returns:
+        --------
+        observable_fraction : (n_interior_pixels) or (n_moduli, n_interior_pixels) array
         """
         if distance_modulus is None: distance_modulus = self.distance_modulus
         mass_init,mass_pdf,mass_act,mag_1,mag_2 = self.sample(mass_min=mass_min,full_data_range=False)
@@ -510,24 +580,36 @@ class IsochroneModel(Model):
         color = mag_1 - mag_2
 
         # ADW: Only calculate observable fraction for unique mask values
-        mag_1_mask,mag_2_mask = mask.mask_roi_unique.T
+        decomposition = mask.decomposition
+        mag_1_mask,mag_2_mask = decomposition.maglim.T
 
-        # ADW: Restrict mag and color to range of mask with sufficient solid angle
-        cmd_cut = ugali.utils.binning.take2D(mask.solid_angle_cmd,color,mag+distance_modulus,
-                                             mask.roi.bins_color, mask.roi.bins_mag) > 0
-        # Pre-apply these cuts to the 1D mass_pdf_array to save time
-        mass_pdf_cut = mass_pdf*cmd_cut
+        scalar = (np.ndim(distance_modulus) == 0)
+        moduli = np.atleast_1d(distance_modulus)
+        observable_fraction = np.zeros((len(moduli),len(mag_1_mask)))
 
-        # Create 2D arrays of cuts for each pixel
-        mask_1_cut = (mag_1+distance_modulus)[:,np.newaxis] < mag_1_mask
-        mask_2_cut = (mag_2+distance_modulus)[:,np.newaxis] < mag_2_mask
-        mask_cut_repeat = (mask_1_cut & mask_2_cut)
+        # Moduli per chunk (~3 arrays of 8 bytes per sample and unique mask value)
+        size = max(int(max_bytes // (24*len(mag_1)*len(mag_1_mask))), 1)
+        for lo in range(0,len(moduli),size):
+            mods = moduli[lo:lo+size,np.newaxis]
 
-        # Condense back into one per digi
-        observable_fraction = (mass_pdf_cut[:,np.newaxis]*mask_cut_repeat).sum(axis=0)
+            # ADW: Restrict mag and color to range of mask with sufficient solid angle
+            cmd_cut = ugali.utils.binning.take2D(mask.solid_angle_cmd,
+                                                 np.broadcast_to(color,(len(mods),len(color))),
+                                                 mag+mods,mask.roi.bins_color, mask.roi.bins_mag) > 0
+            # Pre-apply these cuts to the 1D mass_pdf_array to save time
+            mass_pdf_cut = mass_pdf*cmd_cut
+
+            # Create (moduli x samples x mask) arrays of cuts for each pixel
+            mask_1_cut = (mag_1+mods)[:,:,np.newaxis] < mag_1_mask
+            mask_2_cut = (mag_2+mods)[:,:,np.newaxis] < mag_2_mask
+            mask_cut_repeat = (mask_1_cut & mask_2_cut)
+
+            # Condense back into one per digi
+            observable_fraction[lo:lo+size] = (mass_pdf_cut[:,:,np.newaxis]*mask_cut_repeat).sum(axis=1)
 
         # Expand to the roi and multiply by coverage fraction
-        return observable_fraction[mask.mask_roi_digi[mask.roi.pixel_interior_cut]] * mask.frac_interior_sparse
+        observable_fraction = decomposition.interior(observable_fraction)
+        return observable_fraction[0] if scalar else observable_fraction
 
 
     def observableFractionCDF(self, mask, distance_modulus, mass_min=0.1):
@@ -550,7 +632,7 @@ class IsochroneModel(Model):
         mag_1 = mag_1+distance_modulus
         mag_2 = mag_2+distance_modulus
          
-        mask_1,mask_2 = mask.mask_roi_unique.T
+        mask_1,mask_2 = mask.decomposition.maglim.T
          
         mag_err_1 = mask.photo_err_1(mask_1[:,np.newaxis]-mag_1)
         mag_err_2 = mask.photo_err_2(mask_2[:,np.newaxis]-mag_2)
@@ -581,16 +663,72 @@ class IsochroneModel(Model):
             comp_cdf = comp_1*comp_2*cdf
          
         observable_fraction = (mass_pdf[np.newaxis]*comp_cdf).sum(axis=-1)
-        return observable_fraction[mask.mask_roi_digi[mask.roi.pixel_interior_cut]]
+        return mask.decomposition.interior(observable_fraction,frac=False)
 
     def observableFractionMMD(self, mask, distance_modulus, mass_min=0.1):
         # This can be done faster...
         logger.info('Calculating observable fraction from MMD')
 
         mmd = self.signalMMD(mask,distance_modulus)
-        obs_frac = mmd.sum(axis=-1).sum(axis=-1)[mask.mask_roi_digi[mask.roi.pixel_interior_cut]]
+        obs_frac = mask.decomposition.interior(mmd.sum(axis=-1).sum(axis=-1),frac=False)
         return obs_frac
 
+    def observableFractionTable(self, mask, distance_moduli, delta_mag=0.01, mass_min=0.1):
+        """
+        Tabulate the observable fraction (before multiplying by the
+        coverage fraction) as a function of the limiting magnitudes in
+        the two bands and the distance modulus. The selection matches
+        `observableFractionCMD`, so for a fixed isochrone and ROI the
+        observable fraction in a pixel depends only on its two
+        limiting magnitudes and the distance modulus. The table values
+        are exact at the grid nodes.
+
+        Parameters:
+        -----------
+        mask            : the mask (sets the range of limiting magnitudes)
+        distance_moduli : distance modulus grid
+        delta_mag       : spacing of the limiting magnitude grid
+        mass_min        : minimum mass [Msun]
+
+        Returns:
+        --------
+        table, maglim_1, maglim_2 : table (n_moduli x n_maglim_1 x n_maglim_2)
+            and limiting magnitude grids
+        """
+        mass_init,mass_pdf,mass_act,mag_1,mag_2 = self.sample(mass_min=mass_min,full_data_range=False)
+
+        mag = mag_1 if self.band_1_detection else mag_2
+        color = mag_1 - mag_2
+
+        # Regular grid over the (positive) limiting magnitudes, with
+        # an additional node for unobserved pixels
+        maglims = []
+        for mask_mag in mask.decomposition.maglim.T:
+            pos = mask_mag[mask_mag > 0] if (mask_mag > 0).any() else mask_mag
+            grid = np.arange(pos.min()-delta_mag,pos.max()+2*delta_mag,delta_mag)
+            if mask_mag.min() < grid[0]: grid = np.insert(grid,0,mask_mag.min())
+            maglims.append(grid)
+        maglim_1,maglim_2 = maglims
+        n_1,n_2 = len(maglim_1),len(maglim_2)
+
+        distance_moduli = np.atleast_1d(distance_moduli)
+        table = np.zeros((len(distance_moduli),n_1,n_2),dtype=np.float32)
+        for i,distance_modulus in enumerate(distance_moduli):
+            # ADW: Restrict mag and color to range of mask with sufficient solid angle
+            cmd_cut = ugali.utils.binning.take2D(mask.solid_angle_cmd,color,mag+distance_modulus,
+                                                 mask.roi.bins_color, mask.roi.bins_mag) > 0
+
+            # Index of the first limiting magnitude fainter than each sample
+            idx_1 = np.searchsorted(maglim_1,mag_1+distance_modulus,side='right')
+            idx_2 = np.searchsorted(maglim_2,mag_2+distance_modulus,side='right')
+
+            # Sum the samples brighter than both limits (cumulative histogram)
+            hist = np.bincount(idx_1*(n_2+1)+idx_2,weights=mass_pdf*cmd_cut,
+                               minlength=(n_1+1)*(n_2+1)).reshape(n_1+1,n_2+1)
+            table[i] = hist.cumsum(axis=0).cumsum(axis=1)[:n_1,:n_2]
+
+        return table, maglim_1, maglim_2
+
     observable_fraction = observableFractionCMD
     observableFraction = observable_fraction
 
@@ -601,7 +739,7 @@ class IsochroneModel(Model):
         mag_1 = mag_1+distance_modulus
         mag_2 = mag_2+distance_modulus
          
-        mask_1,mask_2 = mask.mask_roi_unique.T
+        mask_1,mask_2 = mask.decomposition.maglim.T
          
         mag_err_1 = mask.photo_err_1(mask_1[:,np.newaxis]-mag_1)
         mag_err_2 = mask.photo_err_2(mask_2[:,np.newaxis]-mag_2)
@@ -751,28 +889,57 @@ class IsochroneModel(Model):
         if distance_modulus is not None:
             self.distance_modulus = distance_modulus
 
-        # Isochrone will be binned, so might as well sample lots of points
-        mass_init,mass_pdf,mass_act,mag_1,mag_2 = self.sample(mass_steps=steps)
-
-        #logger.warning("Fudging intrinisic dispersion in isochrone.")
-        #mag_1 += np.random.normal(scale=0.02,size=len(mag_1))
-        #mag_2 += np.random.normal(scale=0.02,size=len(mag_2))
+        isochrone_pdf, bins_mag_1, bins_mag_2 = self.histogram2d_absolute(delta_mag,steps)
 
         # We cast to np.float32 to save memory
-        bins_mag_1 = np.arange(self.mod+mag_1.min() - (0.5*delta_mag),
-                               self.mod+mag_1.max() + (0.5*delta_mag),
-                               delta_mag).astype(np.float32)
-        bins_mag_2 = np.arange(self.mod+mag_2.min() - (0.5*delta_mag),
-                               self.mod+mag_2.max() + (0.5*delta_mag),
-                               delta_mag).astype(np.float32)
- 
-        # ADW: Completeness needs to go in mass_pdf here...
-        isochrone_pdf = np.histogram2d(self.mod + mag_1,
-                                       self.mod + mag_2,
-                                       bins=[bins_mag_1, bins_mag_2],
-                                       weights=mass_pdf)[0].astype(np.float32)
- 
-        return isochrone_pdf, bins_mag_1, bins_mag_2
+        bins_mag_1 = (self.mod + bins_mag_1).astype(np.float32)
+        bins_mag_2 = (self.mod + bins_mag_2).astype(np.float32)
+
+        return isochrone_pdf.copy(), bins_mag_1, bins_mag_2
+
+    def histogram2d_absolute(self,delta_mag=0.03,steps=10000):
+        """
+        Return a 2D histogram of the isochrone in absolute
+        magnitude. The bins are anchored to the isochrone, so the
+        histogram at any distance modulus is this histogram with the
+        bin edges shifted. The result is memoized; do not modify the
+        returned arrays.
+
+        Parameters:
+        -----------
+        delta_mag : magnitude bin size
+        mass_steps : number of steps to sample isochrone at
+
+        Returns:
+        --------
+        isochrone_pdf : weighted pdf of isochrone in each bin
+        bins_mag_1 : bin edges for first absolute magnitude
+        bins_mag_2 : bin edges for second absolute magnitude
+        """
+        key = self._memo_key('histogram2d',delta_mag,int(steps))
+        cached = self._memo.get(key)
+        if cached is None:
+            # Isochrone will be binned, so might as well sample lots of points
+            mass_init,mass_pdf,mass_act,mag_1,mag_2 = self.sample(mass_steps=steps)
+
+            #logger.warning("Fudging intrinisic dispersion in isochrone.")
+            #mag_1 += np.random.normal(scale=0.02,size=len(mag_1))
+            #mag_2 += np.random.normal(scale=0.02,size=len(mag_2))
+
+            bins_mag_1 = np.arange(mag_1.min() - (0.5*delta_mag),
+                                   mag_1.max() + (0.5*delta_mag),
+                                   delta_mag)
+            bins_mag_2 = np.arange(mag_2.min() - (0.5*delta_mag),
+                                   mag_2.max() + (0.5*delta_mag),
+                                   delta_mag)
+
+            # ADW: Completeness needs to go in mass_pdf here...
+            isochrone_pdf = np.histogram2d(mag_1, mag_2,
+                                           bins=[bins_mag_1, bins_mag_2],
+                                           weights=mass_pdf)[0].astype(np.float32)
+            cached = (isochrone_pdf, bins_mag_1, bins_mag_2)
+            self._memo.put(key,cached)
+        return cached
  
     def pdf_mmd(self, lon, lat, mag_1, mag_2, distance_modulus, mask, delta_mag=0.03, steps=1000):
         """
@@ -798,7 +965,7 @@ class IsochroneModel(Model):
             raise Exception(msg)
  
         idx = mask.roi.indexROI(lon,lat)
-        u_color = mmd[(mask.mask_roi_digi[idx],idx_mag_1,idx_mag_2)]
+        u_color = mmd[(mask.decomposition.digi[idx],idx_mag_1,idx_mag_2)]
  
         # Remove the bin size to convert the pdf to units of mag^-2
         u_color /= delta_mag**2
@@ -808,9 +975,300 @@ class IsochroneModel(Model):
     #import memory_profiler
     #@memory_profiler.profile
     def pdf(self, mag_1, mag_2, mag_err_1, mag_err_2, 
-            distance_modulus=None, delta_mag=0.03, steps=10000):
+            distance_modulus=None, delta_mag=0.03, steps=10000,
+            max_bytes=PDF_MAX_BYTES, mode='chunked'):
         """
         Compute isochrone probability for each catalog object.
+
+        For an array of distance moduli, the calculation is done in
+        absolute magnitude (see `histogram2d_absolute`): every
+        (modulus, object) pair is treated as an object with absolute
+        magnitude `mag - distance_modulus`, so all moduli are evaluated
+        in a single pass over the catalog. This agrees with the
+        calculation for a single modulus (which uses float32 apparent
+        magnitude bin edges) to ~1e-4.
+
+        Parameters:
+        -----------
+        mag_1 : magnitude of stars (pdf sample points) in first band
+        mag_2 : magnitude of stars (pdf sample points) in second band
+        mag_err_1 : magnitude error of stars (pdf sample points) in first band
+        mag_err_2 : magnitude error of stars (pdf sample points) in second band
+        distance_modulus : distance modulus (or array of moduli) of isochrone
+        delta_mag : magnitude binning for evaluating the pdf
+        steps : number of isochrone sample points
+        max_bytes : approximate memory budget (not used by 'dense')
+        mode : calculation mode ['chunked','separable','dense']
+
+        Returns:
+        --------
+        u_color : probability that the star belongs to the isochrone [mag^-2]
+                  (n_objects) or (n_moduli, n_objects) array
+        """
+        if distance_modulus is None: 
+            distance_modulus = self.distance_modulus
+
+        if mode == 'chunked':
+            func = self._pdf_chunked
+        elif mode == 'separable':
+            func = self._pdf_separable
+        elif mode == 'dense':
+            args = (mag_1, mag_2, mag_err_1, mag_err_2)
+            if np.ndim(distance_modulus) == 0:
+                return self.pdf_dense(*args,distance_modulus=distance_modulus,
+                                      delta_mag=delta_mag,steps=steps)
+            return np.array([self.pdf_dense(*args,distance_modulus=mod,delta_mag=delta_mag,
+                                            steps=steps) for mod in distance_modulus])
+        else:
+            msg = "Unrecognized pdf mode: %s"%mode
+            raise ValueError(msg)
+
+        scalar = (np.ndim(distance_modulus) == 0)
+        moduli = np.atleast_1d(distance_modulus).astype(float)
+
+        mag_1 = np.asarray(mag_1)
+        mag_2 = np.asarray(mag_2)
+
+        # ADW: HACK TO ADD SYSTEMATIC UNCERTAINTY (0.010 mag)
+        mag_err_1 = np.sqrt(mag_err_1**2 + 0.01**2)
+        mag_err_2 = np.sqrt(mag_err_2**2 + 0.01**2)
+
+        n_moduli, n_catalog = len(moduli), len(mag_1)
+        u_color = np.zeros((n_moduli,n_catalog),dtype=np.float32)
+
+        if scalar:
+            # Binned pdf in apparent magnitude (as in `pdf_dense`)
+            histo_pdf,bins_mag_1,bins_mag_2 = self.histogram2d(distance_modulus,delta_mag,steps)
+            offsets = np.zeros(1)
+        else:
+            # Binned pdf in absolute magnitude shared by all moduli
+            histo_pdf,bins_mag_1,bins_mag_2 = self.histogram2d_absolute(delta_mag,steps)
+            offsets = moduli
+
+        if n_catalog and histo_pdf.any():
+            # Objects per chunk (~8 arrays of 8 bytes per object and modulus)
+            size = max(int(max_bytes // (64*n_moduli)), 1)
+            for lo in range(0,n_catalog,size):
+                sl = slice(lo,lo+size)
+                shape = (n_moduli,len(mag_1[sl]))
+                abs_1 = (mag_1[sl] - offsets[:,np.newaxis]).ravel()
+                abs_2 = (mag_2[sl] - offsets[:,np.newaxis]).ravel()
+                err_1 = np.broadcast_to(mag_err_1[sl],shape).ravel()
+                err_2 = np.broadcast_to(mag_err_2[sl],shape).ravel()
+                u = func(abs_1,abs_2,err_1,err_2,histo_pdf,bins_mag_1,bins_mag_2,max_bytes)
+                # Remove the bin size to convert the pdf to units of mag^-2
+                u_color[:,sl] = (u/delta_mag**2).reshape(shape)
+
+        return u_color[0] if scalar else u_color
+
+    @staticmethod
+    def _pdf_chunked(mag_1, mag_2, mag_err_1, mag_err_2, histo_pdf,
+                     bins_mag_1, bins_mag_2, max_bytes=PDF_MAX_BYTES, nsigma=5.0):
+        """
+        Sum of the isochrone pdf over (object, bin) pairs.
+
+        Only the (object, bin) pairs that lie within `nsigma` of each
+        other are evaluated. The isochrone bins are sorted by their
+        first magnitude so that the candidate bins for each object are
+        a contiguous range found with `searchsorted`. Pairs are
+        expanded for chunks of the catalog and accumulated with
+        `bincount`, so peak memory is set by `max_bytes` rather than
+        by `n_catalog x n_isochrone_bins` (see `pdf_dense`).
+
+        Parameters:
+        -----------
+        mag_1, mag_2 : magnitudes of the objects
+        mag_err_1, mag_err_2 : magnitude errors of the objects
+        histo_pdf : binned isochrone pdf
+        bins_mag_1, bins_mag_2 : magnitude bin edges
+        max_bytes : approximate memory budget for the pair arrays
+        nsigma : number of standard deviations
+
+        Returns:
+        --------
+        u : summed pdf of each object (not divided by the bin area)
+        """
+        n_catalog = len(mag_1)
+        u = np.zeros(n_catalog,dtype=np.float64)
+
+        # Non-zero isochrone bins (row-major, so sorted by first magnitude)
+        idx_mag_1, idx_mag_2 = np.nonzero(histo_pdf)
+        isochrone_pdf = histo_pdf[idx_mag_1, idx_mag_2]
+
+        # Candidate range of bins in the first magnitude (with a small
+        # slack; the exact nsigma cut is applied to the pairs below)
+        edge_lo = bins_mag_1[idx_mag_1]
+        edge_hi = bins_mag_1[idx_mag_1+1]
+        slack = 1e-3
+        start = np.searchsorted(edge_hi, mag_1 - (nsigma+slack)*mag_err_1, side='left')
+        stop  = np.searchsorted(edge_lo, mag_1 + (nsigma+slack)*mag_err_1, side='right')
+        counts = np.clip(stop - start, 0, None)
+
+        # Objects per chunk such that the pair arrays fit within the budget
+        # (~15 arrays of 8 bytes per pair)
+        max_pairs = max(int(max_bytes // 120), 1)
+        cumsum = np.cumsum(counts)
+        splits = np.searchsorted(cumsum, np.arange(max_pairs, cumsum[-1], max_pairs),
+                                 side='right')
+        bounds = np.unique(np.concatenate([[0],splits,[n_catalog]]))
+
+        for lo,hi in zip(bounds[:-1],bounds[1:]):
+            nobj = counts[lo:hi]
+            npair = nobj.sum()
+            if npair == 0: continue
+
+            # Expand the (object, bin) pairs of this chunk
+            obj = np.repeat(np.arange(lo,hi), nobj)
+            offset = np.repeat(np.cumsum(nobj) - nobj, nobj)
+            ibin = start[obj] + (np.arange(npair) - offset)
+            del offset
+
+            i1, i2 = idx_mag_1[ibin], idx_mag_2[ibin]
+            m1, e1 = mag_1[obj], mag_err_1[obj]
+            m2, e2 = mag_2[obj], mag_err_2[obj]
+
+            # Normalized distance between object and bin edges
+            dist_mag_1_hi = (m1-bins_mag_1[i1])/e1
+            dist_mag_1_lo = (m1-bins_mag_1[i1+1])/e1
+            dist_mag_2_hi = (m2-bins_mag_2[i2])/e2
+            dist_mag_2_lo = (m2-bins_mag_2[i2+1])/e2
+
+            # Only pairs < nsigma from the data point
+            sel = (dist_mag_1_hi > -nsigma) & (dist_mag_1_lo < nsigma) \
+                & (dist_mag_2_hi > -nsigma) & (dist_mag_2_lo < nsigma)
+
+            # Delta of the normalized cdf in each band
+            pdf_mag_1 = norm_cdf(dist_mag_1_hi[sel]) - norm_cdf(dist_mag_1_lo[sel])
+            pdf_mag_2 = norm_cdf(dist_mag_2_hi[sel]) - norm_cdf(dist_mag_2_lo[sel])
+
+            weights = pdf_mag_1 * pdf_mag_2 * isochrone_pdf[ibin[sel]]
+            u[lo:hi] += np.bincount(obj[sel]-lo, weights=weights, minlength=hi-lo)
+
+        return u
+
+    @classmethod
+    def _pdf_separable(cls, mag_1, mag_2, mag_err_1, mag_err_2, histo_pdf,
+                       bins_mag_1, bins_mag_2, max_bytes=PDF_MAX_BYTES, nsigma=5.0):
+        """
+        Sum of the isochrone pdf by factorizing the error convolution
+        into the two bands.
+
+        Both the Gaussian bin probabilities and the `nsigma` cut are
+        separable in the two magnitudes, so
+
+          u[i] = sum_jk P1[i,j] * H[j,k] * P2[i,k]
+
+        where P1 (P2) holds the bin probabilities of each object over
+        the narrow window of first (second) magnitude bins that it
+        touches, and H is the (sparse) binned isochrone. The cdf is
+        evaluated once per object and band bin (rather than per
+        object and isochrone bin), and the contraction only touches
+        the occupied isochrone bins near each object.
+
+        Parameters:
+        -----------
+        mag_1, mag_2 : magnitudes of the objects
+        mag_err_1, mag_err_2 : magnitude errors of the objects
+        histo_pdf : binned isochrone pdf
+        bins_mag_1, bins_mag_2 : magnitude bin edges
+        max_bytes : approximate memory budget for the band windows
+        nsigma : number of standard deviations
+
+        Returns:
+        --------
+        u : summed pdf of each object (not divided by the bin area)
+        """
+        n_catalog = len(mag_1)
+        u = np.zeros(n_catalog,dtype=np.float64)
+
+        histo_pdf = scipy.sparse.csr_matrix(histo_pdf.astype(np.float64))
+
+        # Window of bins touched by each object in each band
+        start_1,count_1 = cls._band_window(mag_1,mag_err_1,bins_mag_1,nsigma)
+        start_2,count_2 = cls._band_window(mag_2,mag_err_2,bins_mag_2,nsigma)
+
+        # Objects per chunk such that the windows fit within the budget
+        # (~10 arrays of 8 bytes per window element)
+        max_pairs = max(int(max_bytes // 80), 1)
+        cumsum = np.cumsum(count_1 + count_2)
+        splits = np.searchsorted(cumsum, np.arange(max_pairs, cumsum[-1], max_pairs),
+                                 side='right')
+        bounds = np.unique(np.concatenate([[0],splits,[n_catalog]]))
+
+        for lo,hi in zip(bounds[:-1],bounds[1:]):
+            sl = slice(lo,hi)
+            prob_1 = cls._band_probability(mag_1[sl],mag_err_1[sl],bins_mag_1,
+                                           start_1[sl],count_1[sl],nsigma)
+            prob_2 = cls._band_probability(mag_2[sl],mag_err_2[sl],bins_mag_2,
+                                           start_2[sl],count_2[sl],nsigma)
+            # Contract with the isochrone: (P1 H) . P2
+            prod = (prob_1 @ histo_pdf).multiply(prob_2)
+            u[sl] = np.asarray(prod.sum(axis=1)).ravel()
+
+        return u
+
+    @staticmethod
+    def _band_window(mag, mag_err, bins, nsigma):
+        """
+        Range of magnitude bins that may lie within `nsigma` of each
+        object (with a small slack; the exact cut is applied in
+        `_band_probability`).
+
+        Parameters:
+        -----------
+        mag     : magnitude of the objects
+        mag_err : magnitude error of the objects
+        bins    : magnitude bin edges
+        nsigma  : number of standard deviations
+
+        Returns:
+        --------
+        start, count : index of the first bin and number of bins
+        """
+        slack = 1e-3
+        start = np.searchsorted(bins[1:], mag - (nsigma+slack)*mag_err, side='left')
+        stop  = np.searchsorted(bins[:-1], mag + (nsigma+slack)*mag_err, side='right')
+        return start, np.clip(stop - start, 0, None)
+
+    @staticmethod
+    def _band_probability(mag, mag_err, bins, start, count, nsigma):
+        """
+        Sparse matrix of the probability for each object to fall in
+        each magnitude bin of its window.
+
+        Parameters:
+        -----------
+        mag     : magnitude of the objects
+        mag_err : magnitude error of the objects
+        bins    : magnitude bin edges
+        start   : index of the first bin in the window of each object
+        count   : number of bins in the window of each object
+        nsigma  : number of standard deviations
+
+        Returns:
+        --------
+        prob    : sparse (n_objects x n_bins) probability matrix
+        """
+        npair = count.sum()
+        obj = np.repeat(np.arange(len(mag)), count)
+        offset = np.repeat(np.cumsum(count) - count, count)
+        ibin = start[obj] + (np.arange(npair) - offset)
+        del offset
+
+        m, e = mag[obj], mag_err[obj]
+        dist_hi = (m-bins[ibin])/e
+        dist_lo = (m-bins[ibin+1])/e
+        sel = (dist_hi > -nsigma) & (dist_lo < nsigma)
+
+        values = norm_cdf(dist_hi[sel]) - norm_cdf(dist_lo[sel])
+        shape = (len(mag), len(bins)-1)
+        return scipy.sparse.csr_matrix((values,(obj[sel],ibin[sel])),shape=shape)
+
+    def pdf_dense(self, mag_1, mag_2, mag_err_1, mag_err_2, 
+                  distance_modulus=None, delta_mag=0.03, steps=10000):
+        """
+        Compute isochrone probability for each catalog object using
+        dense `n_catalog x n_isochrone_bins` arrays (see `pdf`).
  
         ADW: This is a memory intensive function, so try as much as
         possible to keep array types at `float32` or smaller (maybe
@@ -847,7 +1305,7 @@ class IsochroneModel(Model):
          
         # Keep only isochrone bins that are within the magnitude
         # space of the sample
-        mag_1_mesh, mag_2_mesh = np.meshgrid(bins_mag_2[1:], bins_mag_1[1:])
+        mag_2_mesh, mag_1_mesh = np.meshgrid(bins_mag_2[1:], bins_mag_1[1:])
          
         # pdf contribution only calculated out to nsigma,
         # so padding shouldn't be necessary.
@@ -1024,6 +1482,9 @@ class Isochrone(IsochroneModel):
         self.params['age'].set_bounds([self.agrid.min(),self.agrid.max()])
         self.params['metallicity'].set_bounds([self.zgrid.min(),self.zgrid.max()])  
         self.filename = None
+        # Parsed grid nodes and interpolated isochrones
+        self._nodes = MemoryCache(MEMO_SIZE)
+        self._interp = MemoryCache(MEMO_SIZE)
         self._cache()
 
     def __str__(self,indent=0):
@@ -1122,6 +1583,10 @@ class Isochrone(IsochroneModel):
         if not hasattr(self,'tree'): return
         if name in ['distance_modulus']: return
 
+        if self.interpolate:
+            self._interpolate()
+            return
+
         filename = self.get_filename()
         if filename != self.filename:
             self.filename = filename
@@ -1134,6 +1599,171 @@ class Isochrone(IsochroneModel):
     def _parse(self,filename):
         raise Exception("Must be implemented by subclass.")
 
+    # Isochrone arrays that are interpolated between grid nodes
+    _node_fields = ['mass_init','mass_act','luminosity','mag_1','mag_2']
+
+    def _load_node(self,age,metallicity):
+        """
+        Parse the isochrone at a grid node and keep its arrays in memory.
+
+        Parameters:
+        -----------
+        age         : age of the grid node [Gyr]
+        metallicity : metallicity of the grid node
+
+        Returns:
+        --------
+        node        : dictionary of isochrone arrays
+        """
+        filename = os.path.join(self.get_dirname(),self.params2filename(age,metallicity))
+        key = (filename,self.band_1,self.band_2)
+        node = self._nodes.get(key)
+        if node is not None: return node
+
+        if not os.path.exists(filename):
+            msg = "Filename does not exist: %s"%filename
+            raise IOError(msg)
+        self._parse(filename)
+
+        node = dict([(f,np.array(getattr(self,f))) for f in self._node_fields])
+        node['stage'] = np.asarray(self.stage)
+        node['mass_init_upper_bound'] = self.mass_init_upper_bound
+        node['index'] = len(node['mass_init']) if self.index is None else self.index
+        self._nodes.put(key,node)
+        return node
+
+    @staticmethod
+    def _bracket(grid,value,log=False):
+        """
+        Grid points bracketing a value and their linear interpolation
+        weights (clipped to the grid range).
+
+        Parameters:
+        -----------
+        grid  : grid values
+        value : value to interpolate to
+        log   : interpolate in log10 of the grid values
+
+        Returns:
+        --------
+        nodes : list of (grid value, weight)
+        """
+        grid = np.unique(grid)
+        if len(grid) == 1: return [(grid[0],1.0)]
+        x,v = (np.log10(grid),np.log10(value)) if log else (grid,value)
+        hi = np.clip(np.searchsorted(x,v),1,len(x)-1)
+        lo = hi - 1
+        w = np.clip((v - x[lo])/(x[hi] - x[lo]),0,1)
+        return [(g,wt) for g,wt in [(grid[lo],1-w),(grid[hi],w)] if wt > 0]
+
+    def _interpolate(self):
+        """
+        Interpolate the isochrone to the current age and metallicity.
+
+        The isochrones at the (up to four) bracketing grid nodes are
+        matched along equivalent evolutionary points: each
+        evolutionary stage is resampled to a common number of points,
+        uniformly in the fractional position along the stage. The
+        arrays are then interpolated bilinearly (linear in age and
+        log metallicity). Nodes and interpolated isochrones are held
+        in memory, so the sampler does not read from disk after the
+        nodes have been loaded.
+        """
+        age,metallicity = float(self.age),float(self.metallicity)
+        key = (self.get_dirname(),self.band_1,self.band_2,age,metallicity)
+        interp = self._interp.get(key)
+        if interp is None:
+            nodes, weights = [], []
+            for a,wa in self._bracket(self.agrid,age):
+                for z,wz in self._bracket(self.zgrid,metallicity,log=True):
+                    nodes.append(self._load_node(a,z))
+                    weights.append(wa*wz)
+            interp = self._interpolate_nodes(nodes,weights)
+            self._interp.put(key,interp)
+
+        self.filename = self.get_filename()
+        self.data = None
+        for k,v in interp.items():
+            setattr(self,k,v)
+        self.mag = self.mag_1 if self.band_1_detection else self.mag_2
+        self.color = self.mag_1 - self.mag_2
+
+    @classmethod
+    def _interpolate_nodes(cls,nodes,weights):
+        """
+        Weighted sum of grid node isochrones matched along equivalent
+        evolutionary points (see `_interpolate`).
+
+        Parameters:
+        -----------
+        nodes   : list of node dictionaries (see `_load_node`)
+        weights : interpolation weight of each node
+
+        Returns:
+        --------
+        interp  : dictionary of interpolated isochrone arrays
+        """
+        # Stages present in all nodes (in evolutionary order)
+        stages = [s for s in ordered_unique(nodes[0]['stage'])
+                  if all((n['stage'] == s).any() for n in nodes)]
+
+        fields = cls._node_fields
+        interp = dict([(f,[]) for f in fields+['stage']])
+        for stage in stages:
+            sel = [n['stage'] == stage for n in nodes]
+            npts = max([s.sum() for s in sel])
+            t = np.linspace(0,1,npts)
+            for f in fields:
+                total = 0
+                for n,s,w in zip(nodes,sel,weights):
+                    y = n[f][s]
+                    if f == 'luminosity': y = np.log10(y)
+                    total = total + w*np.interp(t,np.linspace(0,1,len(y)),y)
+                interp[f].append(total)
+            interp['stage'].append(np.repeat(nodes[0]['stage'][sel[0]][:1],npts))
+
+        interp = dict([(k,np.concatenate(v)) for k,v in interp.items()])
+        interp['luminosity'] = 10**interp['luminosity']
+
+        # Keep the isochrone sorted by initial mass
+        order = np.argsort(interp['mass_init'],kind='mergesort')
+        interp = dict([(k,v[order]) for k,v in interp.items()])
+
+        interp['mass_init_upper_bound'] = np.sum([w*n['mass_init_upper_bound']
+                                                  for n,w in zip(nodes,weights)])
+        # Start of the post-AGB stage (if any)
+        index = len(interp['mass_init'])
+        for n in nodes:
+            if n['index'] < len(n['mass_init']):
+                stage = n['stage'][n['index']]
+                if (interp['stage'] == stage).any():
+                    index = min(index,np.argmax(interp['stage'] == stage))
+        interp['index'] = index
+        return interp
+
+    def _genfromtxt(self,filename,**kwargs):
+        """
+        Read the data of an isochrone file. If the isochrone directory
+        contains a binary archive (see `ugali.isochrone.archive`) the
+        data is sliced from the memory-mapped archive, otherwise the
+        text file is parsed with `np.genfromtxt`.
+
+        Parameters:
+        -----------
+        filename : isochrone filename
+        kwargs   : passed to `np.genfromtxt`
+
+        Returns:
+        --------
+        data     : structured array of isochrone data
+        """
+        dirname = os.path.dirname(filename)
+        archive = IsochroneArchive.open(os.path.join(dirname,ARCHIVE))
+        if archive is not None:
+            data = archive.get(os.path.basename(filename),kwargs)
+            if data is not None: return data
+        return np.genfromtxt(filename,**kwargs)
+
     def print_info(self,age,metallicity):
         params = dict(age=age,z=metallicity)
         params['name'] = self.__class__.__name__
@@ -425,7 +425,7 @@ class Bressan2012(ParsecIsochrone):
         # ADW: This should be updated, but be careful of column numbering
         kwargs = dict(delimiter='\t',usecols=list(columns.keys()),
                       dtype=list(columns.values()))
-        self.data = np.genfromtxt(filename,**kwargs)
+        self.data = self._genfromtxt(filename,**kwargs)
 
         self.mass_init = self.data['mass_init']
         self.mass_act  = self.data['mass_act']
@@ -530,7 +530,7 @@ class Marigo2017(ParsecIsochrone):
             raise(e)
 
         kwargs = dict(usecols=list(columns.keys()),dtype=list(columns.values()))
-        self.data = np.genfromtxt(filename,**kwargs)
+        self.data = self._genfromtxt(filename,**kwargs)
         # cut out anomalous point:
         # https://github.com/DarkEnergySurvey/ugali/issues/29
         self.data = self.data[~np.in1d(self.data['stage'], [9])]
@@ -1,7 +1,10 @@
 """
 Classes which manage object catalogs live here.
 """
+import re
+
 import numpy as np
+import scipy.spatial
 import fitsio
 import copy
 
@@ -9,43 +12,97 @@ import ugali.utils.projector
 
 from ugali.utils.config import Config
 from ugali.utils.projector import gal2cel,cel2gal
-from ugali.utils.healpix import ang2pix,superpixel
+from ugali.utils.healpix import ang2pix,ang2vec,superpixel
 from ugali.utils.logger import logger
-from ugali.utils.fileio import load_infiles
+from ugali.utils.fileio import load_infiles, load_column_stores
+from ugali.utils.fileio import column_store_path, column_store_names
 from ugali.utils import mlab
 
 class Catalog:
 
-    def __init__(self, config, roi=None, data=None, filenames=None):
+    def __init__(self, config, roi=None, data=None, filenames=None,
+                 parent=None, index=None):
         """
         Class to store information about detected objects. This class
         augments the raw data array with several aliases and derived
         quantities.
 
+        A catalog can also be a view of a `parent` catalog through an
+        `index` array (see `applyCut`). Columns of a view are taken
+        from the parent when first accessed and cached; the parent
+        should not be modified while views of it are in use.
+
         Parameters:
         -----------
         config    : Configuration object
         roi       : Region of Interest to load catalog data for
         data      : Data array object
         filenames : FITS filenames to read catalog from
+        parent    : Catalog that this catalog is a view of
+        index     : Indices of the objects of the parent catalog
 
         Returns:
         --------
         catalog   : The Catalog object
         """
-        self.config = Config(config)
-
-        if data is None:
-            self._parse(roi,filenames)
+        self._data = None
+        self._parent = None
+        self._index = None
+        self._columns = dict()
+
+        if parent is not None:
+            # Views share the configuration of the parent
+            self.config = parent.config
+            self._parent = parent
+            self._index = np.asarray(index)
         else:
-            self.data = data
+            self.config = Config(config)
+            if data is None:
+                self._parse(roi,filenames)
+            else:
+                self.data = data
 
         self._defineVariables()
 
+    @property
+    def data(self):
+        """ Data array (materialized from the parent for views). """
+        if self._data is None and self._parent is not None:
+            self._data = self._parent.data[self._index]
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Setting the data detaches a view from its parent
+        self._data = data
+        self._parent = None
+        self._index = None
+        self._columns = dict()
+
+    @property
+    def is_view(self):
+        """ Catalog is an (unmaterialized) view of a parent catalog. """
+        return self._data is None and self._parent is not None
+
+    def _column(self, name):
+        """ Column of the catalog data (cached for views). """
+        if not self.is_view:
+            return self.data[name]
+        if name not in self._columns:
+            self._columns[name] = self._parent._column(name)[self._index]
+        return self._columns[name]
+
+    @property
+    def names(self):
+        """ Names of the data columns. """
+        if self.is_view: return self._parent.names
+        return self.data.dtype.names
+
     def __add__(self, other):
         return mergeCatalogs([self,other])
 
     def __len__(self):
+        if self.is_view: return len(self._index)
         return len(self.objid)
 
     def __eq__(self, other):
@@ -57,8 +114,11 @@ class Catalog:
         using the input cut array.
 
         NOTE: This is really a *selection* (i.e., objects are retained if the value of 'cut' is True)
+
+        The new catalog is a view of this catalog (see `Catalog`).
         """
-        return Catalog(self.config, data=self.data[cut])
+        index = np.arange(len(self))[cut]
+        return Catalog(self.config, parent=self, index=index)
 
     def bootstrap(self, mc_bit=0x10, seed=None):
         """
@@ -90,6 +150,13 @@ class Catalog:
         else:
             self.projector = projector
 
+        # Share the projection with the parent catalog
+        parent = self._parent
+        if (parent is not None and getattr(parent,'projector',None) is self.projector
+            and hasattr(parent,'x')):
+            self.x, self.y = parent.x[self._index], parent.y[self._index]
+            return
+
         self.x, self.y = self.projector.sphereToImage(self.lon, self.lat)
 
     def spatialBin(self, roi):
@@ -100,13 +167,53 @@ class Catalog:
             logger.warning('Catalog alread spatially binned')
             return
 
+        # Share the binning with the parent catalog
+        parent = self._parent
+        if parent is not None and getattr(parent,'_binned_roi',None) is roi:
+            self.pixel = parent.pixel[self._index]
+            self.pixel_roi_index = parent.pixel_roi_index[self._index]
+            self._binned_roi = roi
+            return
+
         # ADW: Not safe to set index = -1 (since it will access last entry); 
         # np.inf would be better...
         self.pixel = ang2pix(self.config['coords']['nside_pixel'],self.lon,self.lat)
         self.pixel_roi_index = roi.indexROI(self.lon,self.lat)
+        self._binned_roi = roi
 
         logger.info("Found %i objects outside ROI"%(self.pixel_roi_index < 0).sum())
 
+    @property
+    def kdtree(self):
+        """
+        KD-tree on the unit vectors of the catalog objects (built on
+        first access).
+        """
+        if getattr(self,'_kdtree',None) is None:
+            vec = ang2vec(self.lon,self.lat).reshape(-1,3)
+            self._kdtree = scipy.spatial.cKDTree(vec)
+        return self._kdtree
+
+    def query_disc(self, lon, lat, radius):
+        """
+        Find the objects within an angular radius of a position.
+
+        Parameters:
+        -----------
+        lon    : longitude of the center (deg)
+        lat    : latitude of the center (deg)
+        radius : angular radius (deg)
+
+        Returns:
+        --------
+        idx    : sorted indices of objects within the radius
+        """
+        vec = ang2vec(lon,lat)
+        # Chord length on the unit sphere
+        chord = 2.*np.sin(np.radians(min(radius,180.))/2.)
+        idx = self.kdtree.query_ball_point(vec,chord)
+        return np.sort(np.asarray(idx,dtype=int))
+
     def write(self, outfile, clobber=True, **kwargs):
         """
         Write the current object catalog to FITS file.
@@ -151,15 +258,63 @@ class Catalog:
             msg = "No catalog files found."
             raise Exception(msg)
 
-        # Load the data
-        self.data = load_infiles(filenames)
-
-        # Apply a selection cut
-        self._applySelection()
+        # Apply the selection cut file by file while loading
+        selection = self.config['catalog'].get('selection')
+        if selection:
+            logger.info('Evaluating selection: \n"%s"'%selection)
+            selection = Selection(selection)
+        else:
+            selection = None
+
+        # Load the data (only the required columns)
+        store = self.config['catalog'].get('store','fits')
+        if store == 'npy':
+            # Memory-mapped columnar store (see `pixelize.pixelizeColumns`)
+            dirnames = [column_store_path(f) for f in filenames]
+            names = column_store_names(dirnames[0])
+            columns = self._getColumns(names,selection)
+            self.data = load_column_stores(dirnames,columns=columns,selection=selection)
+        elif store == 'fits':
+            with fitsio.FITS(filenames[0]) as fits:
+                names = fits[1].get_colnames()
+            columns = self._getColumns(names,selection)
+            self.data = load_infiles(filenames,columns=columns,selection=selection)
+        else:
+            msg = "Unrecognized catalog store: %s"%store
+            raise ValueError(msg)
 
         # Cast data to recarray (historical reasons)
         self.data = self.data.view(np.recarray)
 
+    def _getColumns(self, names, selection=None):
+        """
+        Columns to read from the catalog files: the fields set in the
+        configuration, the columns used by the selection and any
+        additional 'columns' (all columns if 'all').
+
+        Parameters:
+        -----------
+        names     : columns available in the catalog files
+        selection : Selection object
+
+        Returns:
+        --------
+        columns   : list of columns (or None for all columns)
+        """
+        extra = self.config['catalog'].get('columns',[])
+        if extra == 'all': return None
+
+        fields = ['objid_field','lon_field','lat_field',
+                  'mag_1_field','mag_err_1_field',
+                  'mag_2_field','mag_err_2_field',
+                  'mc_source_id_field']
+        required = [self.config['catalog'].get(f) for f in fields]
+        required += list(np.atleast_1d(extra if extra else []))
+        if selection is not None: required += selection.columns
+
+        # Keep the file order (missing columns are handled later)
+        return [n for n in names if n in required]
+
     def _applySelection(self,selection=None):
         # ADW: This is a hack (eval is unsafe!)
         if selection is None:
@@ -167,12 +322,9 @@ class Catalog:
 
         if not selection: 
             return
-        elif 'self.data' not in selection:
-            msg = "Selection does not contain 'data'"
-            raise Exception(msg)
         else:
             logger.info('Evaluating selection: \n"%s"'%selection)
-            sel = eval(selection)
+            sel = Selection(selection)(self.data)
             self.data = self.data[sel]
         
     def _defineVariables(self):
@@ -181,11 +333,11 @@ class Catalog:
 
         ADW (20170627): This has largely been replaced by properties.
         """
-        logger.info('Catalog contains %i objects'%(len(self.data)))
+        logger.info('Catalog contains %i objects'%(len(self)))
 
         mc_source_id_field = self.config['catalog']['mc_source_id_field']
         if mc_source_id_field is not None:
-            if mc_source_id_field not in self.data.dtype.names:
+            if mc_source_id_field not in self.names:
                 array = np.zeros(len(self.data),dtype='>i8') # FITS byte-order convention
                 self.data = mlab.rec_append_fields(self.data,
                                                    names=mc_source_id_field,
@@ -194,26 +346,26 @@ class Catalog:
 
     # Use properties to avoid duplicating the data
     @property
-    def objid(self): return self.data[self.config['catalog']['objid_field']]
+    def objid(self): return self._column(self.config['catalog']['objid_field'])
     @property
-    def lon(self): return self.data[self.config['catalog']['lon_field']]
+    def lon(self): return self._column(self.config['catalog']['lon_field'])
     @property 
-    def lat(self): return self.data[self.config['catalog']['lat_field']]
+    def lat(self): return self._column(self.config['catalog']['lat_field'])
     @property
     def coordsys(self): 
         return self.config['coords']['coordsys'].lower()
 
     @property
-    def mag_1(self): return self.data[self.config['catalog']['mag_1_field']]
+    def mag_1(self): return self._column(self.config['catalog']['mag_1_field'])
     @property
     def mag_err_1(self):
-        return self.data[self.config['catalog']['mag_err_1_field']]
+        return self._column(self.config['catalog']['mag_err_1_field'])
     @property
     def mag_2(self):
-        return self.data[self.config['catalog']['mag_2_field']]
+        return self._column(self.config['catalog']['mag_2_field'])
     @property
     def mag_err_2(self):
-        return self.data[self.config['catalog']['mag_err_2_field']]
+        return self._column(self.config['catalog']['mag_err_2_field'])
     @property 
     def mag(self):
         if self.config['catalog']['band_1_detection']: return self.mag_1
@@ -228,7 +380,7 @@ class Catalog:
     def color_err(self): return np.sqrt(self.mag_err_1**2 + self.mag_err_2**2)
     @property
     def mc_source_id(self):
-        return self.data[self.config['catalog']['mc_source_id_field']]
+        return self._column(self.config['catalog']['mc_source_id_field'])
 
     # This assumes Galactic coordinates
     @property
@@ -251,6 +403,42 @@ class Catalog:
 
 ############################################################
 
+class Selection(object):
+    """
+    Compiled catalog selection expression, e.g., 
+
+      "(np.abs(self.data['WAVG_SPREAD_MODEL_I']) < 0.003)"
+
+    The expression is evaluated with `self.data` bound to the data
+    passed to the selection, so it can be applied to each file as it
+    is read.
+    """
+    # ADW: This is a hack (eval is unsafe!)
+
+    def __init__(self, expression):
+        if 'self.data' not in expression:
+            msg = "Selection does not contain 'data'"
+            raise Exception(msg)
+        self.expression = expression
+        self.columns = re.findall(r"data\[\s*['\"]([^'\"]+)['\"]\s*\]",expression)
+        self._code = compile(expression,'<selection>','eval')
+
+    def __call__(self, data):
+        """ Boolean selection of the rows of data. """
+        return eval(self._code,globals(),dict(self=_SelectionData(data)))
+
+    def __getstate__(self):
+        return dict(expression=self.expression)
+
+    def __setstate__(self, state):
+        self.__init__(state['expression'])
+
+class _SelectionData(object):
+    """ Stand-in for the catalog in selection expressions. """
+    def __init__(self, data): self.data = data
+
+############################################################
+
 def mergeCatalogs(catalog_list):
     """
     Merge a list of Catalogs.
@@ -9,6 +9,8 @@ Functions
 """
 
 import os
+from collections import OrderedDict as odict
+
 import numpy as np
 import healpy as hp
 import scipy.signal
@@ -50,40 +52,45 @@ class Mask(object):
 
         self._photometricErrors()
 
+    @property
+    def decomposition(self):
+        """
+        Quantized representation of the ROI mask (see
+        `MaskDecomposition`). It is calculated once and recalculated
+        only when the `mask_roi_sparse` (or `frac_roi_sparse`) arrays
+        are replaced.
+        """
+        arrays = (self.mask_1.mask_roi_sparse,self.mask_2.mask_roi_sparse,
+                  self.frac_roi_sparse)
+        cached = getattr(self,'_decomposition',None)
+        if cached is None or not cached.matches(*arrays):
+            self._decomposition = MaskDecomposition(*arrays,roi=self.roi)
+        return self._decomposition
+
     @property
     def mask_roi_unique(self):
         """
         Assemble a set of unique magnitude tuples for the ROI
         """
-        # There is no good inherent way in numpy to do this...
-        # http://stackoverflow.com/q/16970982/
-
-        # Also possible and simple:
-        #return np.unique(zip(self.mask_1.mask_roi_sparse,self.mask_2.mask_roi_sparse))
-
-        A = np.vstack([self.mask_1.mask_roi_sparse,self.mask_2.mask_roi_sparse]).T
-        B = A[np.lexsort(A.T[::-1])]
-        return B[np.concatenate(([True],np.any(B[1:]!=B[:-1],axis=1)))]
+        return self.decomposition.maglim
 
     @property
     def mask_roi_digi(self):
         """
         Get the index of the unique magnitude tuple for each pixel in the ROI.
         """
-        # http://stackoverflow.com/q/24205045/#24206440
-        A = np.vstack([self.mask_1.mask_roi_sparse,self.mask_2.mask_roi_sparse]).T
-        B = self.mask_roi_unique
-
-        AA = np.ascontiguousarray(A)
-        BB = np.ascontiguousarray(B)
-         
-        dt = np.dtype((np.void, AA.dtype.itemsize * AA.shape[1]))
-        a = AA.view(dt).ravel()
-        b = BB.view(dt).ravel()
-         
-        idx = np.argsort(b)
-        indices = np.searchsorted(b[idx],a)
-        return idx[indices]
+        return self.decomposition.digi
+
+    @property
+    def maglim_map(self):
+        """
+        Sparse map of the magnitude limits ('MAGLIM_1','MAGLIM_2') of
+        the ROI pixels for looking up arbitrary pixels.
+        """
+        values = odict([('MAGLIM_1',self.mask_1.mask_roi_sparse),
+                        ('MAGLIM_2',self.mask_2.mask_roi_sparse)])
+        return healpix.SparseHealpixMap(self.roi.config['coords']['nside_pixel'],
+                                        self.roi.pixels,values)
 
     @property
     def frac_annulus_sparse(self):
@@ -701,6 +708,75 @@ class Mask(object):
 
 ############################################################
 
+class MaskDecomposition(object):
+    """
+    Compact quantized representation of the ROI mask. Each ROI pixel
+    is described by one of a small set of unique (maglim_1, maglim_2,
+    frac) tuples, so quantities that depend only on the limiting
+    magnitudes can be calculated once per unique magnitude pair and
+    expanded to the pixels.
+
+    The mask arrays are treated as immutable; modify them by
+    assigning new arrays (as `Mask._pruneCMD` does).
+    """
+
+    def __init__(self, maglim_1, maglim_2, frac, roi):
+        """
+        Parameters:
+        -----------
+        maglim_1 : limiting magnitude of each ROI pixel in the first band
+        maglim_2 : limiting magnitude of each ROI pixel in the second band
+        frac     : coverage fraction of each ROI pixel
+        roi      : roi object
+
+        Returns:
+        --------
+        decomposition : MaskDecomposition object
+        """
+        self.arrays = (maglim_1, maglim_2, frac)
+
+        # Unique (maglim_1, maglim_2, frac) tuples and the tuple of each pixel
+        A = np.vstack([maglim_1,maglim_2,frac]).T
+        self.tuples,index = np.unique(A,axis=0,return_inverse=True)
+        self.index = index.reshape(-1)
+        self.index_interior = self.index[roi.pixel_interior_cut]
+        self.index_annulus = self.index[roi.pixel_annulus_cut]
+
+        # Unique (maglim_1, maglim_2) pairs and the pair of each tuple
+        dtype = np.result_type(maglim_1,maglim_2)
+        maglim,maglim_index = np.unique(self.tuples[:,:2],axis=0,return_inverse=True)
+        self.maglim = maglim.astype(dtype)
+        self.maglim_index = maglim_index.reshape(-1)
+
+        # Magnitude pair of each pixel
+        self.digi = self.maglim_index[self.index]
+        self.digi_interior = self.digi[roi.pixel_interior_cut]
+        self.frac_interior = self.tuples[self.index_interior,2]
+
+    def matches(self, maglim_1, maglim_2, frac):
+        """ Check whether the decomposition was built from these arrays. """
+        return all(a is b for a,b in zip(self.arrays,(maglim_1,maglim_2,frac)))
+
+    def interior(self, values, frac=True):
+        """
+        Expand values calculated for each unique magnitude pair to
+        the interior pixels of the ROI.
+
+        Parameters:
+        -----------
+        values : array with last axis over the unique magnitude pairs
+        frac   : multiply by the coverage fraction
+
+        Returns:
+        --------
+        values : array with last axis over the interior pixels
+        """
+        values = np.asarray(values)[...,self.digi_interior]
+        if frac: values = values * self.frac_interior
+        return values
+
+############################################################
+
 class MaskBand(object):
     """
     Map of liming magnitude for a single observing band.
@@ -720,20 +796,28 @@ class MaskBand(object):
         self.roi = roi
         self.config = self.roi.config
 
-        # ADW: It's overkill to make the full map just to slim it
-        # down, but we don't have a great way to go from map pixels to
-        # roi pixels.
-        nside,pixel,maglim = healpix.read_partial_map(infiles,column='MAGLIM')
+        # Look up the roi pixels directly (rather than building the
+        # fullsky map) and read both columns in one pass
+        try: 
+            logger.debug("Reading MAGLIM and FRACDET...")
+            nside,pixel,data = healpix.read_partial_map(infiles,['MAGLIM','FRACDET'],
+                                                        pixels=self.roi.pixels)
+            maglim,frac = np.array(data['MAGLIM']),np.array(data['FRACDET'])
+        except ValueError as e:
+            # No detection fraction present
+            msg = "No 'FRACDET' column found in masks; assuming FRACDET = 1.0"
+            logger.warn(msg)
+            nside,pixel,maglim = healpix.read_partial_map(infiles,'MAGLIM',
+                                                          pixels=self.roi.pixels)
+            frac = None
         self.nside = nside
 
         # Sparse maps of pixels in various ROI regions
-        self.mask_roi_sparse = maglim[self.roi.pixels] 
+        self.mask_roi_sparse = maglim
 
         # Try to get the detection fraction
         self.frac_roi_sparse = (self.mask_roi_sparse > 0)
-        try: 
-            logger.debug("Reading FRACDET...")
-            nside,pixel,frac=healpix.read_partial_map(infiles,column='FRACDET')
+        if frac is not None:
             # This clipping might gloss over bugs...
             fractype = self.config['mask'].get('fractype','binary')
             fracmin = self.config['mask'].get('fracmin',0.5)
@@ -747,11 +831,7 @@ class MaskBand(object):
                 msg = "Unrecognized fractype: %s"%fractype
                 logger.warn(msg)
                 
-            self.frac_roi_sparse = np.clip(frac[self.roi.pixels],0.0,1.0)
-        except ValueError as e:
-            # No detection fraction present
-            msg = "No 'FRACDET' column found in masks; assuming FRACDET = 1.0"
-            logger.warn(msg)
+            self.frac_roi_sparse = np.clip(frac,0.0,1.0)
 
         # Explicitly zero the maglim of pixels with fracdet < fracmin
         self.mask_roi_sparse[self.frac_roi_sparse == 0] = 0.0
@@ -840,6 +920,7 @@ class SimpleMask(Mask):
 
         self.mask_1 = SimpleMaskBand(maglim_1,self.roi)
         self.mask_2 = SimpleMaskBand(maglim_2,self.roi)
+        self._fracRoiSparse()
         
         self.minimum_solid_angle = self.config.params['mask']['minimum_solid_angle'] # deg^2
 
@@ -864,9 +945,9 @@ class SimpleMaskBand(MaskBand):
         Infile is a sparse HEALPix map fits file.
         """
         self.roi = roi
-        mask = maglim*np.ones(hp.nside2npix(self.roi.config['coords']['nside_pixel']))
-        self.nside = hp.npix2nside(len(mask))
+        self.nside = self.roi.config['coords']['nside_pixel']
         # Sparse maps of pixels in various ROI regions
-        self.mask_roi_sparse = mask[self.roi.pixels] 
+        self.mask_roi_sparse = maglim*np.ones(len(self.roi.pixels))
+        self.frac_roi_sparse = (self.mask_roi_sparse > 0).astype(float)
 
 ############################################################
@@ -11,7 +11,7 @@ import ugali.preprocess.maglims
 
 from ugali.utils.logger import logger
 
-components = ['pixelize','density','maglims','simple','split']
+components = ['pixelize','columns','density','maglims','simple','split']
 defaults = ['pixelize','density','simple']
 
 def run(self):
@@ -25,6 +25,10 @@ def run(self):
         rawdir = self.config['data']['dirname']
         rawfiles = sorted(glob.glob(os.path.join(rawdir,'*.fits')))
         x = ugali.preprocess.pixelize.pixelizeCatalog(rawfiles,self.config)
+    if 'columns' in self.opts.run:
+        # Write memory-mapped columnar catalog stores
+        logger.info("Running 'columns'...")
+        x = ugali.preprocess.pixelize.pixelizeColumns(self.config,force=self.opts.force)
     if 'density' in self.opts.run:
         # Calculate magnitude limits
         logger.info("Running 'density'...")
@@ -47,7 +47,7 @@ def run(self):
                 logger.warning("  Found %s; skipping..."%outfile)
             else:
                 healpix.merge_partial_maps(infiles[superpixel == pix],
-                                           outfile,multiproc=8)
+                                           outfile,threads=8)
 
         if exists(roifile) and not self.opts.force:
             logger.warning("  Found %s; skipping..."%roifile)
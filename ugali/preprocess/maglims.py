@@ -19,8 +19,10 @@ from scipy.optimize import brentq
 
 import ugali.utils.skymap
 import ugali.utils.binning
+import ugali.utils.fileio
 from ugali.utils.projector import cel2gal, gal2cel
 from ugali.utils.healpix import ang2pix, pix2ang, superpixel, read_map
+from ugali.utils.healpix import lookup_partial_map
 from ugali.utils.shell import mkdir
 from ugali.utils.logger import logger
 from ugali.utils.config import Config
@@ -199,6 +201,10 @@ def inFootprint(footprint,ra,dec):
     try:
         if isinstance(footprint,str) and os.path.exists(footprint):
             filename = footprint
+            hdr = fitsio.read_header(filename,ext=1)
+            if hdr.get('INDXSCHM','').strip() == 'EXPLICIT':
+                # Only read the pixels containing the coordinates
+                return inPartialFootprint(filename,ra,dec)
             #footprint = hp.read_map(filename,verbose=False)
             #footprint = fitsio.read(filename)['I'].ravel()
             footprint = read_map(filename)
@@ -210,6 +216,28 @@ def inFootprint(footprint,ra,dec):
         inside = inMangle(filename,ra,dec)
     return inside
 
+def inPartialFootprint(filename,ra,dec):
+    """
+    Check if set of ra,dec combinations are in a partial healpix
+    footprint, reading only the rows of the pixels that contain the
+    coordinates.
+
+    filename : partial healpix map (pixel column followed by value column)
+    ra,dec   : Celestial coordinates
+
+    Returns:
+    inside   : boolean array of coordinates in footprint
+    """
+    hdr = fitsio.read_header(filename,ext=1)
+    nest = (hdr.get('ORDERING','RING').strip() == 'NEST')
+    pix = ang2pix(hdr['NSIDE'],ra,dec,nest=nest)
+
+    with fitsio.FITS(filename) as fits:
+        pixcol,column = fits[1].get_colnames()[:2]
+    data = ugali.utils.fileio.read_pixels(filename,pix,column=pixcol,columns=[pixcol,column])
+    value = lookup_partial_map(data[pixcol],data[column],pix)
+    return (value > 0)
+
 def inMangle(polyfile,ra,dec):
     coords = tempfile.NamedTemporaryFile(suffix='.txt',delete=False)
     logger.debug("Writing coordinates to %s"%coords.name)
@@ -50,6 +50,8 @@ def pixelizeCatalog(infiles, config, force=False):
 
     # ADW: It would probably be better (and more efficient) to do the
     # pixelizing and the new column insertion separately.
+    outfiles = set()
+    pix_pix_name = 'PIX%i'%nside_pixel
     for i,filename in enumerate(infiles):
         logger.info('(%i/%i) %s'%(i+1, len(infiles), filename))
         data = fitsio.read(filename)
@@ -111,6 +113,46 @@ def pixelizeCatalog(infiles, config, force=False):
 
             logger.debug("Writing %s"%outfile)
             out.close()
+            outfiles.add(outfile)
+
+    # Sort the rows of each file by pixel and index the pixel ranges
+    for outfile in sorted(outfiles):
+        logger.debug("Sorting %s"%outfile)
+        data,hdr = fitsio.read(outfile,header=True)
+        data = data[np.argsort(data[pix_pix_name],kind='stable')]
+        header = [dict(name=k,value=hdr[k],comment=hdr.get_comment(k)) 
+                  for k in ['PIXTYPE','ORDERING','NSIDE','COORDSYS','PIX'] if k in hdr]
+        fitsio.write(outfile,data,header=header,clobber=True)
+        ugali.utils.fileio.write_pixel_index(outfile,data[pix_pix_name],column=pix_pix_name)
+
+    if config['catalog'].get('store','fits') == 'npy':
+        pixelizeColumns(config,outfiles=sorted(outfiles),force=True)
+
+def pixelizeColumns(config, outfiles=None, force=False):
+    """
+    Write a memory-mappable columnar store (one native-endian .npy
+    file per column) next to each pixelized catalog file.
+
+    Parameters:
+    -----------
+    config   : Configuration file
+    outfiles : catalog files to convert (default: all existing)
+    force    : overwrite existing stores
+    
+    Returns:
+    --------
+    None
+    """
+    if outfiles is None:
+        outfiles = config.getFilenames()['catalog'].compressed()
+
+    for i,outfile in enumerate(outfiles):
+        dirname = ugali.utils.fileio.column_store_path(outfile)
+        if os.path.exists(dirname) and not force:
+            logger.info("Found %s; skipping..."%dirname)
+            continue
+        logger.info('(%i/%i) Writing %s'%(i+1, len(outfiles), dirname))
+        ugali.utils.fileio.write_column_store(dirname,fitsio.read(outfile))
 
 def pixelizeDensity(config, nside=None, force=False):
     if nside is None: 
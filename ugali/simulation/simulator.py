@@ -374,13 +374,9 @@ class Simulator(object):
 
         mag_2 = mag_1 - color
 
-        # There is probably a better way to do this step without creating the full HEALPix map
-        mask = -1. * np.ones(hp.nside2npix(self.nside_pixel))
-        mask[self.roi.pixels] = self.mask.mask_1.mask_roi_sparse
-        mag_lim_1 = mask[pix]
-        mask = -1. * np.ones(hp.nside2npix(self.nside_pixel))
-        mask[self.roi.pixels] = self.mask.mask_2.mask_roi_sparse
-        mag_lim_2 = mask[pix]
+        # Look up the magnitude limits without creating the full HEALPix map
+        maglim = self.mask.maglim_map.lookup(pix,fill_value=-1.)
+        mag_lim_1,mag_lim_2 = maglim['MAGLIM_1'],maglim['MAGLIM_2']
         
         #mag_err_1 = 1.0*np.ones(len(pix))
         #mag_err_2 = 1.0*np.ones(len(pix))
@@ -462,13 +458,9 @@ class Simulator(object):
         nside_pixel = self.nside_pixel
         pix = ang2pix(nside_pixel, lon, lat)
 
-        # There is probably a better way to do this step without creating the full HEALPix map
-        mask = -1. * np.ones(hp.nside2npix(nside_pixel))
-        mask[self.roi.pixels] = self.mask.mask_1.mask_roi_sparse
-        mag_lim_1 = mask[pix]
-        mask = -1. * np.ones(hp.nside2npix(nside_pixel))
-        mask[self.roi.pixels] = self.mask.mask_2.mask_roi_sparse
-        mag_lim_2 = mask[pix]
+        # Look up the magnitude limits without creating the full HEALPix map
+        maglim = self.mask.maglim_map.lookup(pix,fill_value=-1.)
+        mag_lim_1,mag_lim_2 = maglim['MAGLIM_1'],maglim['MAGLIM_2']
 
         mag_err_1 = self.photo_err_1(mag_lim_1 - mag_1)
         mag_err_2 = self.photo_err_2(mag_lim_2 - mag_2)
@@ -510,13 +502,9 @@ class Simulator(object):
         logger.info("Simulating %i satellite stars..."%len(mag_1))
         pix = ang2pix(self.config['coords']['nside_pixel'], lon, lat)
 
-        # There is probably a better way to do this step without creating the full HEALPix map
-        mask = -1. * np.ones(hp.nside2npix(self.config['coords']['nside_pixel']))
-        mask[self.roi.pixels] = self.mask.mask_1.mask_roi_sparse
-        mag_lim_1 = mask[pix]
-        mask = -1. * np.ones(hp.nside2npix(self.config['coords']['nside_pixel']))
-        mask[self.roi.pixels] = self.mask.mask_2.mask_roi_sparse
-        mag_lim_2 = mask[pix]
+        # Look up the magnitude limits without creating the full HEALPix map
+        maglim = self.mask.maglim_map.lookup(pix,fill_value=-1.)
+        mag_lim_1,mag_lim_2 = maglim['MAGLIM_1'],maglim['MAGLIM_2']
 
         mag_err_1 = self.photo_err_1(mag_lim_1 - mag_1)
         mag_err_2 = self.photo_err_2(mag_lim_2 - mag_2)
@@ -562,13 +550,9 @@ class Simulator(object):
         logger.info("Simulating %i satellite stars..."%len(mag_1))
         pix = ang2pix(self.config['coords']['nside_pixel'], lon, lat)
 
-        # There is probably a better way to do this step without creating the full HEALPix map
-        mask = -1. * np.ones(hp.nside2npix(self.config['coords']['nside_pixel']))
-        mask[self.roi.pixels] = self.mask.mask_1.mask_roi_sparse
-        mag_lim_1 = mask[pix]
-        mask = -1. * np.ones(hp.nside2npix(self.config['coords']['nside_pixel']))
-        mask[self.roi.pixels] = self.mask.mask_2.mask_roi_sparse
-        mag_lim_2 = mask[pix]
+        # Look up the magnitude limits without creating the full HEALPix map
+        maglim = self.mask.maglim_map.lookup(pix,fill_value=-1.)
+        mag_lim_1,mag_lim_2 = maglim['MAGLIM_1'],maglim['MAGLIM_2']
 
         mag_err_1 = self.mask.photo_err_1(mag_lim_1 - mag_1)
         mag_err_2 = self.mask.photo_err_2(mag_lim_2 - mag_2)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+In-memory and persistent on-disk caches of numpy arrays.
+"""
+__author__ = "Alex Drlica-Wagner"
+
+import os
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict as odict
+
+import numpy as np
+
+from ugali.utils.shell import mkdir
+from ugali.utils.logger import logger
+
+def freeze(obj):
+    """ Convert a (nested) model dictionary into plain python values
+    with a stable `repr` (e.g., `Parameter` objects to their value).
+
+    Parameters:
+    -----------
+    obj : dict, list, Parameter, or value
+
+    Returns:
+    --------
+    frozen : nested tuples of plain values
+    """
+    if isinstance(obj,dict):
+        return tuple((k,freeze(v)) for k,v in obj.items())
+    if isinstance(obj,(list,tuple)):
+        return tuple(freeze(v) for v in obj)
+    if hasattr(obj,'value'):
+        return freeze(obj.value)
+    if isinstance(obj,np.ndarray):
+        return tuple(obj.tolist())
+    if isinstance(obj,np.generic):
+        return obj.item()
+    return obj
+
+def hash_args(*args):
+    """ Create a hex digest from a set of arrays and/or python objects.
+
+    Parameters:
+    -----------
+    args : arrays or objects with a stable `repr`
+
+    Returns:
+    --------
+    digest : hexadecimal hash string
+    """
+    sha = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg,np.ndarray):
+            arr = np.ascontiguousarray(arg)
+            sha.update(str((arr.dtype.str,arr.shape)).encode())
+            sha.update(arr.view(np.uint8).ravel() if arr.size else b'')
+        else:
+            sha.update(repr(arg).encode())
+    return sha.hexdigest()
+
+class MemoryCache(object):
+    """
+    Least recently used cache held in memory. Values are stored as
+    given, so callers should copy mutable values that they intend to
+    modify.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = odict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """ Return the value stored under a key (or None). """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        # Move to the most recently used position
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        """ Store a value, evicting the least recently used entries. """
+        self._data.pop(key,None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+class DiskCache(object):
+    """
+    Size-bounded least recently used cache of numpy arrays. Each entry
+    is a directory holding one '.npy' file per array. Arrays are
+    returned as read-only memory maps. Entries are written to a
+    temporary directory and renamed into place, so several processes
+    can share the same cache directory.
+    """
+
+    def __init__(self, dirname, max_bytes=10*1024**3, dtype='f4'):
+        self.dirname = mkdir(os.path.expandvars(dirname))
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+
+    def path(self, key):
+        return os.path.join(self.dirname,key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self.path(key))
+
+    def get(self, key, names):
+        """ Load the arrays stored under a key.
+
+        Parameters:
+        -----------
+        key   : hash key of the entry
+        names : names of the arrays to load
+
+        Returns:
+        --------
+        arrays : list of memory-mapped arrays (or None if not cached)
+        """
+        path = self.path(key)
+        try:
+            arrays = [np.load(os.path.join(path,n+'.npy'),mmap_mode='r')
+                      for n in names]
+        except (IOError,OSError,ValueError):
+            return None
+
+        # Update the access time for LRU eviction
+        try: os.utime(path,None)
+        except OSError: pass
+        logger.debug("Loaded cache entry %s"%key)
+        return arrays
+
+    def put(self, key, **arrays):
+        """ Store a set of arrays under a key.
+
+        Parameters:
+        -----------
+        key    : hash key of the entry
+        arrays : named arrays to store
+
+        Returns:
+        --------
+        None
+        """
+        if key in self: return
+
+        tmpdir = tempfile.mkdtemp(dir=self.dirname,prefix='.tmp')
+        try:
+            for name,arr in arrays.items():
+                arr = np.asarray(arr).astype(self.dtype,copy=False)
+                np.save(os.path.join(tmpdir,name+'.npy'),arr)
+            os.rename(tmpdir,self.path(key))
+        except OSError:
+            # Another process may have written the same entry
+            shutil.rmtree(tmpdir,ignore_errors=True)
+            if key not in self: raise
+        logger.debug("Wrote cache entry %s"%key)
+        self.evict()
+
+    def entries(self):
+        """ List of (mtime, nbytes, path) for all entries. """
+        ret = []
+        for name in os.listdir(self.dirname):
+            path = os.path.join(self.dirname,name)
+            if name.startswith('.') or not os.path.isdir(path): continue
+            try:
+                nbytes = sum(os.path.getsize(os.path.join(path,f))
+                             for f in os.listdir(path))
+                ret.append((os.path.getmtime(path),nbytes,path))
+            except OSError:
+                continue
+        return sorted(ret)
+
+    def nbytes(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache
+        fits within `max_bytes`. """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime,nbytes,path in entries:
+            if total <= self.max_bytes: break
+            logger.debug("Evicting cache entry %s"%os.path.basename(path))
+            shutil.rmtree(path,ignore_errors=True)
+            total -= nbytes
+
+    def clear(self):
+        for mtime,nbytes,path in self.entries():
+            shutil.rmtree(path,ignore_errors=True)
@@ -124,14 +124,21 @@ def load_header(kwargs):
         logger.error("Failed to load header from file: %(filename)s"%kwargs)
         raise(e)
 
-def load_headers(filenames,multiproc=False,**kwargs):
-    """ Load a set of FITS headers with kwargs. """
+def load_headers(filenames,multiproc=False,threads=False,**kwargs):
+    """ Load a set of FITS headers with kwargs. Headers are small, so
+    reading them with a pool of `threads` is usually faster than
+    spawning processes with `multiproc`. """
     filenames = np.atleast_1d(filenames)
     logger.debug("Loading %s files..."%len(filenames))
 
     kwargs = [dict(filename=f,**kwargs) for f in filenames]
 
-    if multiproc:
+    if threads:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads if threads > 0 else None)
+        out = pool.map(load_header,kwargs)
+        pool.close()
+    elif multiproc:
         from multiprocessing import Pool
         processes = multiproc if multiproc > 0 else None
         pool = Pool(processes,maxtasksperchild=1)
@@ -154,6 +161,9 @@ def load_file(kwargs):
     """
     logger.debug("Loading %(filename)s..."%kwargs)
     try:
+        if kwargs.get('pixels') is not None:
+            return read_pixels(**kwargs)
+        kwargs.pop('pixels',None)
         return fitsio.read(**kwargs)
     except Exception as e:
         logger.error("Failed to load file: %(filename)s"%kwargs)
@@ -186,18 +196,127 @@ def load_files(filenames,multiproc=False,**kwargs):
     logger.debug('Concatenating arrays...')
     return np.concatenate(out)
 
+# Extension holding the pixel ranges of tables sorted by pixel
+PIXEL_INDEX_EXTNAME = 'PIX_INDEX'
+# Number of rows per pixel range
+PIXEL_INDEX_BLOCKSIZE = 256
+
+def pixel_index(pix, blocksize=PIXEL_INDEX_BLOCKSIZE):
+    """ Create an index of the pixel range in each block of rows.
+
+    Parameters:
+    pix       : pixel of each row (sorted)
+    blocksize : number of rows per block
+    Returns:
+    index     : recarray of the row and pixel range of each block
+    """
+    pix = np.asarray(pix)
+    if np.any(pix[1:] < pix[:-1]):
+        msg = "Rows must be sorted by pixel."
+        raise ValueError(msg)
+
+    start = np.arange(0,len(pix),blocksize,dtype='i8')
+    stop = np.minimum(start+blocksize,len(pix))
+    index = np.recarray(len(start),dtype=[('ROWMIN','i8'),('ROWMAX','i8'),
+                                          ('PIXMIN','i8'),('PIXMAX','i8')])
+    index['ROWMIN'] = start
+    index['ROWMAX'] = stop
+    index['PIXMIN'] = pix[start]
+    index['PIXMAX'] = pix[stop-1]
+    return index
+
+def write_pixel_index(filename, pix, column='PIXEL', blocksize=PIXEL_INDEX_BLOCKSIZE):
+    """ Append an index of pixel ranges to a FITS file whose first
+    table is sorted by pixel (see `read_pixels`).
+
+    Parameters:
+    filename  : FITS file name
+    pix       : pixel of each row of the first table (sorted)
+    column    : name of the pixel column
+    blocksize : number of rows per block
+    Returns:
+    None
+    """
+    index = pixel_index(pix,blocksize)
+    header = [dict(name='PIXCOL',value=column,comment='Indexed pixel column')]
+    fitsio.write(filename,index,extname=PIXEL_INDEX_EXTNAME,header=header,clobber=False)
+
+def index_rows(index, pixels):
+    """ Rows of the blocks in a pixel index that may contain pixels. 
+
+    Parameters:
+    index  : pixel index (see `pixel_index`)
+    pixels : sorted array of pixels
+    Returns:
+    rows   : row numbers
+    """
+    lo = np.searchsorted(pixels,index['PIXMIN'],side='left')
+    hi = np.searchsorted(pixels,index['PIXMAX'],side='right')
+    sel = (hi > lo)
+    rows = [np.arange(a,b) for a,b in zip(index['ROWMIN'][sel],index['ROWMAX'][sel])]
+    return np.concatenate(rows) if rows else np.zeros(0,dtype='i8')
+
+def read_pixels(filename, pixels, column='PIXEL', ext=1, **kwargs):
+    """ Read the rows of a FITS table that lie in a set of pixels.
+
+    If the file has a pixel index (see `write_pixel_index`), only the
+    blocks of rows that can contain the pixels are read. Otherwise,
+    the pixel column is read to select the rows.
+
+    Parameters:
+    filename : FITS file name
+    pixels   : pixels to select
+    column   : name of the pixel column (overridden by the index)
+    ext      : table extension
+    kwargs   : passed to fitsio read
+    Returns:
+    data     : rows of the table in the pixels
+    """
+    pixels = np.unique(pixels)
+    with fitsio.FITS(filename) as fits:
+        hdu = fits[ext]
+        nrows = hdu.get_nrows()
+        if PIXEL_INDEX_EXTNAME in fits and ext in (1,'PIX_DATA'):
+            index = fits[PIXEL_INDEX_EXTNAME].read()
+            hdr = fits[PIXEL_INDEX_EXTNAME].read_header()
+            column = hdr.get('PIXCOL',column).strip()
+            rows = index_rows(index,pixels)
+        else:
+            rows = np.arange(nrows)
+
+        if len(rows):
+            pix = hdu.read(columns=[column],rows=rows)[column]
+            rows = rows[np.in1d(pix,pixels)]
+        if not len(rows):
+            return hdu.read(rows=[0],**kwargs)[:0] if nrows else hdu.read(**kwargs)
+        return hdu.read(rows=rows,**kwargs)
+
 def load(args):
-    infile,columns = args
+    infile,columns,selection = (tuple(args) + (None,))[:3]
     logger.debug("Loading %s..."%infile)
-    return fitsio.read(infile,columns=columns)
+    data = fitsio.read(infile,columns=columns)
+    if selection is not None:
+        data = data[selection(data)]
+    return data
 
-def load_infiles(infiles,columns=None,multiproc=False):
+def load_infiles(infiles,columns=None,multiproc=False,selection=None):
+    """ Load a set of FITS files, optionally reading only some
+    columns and selecting rows file by file.
+
+    Parameters:
+    infiles   : input file name(s)
+    columns   : columns to read (all if None)
+    multiproc : number of processes (must be picklable selection)
+    selection : function returning a boolean row selection for the data
+    Returns:
+    data      : concatenated data
+    """
     if isstring(infiles):
         infiles = [infiles]
 
     logger.debug("Loading %s files..."%len(infiles))
 
-    args = list(zip(infiles,len(infiles)*[columns]))
+    args = list(zip(infiles,len(infiles)*[columns],len(infiles)*[selection]))
 
     if multiproc:
         from multiprocessing import Pool
@@ -217,6 +336,99 @@ def load_infiles(infiles,columns=None,multiproc=False):
     logger.debug('Concatenating arrays...')
     return np.concatenate(out)
 
+# Suffix of the columnar store written next to a FITS file
+COLUMN_STORE_EXT = '.cols'
+
+def column_store_path(filename):
+    """ Path of the columnar store for a FITS file. """
+    return os.path.splitext(filename)[0] + COLUMN_STORE_EXT
+
+def write_column_store(dirname,data):
+    """ Write a record array as a columnar store: one native-endian
+    .npy file per column (and a list of the column names), so that
+    the columns can be memory-mapped without parsing or byte-swapping.
+
+    Parameters:
+    dirname : output directory (replaced if it exists)
+    data    : record array
+    Returns:
+    None
+    """
+    import tempfile
+    parent = os.path.dirname(os.path.abspath(dirname))
+    tmpdir = tempfile.mkdtemp(dir=parent,prefix='.tmp_')
+    names = data.dtype.names
+    for name in names:
+        col = np.ascontiguousarray(data[name])
+        col = col.astype(col.dtype.newbyteorder('='),copy=False)
+        np.save(os.path.join(tmpdir,name+'.npy'),col)
+    with open(os.path.join(tmpdir,'columns.txt'),'w') as f:
+        f.write('\n'.join(names)+'\n')
+
+    # Replace the store in one step so readers never see a partial store
+    if os.path.exists(dirname): shutil.rmtree(dirname)
+    os.rename(tmpdir,dirname)
+
+def read_column_store(dirname,columns=None,mmap_mode='r'):
+    """ Memory-map the columns of a columnar store.
+
+    Parameters:
+    dirname   : columnar store directory
+    columns   : columns to map (all if None)
+    mmap_mode : passed to np.load
+    Returns:
+    columns   : ordered dictionary of (memory-mapped) column arrays
+    """
+    if columns is None: columns = column_store_names(dirname)
+    return odict([(c,np.load(os.path.join(dirname,c+'.npy'),mmap_mode=mmap_mode)) 
+                  for c in columns])
+
+def column_store_names(dirname):
+    """ Names of the columns in a columnar store. """
+    with open(os.path.join(dirname,'columns.txt')) as f:
+        return [l.strip() for l in f if l.strip()]
+
+def load_column_stores(dirnames,columns=None,selection=None):
+    """ Load a set of columnar stores into a single record array.
+
+    The selection is evaluated on the memory-mapped columns of each
+    store and the selected rows of all stores are copied once into
+    the output array.
+
+    Parameters:
+    dirnames  : columnar store directories
+    columns   : columns to load (all if None)
+    selection : function returning a boolean row selection for a
+                dictionary of columns
+    Returns:
+    data      : record array
+    """
+    dirnames = np.atleast_1d(dirnames)
+    logger.debug("Loading %s column stores..."%len(dirnames))
+
+    stores,sels,nrows = [],[],[]
+    for dirname in dirnames:
+        store = read_column_store(dirname,columns)
+        if selection is None:
+            sel = slice(None)
+            n = len(next(iter(store.values())))
+        else:
+            sel = np.nonzero(selection(store))[0]
+            n = len(sel)
+        stores.append(store)
+        sels.append(sel)
+        nrows.append(n)
+
+    dtype = [(name,col.dtype,col.shape[1:]) for name,col in stores[0].items()]
+    data = np.empty(sum(nrows),dtype=dtype)
+
+    start = 0
+    for store,sel,n in zip(stores,sels,nrows):
+        for name,col in store.items():
+            data[name][start:start+n] = col[sel]
+        start += n
+    return data
+
 def insert_columns(filename,data,ext=1,force=False,colnum=None):
     #logger.info(filename)
     if not os.path.exists(filename):
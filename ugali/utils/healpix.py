@@ -15,36 +15,49 @@ from ugali.utils import fileio
 from ugali.utils.logger import logger
 import ugali.utils.fileio
 
+# Number of rows copied at a time when merging partial maps
+MERGE_CHUNKSIZE = 2**16
+
 ############################################################
 
+def _nside_shift(nside_lo, nside_hi):
+    """
+    Number of bits separating the NEST indices of pixels at two
+    resolutions (nside_hi >= nside_lo).
+    """
+    ratio = int(nside_hi)//int(nside_lo)
+    if ratio*int(nside_lo) != int(nside_hi) or (ratio & (ratio-1)):
+        msg = "Invalid nside ratio: %s/%s"%(nside_hi,nside_lo)
+        raise ValueError(msg)
+    return 2*(ratio.bit_length()-1)
+
 def superpixel(subpix, nside_subpix, nside_superpix):
     """
-    Return the indices of the super-pixels which contain each of the sub-pixels.
+    Return the indices of the super-pixels which contain each of the
+    sub-pixels (RING ordering). Exact integer operation in NEST.
     """
     if nside_subpix==nside_superpix: return subpix
-    theta, phi =  hp.pix2ang(nside_subpix, subpix)
-    return hp.ang2pix(nside_superpix, theta, phi)
-
+    return d_grade_ipix(subpix, nside_subpix, nside_superpix)
 
 def subpixel(superpix, nside_superpix, nside_subpix):
     """
     Return the indices of sub-pixels (resolution nside_subpix) within
-    the super-pixel with (resolution nside_superpix).
-    
-    ADW: It would be better to convert to next and do this explicitly
+    the super-pixel with (resolution nside_superpix) in RING ordering.
+    Exact integer operation in NEST.
+
+    For an array of super-pixels, the result has one (sorted) row of
+    sub-pixels per super-pixel.
     """
     if nside_superpix==nside_subpix: return superpix
-    vec = hp.pix2vec(nside_superpix, superpix)
-    radius = np.degrees(2. * hp.max_pixrad(nside_superpix))
-    subpix = query_disc(nside_subpix, vec, radius)
-    pix_for_subpix = superpixel(subpix,nside_subpix,nside_superpix)
-    # Might be able to speed up array indexing...
-    return subpix[pix_for_subpix == superpix]
+    subpix = u_grade_ipix(superpix, nside_superpix, nside_subpix)
+    return np.sort(subpix,axis=-1)
 
 def d_grade_ipix(ipix, nside_in, nside_out, nest=False):
     """
     Return the indices of the super-pixels which contain each of the
-    sub-pixels (nside_in > nside_out).
+    sub-pixels (nside_in > nside_out). The NEST index of the
+    super-pixel is given by dropping the low-order bits of the NEST
+    index of the sub-pixel.
 
     Parameters:
     -----------
@@ -61,12 +74,21 @@ def d_grade_ipix(ipix, nside_in, nside_out, nest=False):
     if not (nside_in > nside_out): 
         raise ValueError("nside_out must be less than nside_in")
 
-    return hp.vec2pix(nside_out, *hp.pix2vec(nside_in, ipix, nest), nest=nest)
+    shift = _nside_shift(nside_out, nside_in)
+    if nest: nest_ipix = np.asarray(ipix,dtype=np.int64)
+    else:    nest_ipix = hp.ring2nest(nside_in, ipix)
+
+    nest_ipix_out = np.right_shift(nest_ipix,shift)
+
+    if nest: return nest_ipix_out
+    else:    return hp.nest2ring(nside_out, nest_ipix_out)
 
 def u_grade_ipix(ipix, nside_in, nside_out, nest=False):
     """
     Return the indices of sub-pixels (resolution nside_subpix) within
-    the super-pixel(s) (resolution nside_superpix).
+    the super-pixel(s) (resolution nside_superpix). The NEST indices
+    of the sub-pixels share the high-order bits of the NEST index of
+    the super-pixel.
     
     Parameters:
     -----------
@@ -83,14 +105,15 @@ def u_grade_ipix(ipix, nside_in, nside_out, nest=False):
     if not (nside_in < nside_out): 
         raise ValueError("nside_in must be less than nside_out")
 
-    if nest: nest_ipix = ipix
+    shift = _nside_shift(nside_in, nside_out)
+    if nest: nest_ipix = np.asarray(ipix,dtype=np.int64)
     else:    nest_ipix = hp.ring2nest(nside_in, ipix)
 
-    factor = (nside_out//nside_in)**2
+    offset = np.arange(1 << shift, dtype=np.int64)
     if np.isscalar(ipix):
-        nest_ipix_out = factor*nest_ipix + np.arange(factor)
+        nest_ipix_out = np.left_shift(nest_ipix,shift) + offset
     else:
-        nest_ipix_out = factor*np.asarray(nest_ipix)[:,np.newaxis]+np.arange(factor)
+        nest_ipix_out = np.left_shift(np.asarray(nest_ipix)[:,np.newaxis],shift) + offset
 
     if nest: return nest_ipix_out
     else:    return hp.nest2ring(nside_out, nest_ipix_out)
@@ -365,7 +388,9 @@ def write_partial_map(filename, data, nside, coord=None, nest=False,
                       header=None,dtype=None,**kwargs):
     """
     Partial HEALPix maps are used to efficiently store maps of the sky by only
-    writing out the pixels that contain data.
+    writing out the pixels that contain data. The rows are sorted by
+    pixel and an index of pixel ranges is written to a separate
+    extension, so that subsets of pixels can be read efficiently.
 
     Three-dimensional data can be saved by supplying a distance modulus array
     which is stored in a separate extension.
@@ -400,26 +425,42 @@ def write_partial_map(filename, data, nside, coord=None, nest=False,
     if header is not None:
         for k,v in header.items():
             fitshdr.add_record({'name':k,'value':v})
+    # Sort the rows by pixel
+    pix = np.asarray(data['PIXEL'])
+    order = np.argsort(pix,kind='stable')
+    if isinstance(data,dict):
+        data = odict([(k,np.asarray(data[k])[order]) for k in names])
+    else:
+        data = data[order]
+
     # ADW: Should this be a debug?
     logger.info("Writing %s..."%filename)
     fitsio.write(filename,data,extname='PIX_DATA',header=fitshdr,clobber=True)
+    fileio.write_pixel_index(filename,pix[order])
 
-def read_partial_map(filenames, column, fullsky=True, **kwargs):
+def read_partial_map(filenames, column, fullsky=True, pixels=None, **kwargs):
     """
     Read a partial HEALPix file(s) and return pixels and values/map. Can
     handle 3D healpix maps (pix, value, zdim). Returned array has
     shape (dimz,npix).
 
+    If `pixels` is specified, only the rows of those pixels are read
+    (see `fileio.read_pixels`) and their values are returned (filled
+    with UNSEEN where missing from the file) without building the
+    fullsky map.
+
     Parameters:
     -----------
     filenames     : list of input filenames
-    column        : column of interest
-    fullsky       : partial or fullsky map
+    column        : column (or list of columns) of interest
+    fullsky       : partial or fullsky map (ignored if pixels is set)
+    pixels        : pixels to look up
     kwargs        : passed to fitsio.read
 
     Returns:
     --------
-    (nside,pix,map) : pixel array and healpix map (partial or fullsky)
+    (nside,pix,map) : pixel array and healpix map (partial, fullsky or 
+                      at the requested pixels)
     """
     import fitsio
 
@@ -429,7 +470,7 @@ def read_partial_map(filenames, column, fullsky=True, **kwargs):
 
     filenames = np.atleast_1d(filenames)
     header = fitsio.read_header(filenames[0],ext=kwargs.get('ext',1))
-    data = fileio.load_files(filenames,**kwargs)
+    data = fileio.load_files(filenames,pixels=pixels,**kwargs)
 
     pix = data['PIXEL']
     value = data[column]
@@ -441,6 +482,10 @@ def read_partial_map(filenames, column, fullsky=True, **kwargs):
         msg = '%i duplicate pixels during load.'%(ndupes)
         raise Exception(msg)
 
+    if pixels is not None:
+        pixels = np.asarray(pixels)
+        return (nside,pixels,lookup_partial_map(pix,value,pixels).T)
+
     if fullsky and not np.isscalar(column):
         raise Exception("Cannot make fullsky map from list of columns.")
     
@@ -453,21 +498,340 @@ def read_partial_map(filenames, column, fullsky=True, **kwargs):
     else:
         return (nside,pix,value.T)
 
-def merge_partial_maps(filenames,outfile,**kwargs):
+def _fill_value(dtype, fill_value=hp.UNSEEN):
     """
+    Fill value that can be held by a dtype. Integer types that cannot
+    represent `fill_value` (e.g., UNSEEN) are filled with -1 (0 if
+    unsigned) and booleans with False.
+    """
+    dtype = np.dtype(dtype).base
+    if dtype.kind == 'b':
+        return bool(fill_value) if fill_value in (0,1) else False
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        if np.isfinite(fill_value) and fill_value == np.round(fill_value) \
+           and info.min <= fill_value <= info.max:
+            return fill_value
+        return -1 if dtype.kind == 'i' else 0
+    return fill_value
+
+def lookup_partial_map(pix, value, pixels, fill_value=hp.UNSEEN):
+    """
+    Look up the values of a partial map at a set of pixels with a
+    sorted search (rather than indexing a fullsky map).
+
+    Parameters:
+    -----------
+    pix        : pixels of the partial map
+    value      : values of the partial map (first axis over pix)
+    pixels     : pixels to look up
+    fill_value : value for pixels missing from the partial map (see
+                 `_fill_value` for integer columns)
+
+    Returns:
+    --------
+    values : values at the requested pixels
+    """
+    shape = (len(pixels),) + value.shape[1:]
+    out = np.empty(shape,dtype=value.dtype)
+    if value.dtype.names:
+        for name in value.dtype.names:
+            out[name] = _fill_value(value.dtype[name],fill_value)
+    else:
+        out[...] = _fill_value(value.dtype,fill_value)
+    if len(pix) == 0: return out
+
+    order = np.argsort(pix)
+    idx = np.searchsorted(pix[order],pixels).clip(0,len(pix)-1)
+    found = (pix[order][idx] == pixels)
+    out[found] = value[order[idx[found]]]
+    return out
+
+class SparseHealpixMap(object):
+    """
+    A partial HEALPix map holding a structured array of values for a
+    sorted set of pixels, together with a coarse coverage bitmap. Values
+    are looked up with a sorted search (after rejecting pixels outside
+    of the coarse coverage) so that no fullsky array is allocated.
+
+    Plain arrays of values are stored in a 'VALUE' field; a dictionary
+    or structured array stores one field per column. Fields can be
+    multi-dimensional (e.g., one value per distance modulus).
+    """
+    NSIDE_COVERAGE = 32
+
+    def __init__(self, nside, pixels, values, nest=False):
+        """
+        Parameters:
+        -----------
+        nside  : healpix nside of the map
+        pixels : pixels containing data
+        values : values of the pixels (array, dict, or structured array)
+        nest   : pixel ordering is NEST
+
+        Returns:
+        --------
+        map    : SparseHealpixMap object
+        """
+        self.nside = int(nside)
+        self.nest = bool(nest)
+
+        pixels = np.asarray(pixels,dtype=np.int64).ravel()
+        values = self._structured(values)
+        if len(values) != len(pixels):
+            msg = "Number of values does not match number of pixels."
+            raise ValueError(msg)
+
+        order = np.argsort(pixels,kind='stable')
+        self.pixels = pixels[order]
+        self.values = values[order]
+        if np.any(self.pixels[1:] == self.pixels[:-1]):
+            msg = '%i duplicate pixels.'%(len(self.pixels)-len(np.unique(self.pixels)))
+            raise ValueError(msg)
+
+        self.nside_coverage = min(self.nside,self.NSIDE_COVERAGE)
+        self.coverage = np.zeros(hp.nside2npix(self.nside_coverage),dtype=bool)
+        self.coverage[self._coarse(self.pixels)] = True
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    @property
+    def names(self):
+        return list(self.values.dtype.names)
+
+    @staticmethod
+    def _structured(values):
+        """ Convert values to a structured array. """
+        if isinstance(values,dict):
+            names = list(values.keys())
+            arrays = [np.asarray(values[n]) for n in names]
+        elif getattr(values,'dtype',None) is not None and values.dtype.names:
+            return np.asarray(values)
+        else:
+            names,arrays = ['VALUE'],[np.asarray(values)]
+        dtype = [(n,a.dtype,a.shape[1:]) for n,a in zip(names,arrays)]
+        out = np.empty(len(arrays[0]),dtype=dtype)
+        for n,a in zip(names,arrays): out[n] = a
+        return out
+
+    def _coarse(self, pixels):
+        return d_grade_ipix(pixels,self.nside,self.nside_coverage,nest=self.nest)
+
+    def _fill(self, shape, fill_value):
+        out = np.empty(shape,dtype=self.values.dtype)
+        for name in self.names:
+            out[name] = _fill_value(self.values.dtype[name],fill_value)
+        return out
+
+    def index(self, pixels):
+        """
+        Index of each pixel in the map.
+
+        Parameters:
+        -----------
+        pixels : pixels to look up
+
+        Returns:
+        --------
+        index  : index into `pixels`/`values` (-1 for missing pixels)
+        """
+        pixels = np.asarray(pixels,dtype=np.int64)
+        flat = pixels.ravel()
+        index = -np.ones(len(flat),dtype=np.int64)
+        if not len(self.pixels) or not len(flat):
+            return index.reshape(pixels.shape)
+
+        # Reject pixels outside the coarse coverage
+        cand, = np.where(self.coverage[self._coarse(flat)])
+        idx = np.searchsorted(self.pixels,flat[cand]).clip(0,len(self.pixels)-1)
+        found = (self.pixels[idx] == flat[cand])
+        index[cand[found]] = idx[found]
+        return index.reshape(pixels.shape)
+
+    def contains(self, pixels):
+        """ Whether each pixel is in the map. """
+        return self.index(pixels) >= 0
+
+    def lookup(self, pixels, column=None, fill_value=hp.UNSEEN):
+        """
+        Look up the values of the map at a set of pixels.
+
+        Parameters:
+        -----------
+        pixels     : pixels to look up
+        column     : column to return (default: all columns)
+        fill_value : value for pixels missing from the map (integer
+                     columns that cannot hold it are filled with -1)
+
+        Returns:
+        --------
+        values : values at the requested pixels
+        """
+        index = np.atleast_1d(self.index(pixels))
+        out = self._fill(index.shape,fill_value)
+        found = (index >= 0)
+        out[found] = self.values[index[found]]
+        if column is not None: out = out[column]
+        return out
+
+    def ud_grade(self, nside_out, how='mean'):
+        """
+        Change the resolution of the map. Upgraded pixels inherit the
+        value of their parent (divided among the children for
+        how='sum'). Degraded pixels combine the values of the children
+        present in the map with `how` in ('mean','sum','min','max').
+
+        Parameters:
+        -----------
+        nside_out : output nside
+        how       : how to combine pixel values
+
+        Returns:
+        --------
+        map       : SparseHealpixMap at nside_out
+        """
+        nside_out = int(nside_out)
+        if how not in ('mean','sum','min','max'):
+            msg = "Unrecognized method: %s"%how
+            raise ValueError(msg)
+
+        if nside_out == self.nside:
+            return SparseHealpixMap(self.nside,self.pixels,self.values.copy(),self.nest)
+
+        if nside_out > self.nside:
+            pixels = u_grade_ipix(self.pixels,self.nside,nside_out,self.nest)
+            nsub = pixels.shape[-1]
+            values = np.repeat(self.values,nsub)
+            if how == 'sum':
+                for name in self.names: values[name] = values[name] / nsub
+            return SparseHealpixMap(nside_out,pixels.ravel(),values,self.nest)
+
+        superpix = d_grade_ipix(self.pixels,self.nside,nside_out,self.nest)
+        pixels,inverse,counts = np.unique(superpix,return_inverse=True,
+                                          return_counts=True)
+        values = np.empty(len(pixels),dtype=self.values.dtype)
+        if not len(pixels):
+            return SparseHealpixMap(nside_out,pixels,values,self.nest)
+
+        # Group the children of each super-pixel and reduce
+        order = np.argsort(inverse,kind='stable')
+        start = np.cumsum(counts) - counts
+        ufunc = dict(mean=np.add,sum=np.add,min=np.minimum,max=np.maximum)[how]
+        for name in self.names:
+            value = ufunc.reduceat(self.values[name][order],start,axis=0)
+            if how == 'mean':
+                value = value / counts.reshape((-1,)+(1,)*(value.ndim-1))
+            values[name] = value
+        return SparseHealpixMap(nside_out,pixels,values,self.nest)
+
+    def _check(self, other):
+        if (self.nside,self.nest) != (other.nside,other.nest):
+            msg = "Incompatible maps: nside=%s,%s"%(self.nside,other.nside)
+            raise ValueError(msg)
+        if self.values.dtype != other.values.dtype:
+            msg = "Incompatible map values: %s,%s"%(self.values.dtype,other.values.dtype)
+            raise ValueError(msg)
+
+    def union(self, other):
+        """
+        Union of the pixels of two maps. Where both maps contain a
+        pixel, the value of this map is kept.
+        """
+        self._check(other)
+        pixels = np.concatenate([self.pixels,other.pixels])
+        values = np.concatenate([self.values,other.values])
+        pixels,idx = np.unique(pixels,return_index=True)
+        return SparseHealpixMap(self.nside,pixels,values[idx],self.nest)
+
+    def intersection(self, other):
+        """
+        Intersection of the pixels of two maps with the values of this
+        map. Only the pixels of `other` are used, so its values may
+        have any dtype.
+        """
+        if (self.nside,self.nest) != (other.nside,other.nest):
+            msg = "Incompatible maps: nside=%s,%s"%(self.nside,other.nside)
+            raise ValueError(msg)
+        sel = np.in1d(self.pixels,other.pixels,assume_unique=True)
+        return SparseHealpixMap(self.nside,self.pixels[sel],self.values[sel],self.nest)
+
+    def fullsky(self, column='VALUE', fill_value=hp.UNSEEN):
+        """
+        Fullsky healpix array of one column (for plotting and
+        compatibility; allocates the full map).
+        """
+        value = self.values[column]
+        hpxmap = np.empty((hp.nside2npix(self.nside),)+value.shape[1:],dtype=value.dtype)
+        hpxmap[...] = _fill_value(value.dtype,fill_value)
+        hpxmap[self.pixels] = value
+        return hpxmap
+
+    def write(self, filename, coord=None, header=None, **kwargs):
+        """
+        Write the map as a partial healpix file (see `write_partial_map`).
+        """
+        data = odict([('PIXEL',self.pixels)])
+        for name in self.names: data[name] = self.values[name]
+        write_partial_map(filename,data,self.nside,coord=coord,nest=self.nest,
+                          header=header,**kwargs)
+
+    @classmethod
+    def read(cls, filenames, columns=None, pixels=None, **kwargs):
+        """
+        Read partial healpix file(s). If `pixels` is specified, only
+        the rows of those pixels are read.
+
+        Parameters:
+        -----------
+        filenames : input filename(s)
+        columns   : column(s) to read (default: all)
+        pixels    : pixels to read (default: all)
+        kwargs    : passed to `fileio.load_files`
+
+        Returns:
+        --------
+        map       : SparseHealpixMap object
+        """
+        filenames = np.atleast_1d(filenames)
+        header = fitsio.read_header(filenames[0],ext=kwargs.get('ext',1))
+        nest = (header.get('ORDERING','RING').strip() == 'NEST')
+        if columns is not None:
+            kwargs['columns'] = ['PIXEL'] + np.atleast_1d(columns).tolist()
+
+        data = fileio.load_files(filenames,pixels=pixels,**kwargs)
+        values = odict([(n,data[n]) for n in data.dtype.names if n != 'PIXEL'])
+        return cls(header['NSIDE'],data['PIXEL'],values,nest=nest)
+
+def merge_partial_maps(filenames,outfile,threads=8,**kwargs):
+    """
+    Merge partial HEALPix maps with a DISTANCE_MODULUS extension (e.g.,
+    the output of the likelihood scan). If `outfile` is specified, the
+    maps are streamed to it (see `stream_partial_maps`) and no merged
+    data is held in memory.
+
     Parameters:
     -----------
     filenames : list of filenames to merge
-    outfile   : name of outfile to create
+    outfile   : name of outfile to create (None to return the data)
+    threads   : number of threads for reading the inputs
     kwargs    : kwargs passed to fitsio.read
 
     Returns:
     --------
-    None
+    nside,data,distance : nside, merged data (None if written to 
+                          outfile) and distance moduli
     """
     import fitsio
     filenames = np.atleast_1d(filenames)
 
+    if outfile is not None:
+        nside,distance = stream_partial_maps(filenames,outfile,threads=threads)
+        return nside,None,distance
+
     header = fitsio.read_header(filenames[0],ext=kwargs.get('ext',1))
     nside = header['NSIDE']
     data = fileio.load_files(filenames,**kwargs)
@@ -490,13 +854,94 @@ def merge_partial_maps(filenames,outfile,**kwargs):
         raise Exception(msg)
     del distance
 
-    # Writing partial maps
-    if outfile is not None:
-        write_partial_map(outfile,data=data,nside=nside,clobber=True)
-        fitsio.write(outfile,{extname:unique_distance},extname=extname)
-
     return nside,data,unique_distance
 
+def _read_merge_input(filename):
+    """ Read the nside, dtype, pixels and distance moduli of a partial map. """
+    with fitsio.FITS(filename) as fits:
+        hdu = fits['PIX_DATA']
+        nside = hdu.read_header()['NSIDE']
+        dtype = hdu.get_rec_dtype()[0]
+        pix = hdu.read_column('PIXEL')
+        distance = fits['DISTANCE_MODULUS'].read_column('DISTANCE_MODULUS')
+    return nside,dtype,pix,distance
+
+def stream_partial_maps(filenames, outfile, chunksize=MERGE_CHUNKSIZE, threads=8):
+    """
+    Merge partial HEALPix maps into a single file sorted by pixel
+    with bounded memory. The PIXEL column (and distance moduli) of the
+    inputs are read concurrently; the rows are then copied to the
+    output in chunks of `chunksize` rows in pixel order, so that only
+    the pixel numbers (not the data) of all inputs are held in memory.
+
+    Parameters:
+    -----------
+    filenames : list of filenames to merge
+    outfile   : name of outfile to create
+    chunksize : number of rows to copy at a time
+    threads   : number of threads for reading the inputs
+
+    Returns:
+    --------
+    nside,distance : nside and distance moduli of the merged map
+    """
+    from multiprocessing.pool import ThreadPool
+    filenames = np.atleast_1d(filenames)
+
+    logger.debug("Reading pixels from %s files..."%len(filenames))
+    pool = ThreadPool(max(int(threads),1))
+    inputs = pool.map(_read_merge_input,filenames)
+    pool.close()
+
+    nside,dtype,_,distance = inputs[0]
+    for filename,(_nside,_dtype,_,_distance) in zip(filenames,inputs):
+        if _nside != nside or _dtype != dtype:
+            msg = "Non-matching map format: %s"%filename
+            raise Exception(msg)
+        if not np.array_equal(_distance,distance):
+            msg = "Non-matching distance modulus:"
+            msg += '\n'+str(_distance)
+            msg += '\n'+str(distance)
+            raise Exception(msg)
+
+    # File and row of each pixel in pixel order
+    pix = np.concatenate([i[2] for i in inputs]).astype(np.int64)
+    fileidx = np.repeat(np.arange(len(inputs)),[len(i[2]) for i in inputs])
+    rowidx = np.concatenate([np.arange(len(i[2])) for i in inputs])
+    del inputs
+    order = np.argsort(pix,kind='stable')
+    pix,fileidx,rowidx = pix[order],fileidx[order],rowidx[order]
+    del order
+
+    ndupes = np.count_nonzero(pix[1:] == pix[:-1])
+    if ndupes > 0:
+        msg = '%i duplicate pixels during load.'%(ndupes)
+        raise Exception(msg)
+
+    hdr = header_odict(nside=nside)
+    fitshdr = fitsio.FITSHDR(list(hdr.values()))
+    logger.info("Writing %s..."%outfile)
+    with fitsio.FITS(outfile,'rw',clobber=True) as fits:
+        for start in range(0,max(len(pix),1),chunksize):
+            files = fileidx[start:start+chunksize]
+            rows = rowidx[start:start+chunksize]
+            data = np.empty(len(rows),dtype=dtype)
+            for i in np.unique(files):
+                idx, = np.where(files == i)
+                srt = np.argsort(rows[idx])
+                data[idx[srt]] = fitsio.read(filenames[i],ext='PIX_DATA',
+                                             rows=rows[idx[srt]])
+            if start == 0:
+                fits.write(data,extname='PIX_DATA',header=fitshdr)
+            else:
+                fits['PIX_DATA'].append(data)
+            del data
+
+    fileio.write_pixel_index(outfile,pix)
+    extname = 'DISTANCE_MODULUS'
+    fitsio.write(outfile,{extname:distance},extname=extname)
+    return nside,distance
+
 def merge_likelihood_headers(filenames, outfile, **kwargs):
     """
     Merge header information from likelihood files.
@@ -517,7 +962,8 @@ def merge_likelihood_headers(filenames, outfile, **kwargs):
     nside = fitsio.read_header(filenames[0],ext=ext)['LKDNSIDE']
 
     keys = ['LKDPIX','STELLAR','NINSIDE','NANNULUS']
-    data_dict = fileio.load_headers(filenames,ext=ext,keys=keys,mulitproc=8)
+    threads = kwargs.get('threads',8)
+    data_dict = fileio.load_headers(filenames,ext=ext,keys=keys,threads=threads)
     names = data_dict.dtype.names
     data_dict.dtype.names = ['PIXEL' if n=='LKDPIX' else n for n in names]
 
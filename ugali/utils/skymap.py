@@ -8,7 +8,7 @@ import healpy as hp
 import ugali.utils.projector
 from ugali.utils.healpix import superpixel,subpixel
 from ugali.utils.healpix import ang2pix,pix2ang,query_disc
-from ugali.utils.healpix import read_partial_map
+from ugali.utils.healpix import SparseHealpixMap
 from ugali.utils.logger import logger
 from ugali.utils.config import Config
 
@@ -53,7 +53,6 @@ def inFootprint(config, pixels, nside=None):
     config = Config(config)
     nside_catalog    = config['coords']['nside_catalog']
     nside_likelihood = config['coords']['nside_likelihood']
-    nside_pixel      = config['coords']['nside_pixel']
 
     if np.isscalar(pixels): pixels = np.array([pixels])
     if nside is None: nside = nside_likelihood
@@ -72,15 +71,12 @@ def inFootprint(config, pixels, nside=None):
 
     # Load the first mask
     logger.debug("Loading %s"%fnames['mask_1'])
-    _nside,subpix1,val1 = read_partial_map(fnames['mask_1'],'MAGLIM',
-                                           fullsky=False,multiproc=8)
+    mask1 = SparseHealpixMap.read(fnames['mask_1'],'MAGLIM',multiproc=8)
     # Load the second mask
     logger.debug("Loading %s"%fnames['mask_2'])
-    _nside,subpix2,val2 = read_partial_map(fnames['mask_2'],'MAGLIM',
-                                           fullsky=False,multiproc=8)
+    mask2 = SparseHealpixMap.read(fnames['mask_2'],'MAGLIM',multiproc=8)
     # Run the subpixels
-    subpix = np.intersect1d(subpix1,subpix2)
-    superpix = np.unique(superpixel(subpix,nside_pixel,nside))
+    superpix = mask1.intersection(mask2).ud_grade(nside).pixels
     inside |= np.in1d(pixels, superpix)
     
     return inside